@@ -0,0 +1,235 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Age after which a temporary file is left over by a failed write, not one
+# still being written.
+STALE_TMP_SECONDS = 300
+
+
+class AnnotationCache:
+  """LRU cache with TTL for the raw detector responses of an image.
+
+  The responses do not depend on the threshold nor on the creative size, so
+  they can be reused by any later request for the same image. Entries live in
+  memory and, when a directory is given, also on the local drive so they
+  survive restarts and are shared between workers. The files on the drive are
+  swept at most every sweep_seconds: the expired ones are removed, then the
+  oldest ones until they fit in max_disk_bytes.
+  """
+
+  def __init__(self, max_entries=256, ttl_seconds=3600, cache_dir=None,
+               max_disk_bytes=256 * 1024 * 1024, sweep_seconds=60):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.cache_dir = cache_dir
+    self.max_disk_bytes = max_disk_bytes
+    self.sweep_seconds = sweep_seconds
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._next_sweep = 0.0
+
+    if cache_dir:
+      os.makedirs(cache_dir, exist_ok=True)
+
+  @staticmethod
+  def make_key(img_url, content, detector='vision'):
+    """Builds the cache key for an image.
+
+    Args:
+        img_url (str): URL of the image
+        content (bytes): content of the image
+        detector (str, optional): cache id of the detector backend, the same
+          image gets different annotations from every backend. Defaults to
+          vision
+
+    Returns:
+        str: hex digest identifying the image and the detector
+    """
+    content_hash = hashlib.sha256(content).digest()
+    return hashlib.sha256(detector.encode('utf-8') + b'\0' +
+                          img_url.encode('utf-8') + b'\0' +
+                          content_hash).hexdigest()
+
+  def _disk_path(self, key):
+    return os.path.join(self.cache_dir, f'{key}.json')
+
+  def _read_from_disk(self, key):
+    """Reads an entry from the local drive.
+
+    Args:
+        key (str): cache key
+
+    Returns:
+        (float, Dict[str, Dict]): expiration time and annotations or None if
+        the entry is missing or expired
+    """
+    try:
+      with open(self._disk_path(key), 'r') as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return None
+
+    if entry['expires_at'] <= time.time():
+      try:
+        os.remove(self._disk_path(key))
+      except OSError:
+        pass
+      return None
+
+    return (entry['expires_at'], entry['annotations'])
+
+  def _write_to_disk(self, key, expires_at, annotations):
+    """Writes an entry atomically to the local drive.
+
+    Args:
+        key (str): cache key
+        expires_at (float): expiration time in seconds since the epoch
+        annotations (Dict[str, Dict]): the Vision API response
+    """
+    try:
+      fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    except OSError as ex:
+      print(ex)
+      return
+    try:
+      with os.fdopen(fd, 'w') as f:
+        json.dump({'expires_at': expires_at, 'annotations': annotations}, f)
+      os.replace(tmp_path, self._disk_path(key))
+    except OSError as ex:
+      print(ex)
+    finally:
+      # Only still there when the write or the rename failed.
+      try:
+        os.remove(tmp_path)
+      except OSError:
+        pass
+
+  def sweep_disk(self):
+    """Removes the expired files from the local drive, then the oldest ones
+    while they take more than max_disk_bytes. The temporary files left over by
+    failed writes are removed too.
+
+    The files are listed every time, the other workers write to the same
+    directory.
+
+    Returns:
+        int: number of files removed
+    """
+    now = time.time()
+    files = []
+    removed = 0
+    with os.scandir(self.cache_dir) as entries:
+      for entry in entries:
+        is_tmp = entry.name.endswith('.tmp')
+        if not is_tmp and not entry.name.endswith('.json'):
+          continue
+        try:
+          stat = entry.stat()
+        except OSError:
+          # Removed by another worker.
+          continue
+        if not is_tmp:
+          files.append((stat.st_mtime, stat.st_size, entry.path))
+        elif stat.st_mtime + STALE_TMP_SECONDS <= now:
+          try:
+            os.remove(entry.path)
+            removed += 1
+          except OSError:
+            pass
+
+    # Written when they were stored, they expire ttl_seconds later.
+    files.sort()
+    total_bytes = sum(size for (_, size, _) in files)
+    for (written_at, size, path) in files:
+      if (written_at + self.ttl_seconds > now and
+          total_bytes <= self.max_disk_bytes):
+        break
+      try:
+        os.remove(path)
+        removed += 1
+      except OSError:
+        pass
+      total_bytes -= size
+    return removed
+
+  def _maybe_sweep_disk(self):
+    with self._lock:
+      now = time.time()
+      if now < self._next_sweep:
+        return
+      self._next_sweep = now + self.sweep_seconds
+    try:
+      removed = self.sweep_disk()
+    except OSError as ex:
+      print(ex)
+      return
+    if removed:
+      print(f'Removed {removed} files from the annotation cache')
+
+  def _store_in_memory(self, key, expires_at, annotations):
+    self._entries[key] = (expires_at, annotations)
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+
+  def get(self, key):
+    """Returns the cached annotations for the key.
+
+    Args:
+        key (str): cache key
+
+    Returns:
+        Dict[str, Dict]: the Vision API response or None if not cached
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        if entry[0] > time.time():
+          self._entries.move_to_end(key)
+          return entry[1]
+        del self._entries[key]
+
+    if not self.cache_dir:
+      return None
+
+    entry = self._read_from_disk(key)
+    if entry is None:
+      return None
+
+    with self._lock:
+      self._store_in_memory(key, entry[0], entry[1])
+    return entry[1]
+
+  def put(self, key, annotations):
+    """Stores the annotations for the key.
+
+    Args:
+        key (str): cache key
+        annotations (Dict[str, Dict]): the Vision API response
+    """
+    expires_at = time.time() + self.ttl_seconds
+    with self._lock:
+      self._store_in_memory(key, expires_at, annotations)
+
+    if self.cache_dir:
+      self._write_to_disk(key, expires_at, annotations)
+      self._maybe_sweep_disk()
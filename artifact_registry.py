@@ -0,0 +1,313 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from gcs_storage import get_storage_manager
+import metrics
+
+LOCAL = 'local'
+GCS = 'gcs'
+# Artifacts removed per sweep, the next sweep picks up the rest.
+MAX_PURGE_BATCH = 1000
+# Wait before trying again to delete an artifact that could not be deleted.
+RETRY_SECONDS = 300
+
+
+class DiskBudgetExceeded(Exception):
+  """A local file does not fit in the disk budget of the generated files."""
+
+
+class ArtifactRegistry:
+  """Index of the generated images and zips with the time they expire.
+
+  A background janitor deletes the expired artifacts, even when the browser
+  never calls /clean. When a new local file does not fit in the disk budget,
+  the expired files and then the oldest unpinned ones are deleted to make
+  room. A file is pinned for min_keep_seconds after it is recorded, while the
+  request that wrote it may still use it.
+
+  The index is a SQLite table on the local drive shared by all the workers of
+  the instance: each sweep claims the rows it deletes in a transaction, so
+  only one worker deletes an artifact. Cloud Storage blobs are deleted in
+  batches, without reading them first.
+  """
+
+  def __init__(self, ttl_seconds=3600, index_path=None, bucket_name=None,
+               max_local_bytes=0, sweep_interval_seconds=60,
+               min_keep_seconds=300):
+    """Initializes the registry.
+
+    Args:
+        ttl_seconds (int, optional): lifetime of the artifacts. Defaults to
+          3600
+        index_path (str, optional): path of the SQLite index. Defaults to a
+          file in the temporary directory
+        bucket_name (str, optional): bucket of the Cloud Storage artifacts.
+          Defaults to None
+        max_local_bytes (int, optional): disk budget of the local artifacts.
+          Defaults to 0, no budget
+        sweep_interval_seconds (int, optional): time between sweeps. Defaults
+          to 60
+        min_keep_seconds (int, optional): time a local file is pinned after it
+          is recorded. Defaults to 300
+    """
+    self.ttl_seconds = ttl_seconds
+    self.index_path = index_path or os.path.join(tempfile.gettempdir(),
+                                                 'creative_artifacts.sqlite3')
+    self.bucket_name = bucket_name
+    self.max_local_bytes = max_local_bytes
+    self.sweep_interval_seconds = sweep_interval_seconds
+    self.min_keep_seconds = min_keep_seconds
+    self._lock = threading.Lock()
+    self._pid = None
+    self._stop = threading.Event()
+
+    with self._connect() as db:
+      db.execute('CREATE TABLE IF NOT EXISTS artifacts (location TEXT, name'
+                 ' TEXT, size INTEGER, expires_at REAL, recorded_at REAL'
+                 ' DEFAULT 0, PRIMARY KEY (location, name))')
+      columns = [row[1] for row in db.execute('PRAGMA table_info(artifacts)')]
+      if 'recorded_at' not in columns:
+        # Index written by a previous version, its files are not pinned.
+        db.execute('ALTER TABLE artifacts ADD COLUMN recorded_at REAL'
+                   ' DEFAULT 0')
+      db.execute('CREATE INDEX IF NOT EXISTS artifacts_by_expiry ON artifacts'
+                 ' (expires_at)')
+
+  @contextlib.contextmanager
+  def _connect(self):
+    # Autocommit, the transactions are started explicitly.
+    db = sqlite3.connect(self.index_path, timeout=10, isolation_level=None)
+    try:
+      yield db
+    finally:
+      db.close()
+
+  def start(self):
+    """Starts the janitor thread once per process.
+
+    Threads do not survive a fork, so it is started again in every worker, by
+    the app when it starts serving.
+    """
+    if self._pid == os.getpid():
+      return
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self._stop = threading.Event()
+      threading.Thread(target=self._run, daemon=True).start()
+
+  def stop(self):
+    """Stops the janitor thread of this process."""
+    self._stop.set()
+
+  def record(self, location, name, size=0, ttl_seconds=None, force=False):
+    """Adds an artifact to the index.
+
+    Args:
+        location (str): LOCAL for a file or GCS for a blob
+        name (str): path of the file or name of the blob
+        size (int, optional): size in bytes. Defaults to 0
+        ttl_seconds (int, optional): lifetime of the artifact. Defaults to
+          None, the one of the registry
+        force (bool, optional): adds a local file even if it does not fit in
+          the disk budget. Defaults to False
+
+    Raises:
+        DiskBudgetExceeded: when a local file does not fit in the disk budget,
+          even once the expired and unpinned files are deleted. The file is
+          not added, nor deleted.
+    """
+    now = time.time()
+    row = (location, name, size, now + (ttl_seconds or self.ttl_seconds), now)
+    if location != LOCAL or not self.max_local_bytes or force:
+      with self._connect() as db:
+        db.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                   row)
+      return
+
+    evicted = self._add_local(row)
+    if evicted is None:
+      raise DiskBudgetExceeded(
+          f'{name} does not fit in the disk budget of the generated files,'
+          f' {self.max_local_bytes} bytes')
+    if evicted:
+      self._retry_later(self._delete(evicted))
+      for _ in evicted:
+        metrics.ARTIFACTS_PURGED.inc(location=LOCAL, reason='evicted')
+      print(f'Evicted {len(evicted)} generated files to make room for {name}')
+
+  def _add_local(self, row):
+    """Adds a local file to the index, taking off the ones it replaces.
+
+    The expired files go first, then the unpinned ones that expire sooner.
+
+    Args:
+        row (tuple): location, name, size, expiry and recording time
+
+    Returns:
+        [(str, str, int)]: location, name and size of the files to delete or
+        None if the file does not fit in the disk budget
+    """
+    (_, name, size, _, now) = row
+    with self._connect() as db:
+      db.execute('BEGIN IMMEDIATE')
+      try:
+        (used,) = db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM artifacts WHERE location = ?'
+            ' AND name != ?', (LOCAL, name)).fetchone()
+        evicted = []
+        if used + size > self.max_local_bytes:
+          candidates = db.execute(
+              'SELECT location, name, size FROM artifacts WHERE location = ?'
+              ' AND name != ? AND (expires_at <= ? OR recorded_at <= ?)'
+              ' ORDER BY expires_at', (LOCAL, name, now,
+                                       now - self.min_keep_seconds))
+          for candidate in candidates:
+            if used + size <= self.max_local_bytes:
+              break
+            evicted.append(candidate)
+            used -= candidate[2]
+        if used + size > self.max_local_bytes:
+          db.execute('ROLLBACK')
+          return None
+        db.executemany('DELETE FROM artifacts WHERE location = ? AND name = ?',
+                       [(location, name) for (location, name, _) in evicted])
+        db.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                   row)
+        db.execute('COMMIT')
+      except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return evicted
+
+  def forget(self, location, name):
+    """Removes an artifact from the index, i.e: once it is deleted.
+
+    Args:
+        location (str): LOCAL or GCS
+        name (str): path of the file or name of the blob
+    """
+    with self._connect() as db:
+      db.execute('DELETE FROM artifacts WHERE location = ? AND name = ?',
+                 (location, name))
+
+  def _claim(self, now):
+    """Takes the expired artifacts off the index.
+
+    Returns:
+        [(str, str, int)]: location, name and size of the artifacts
+    """
+    with self._connect() as db:
+      db.execute('BEGIN IMMEDIATE')
+      try:
+        expired = db.execute(
+            'SELECT location, name, size FROM artifacts WHERE expires_at <= ?'
+            ' ORDER BY expires_at LIMIT ?', (now, MAX_PURGE_BATCH)).fetchall()
+        db.executemany('DELETE FROM artifacts WHERE location = ? AND name = ?',
+                       [(location, name) for (location, name, _) in expired])
+        db.execute('COMMIT')
+      except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return expired
+
+  def _delete(self, artifacts):
+    """Deletes artifacts from the local drive or Cloud Storage.
+
+    Args:
+        artifacts ([(str, str, int)]): location, name and size of the
+          artifacts
+
+    Returns:
+        [(str, str, int)]: the artifacts that could not be deleted
+    """
+    failed = []
+    blobs = {}
+    for (location, name, size) in artifacts:
+      if location == GCS:
+        blobs[name] = size
+        continue
+      try:
+        os.remove(name)
+      except FileNotFoundError:
+        pass
+      except OSError as ex:
+        print(f'Could not delete {name}: {ex}')
+        failed.append((location, name, size))
+
+    if blobs:
+      try:
+        failed.extend((GCS, name, blobs[name]) for name in get_storage_manager(
+            self.bucket_name).delete_blobs(list(blobs)))
+      except Exception as ex:
+        print(f'Could not delete {len(blobs)} blobs: {ex}')
+        failed.extend((GCS, name, size) for (name, size) in blobs.items())
+    return failed
+
+  def _retry_later(self, failed):
+    """Puts back in the index the artifacts that could not be deleted.
+
+    Args:
+        failed ([(str, str, int)]): location, name and size of the artifacts
+    """
+    if not failed:
+      return
+    # Tried again later, with their size so they still count in the disk
+    # budget. A file written again since then keeps its own row.
+    now = time.time()
+    with self._connect() as db:
+      db.executemany(
+          'INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+          [(location, name, size, now + RETRY_SECONDS, 0)
+           for (location, name, size) in failed])
+
+  def purge(self, now=None):
+    """Deletes the expired artifacts.
+
+    Args:
+        now (float, optional): current time. Defaults to None, time.time()
+
+    Returns:
+        int: number of artifacts deleted
+    """
+    expired = self._claim(now or time.time())
+    if not expired:
+      return 0
+
+    failed = self._delete(expired)
+    self._retry_later(failed)
+    deleted = 0
+    for (location, _, _) in set(expired) - set(failed):
+      metrics.ARTIFACTS_PURGED.inc(location=location, reason='expired')
+      deleted += 1
+
+    if deleted:
+      print(f'Purged {deleted} generated artifacts')
+    return deleted
+
+  def _run(self):
+    stop = self._stop
+    while not stop.wait(self.sweep_interval_seconds):
+      try:
+        while self.purge() >= MAX_PURGE_BATCH:
+          pass
+      except Exception as ex:
+        print(f'Error purging the generated artifacts: {ex}')
@@ -0,0 +1,182 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+
+
+# Tokens are file names in the spill directory, they come from the browser.
+_TOKEN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+class ArtifactStore:
+  """Keeps the files generated for a creative until its zip is built.
+
+  Every artifact is identified by a random token handed to the browser. It is
+  written to a file named after the token in a directory shared by all the
+  workers of the instance, so any of them can build the zip, and the most
+  recent artifacts are also kept in the memory of the worker that made them.
+  A file expires ttl_seconds after it was written. The expired ones, including
+  the ones left by a previous run, are swept when the store is created and
+  then at most every sweep_seconds.
+  """
+
+  def __init__(self, max_memory_bytes=64 * 1024 * 1024, ttl_seconds=3600,
+               spill_dir=None, sweep_seconds=60):
+    self.max_memory_bytes = max_memory_bytes
+    self.ttl_seconds = ttl_seconds
+    self.spill_dir = spill_dir or os.path.join(tempfile.gettempdir(),
+                                               'artifacts')
+    self.sweep_seconds = sweep_seconds
+    self._entries = collections.OrderedDict()
+    self._memory_bytes = 0
+    self._lock = threading.Lock()
+    self._next_sweep = 0
+    os.makedirs(self.spill_dir, exist_ok=True)
+    self._maybe_sweep()
+
+  def _spill_path(self, token):
+    return os.path.join(self.spill_dir, token)
+
+  def _forget(self, token):
+    """Drops an artifact from the memory of this worker."""
+    entry = self._entries.pop(token, None)
+    if entry is not None:
+      self._memory_bytes -= len(entry[1])
+
+  def _remove_file(self, path):
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    except OSError as ex:
+      print(ex)
+
+  def sweep(self, now=None):
+    """Deletes the expired files, whichever worker or run wrote them.
+
+    Args:
+        now (float, optional): current time. Defaults to None, time.time()
+
+    Returns:
+        int: number of files deleted
+    """
+    now = now or time.time()
+    deleted = 0
+    try:
+      entries = list(os.scandir(self.spill_dir))
+    except OSError as ex:
+      print(ex)
+      return 0
+    for entry in entries:
+      try:
+        expired = entry.stat().st_mtime + self.ttl_seconds <= now
+      except OSError:
+        continue
+      if expired:
+        self._remove_file(entry.path)
+        deleted += 1
+    return deleted
+
+  def _maybe_sweep(self):
+    now = time.time()
+    if now < self._next_sweep:
+      return
+    self._next_sweep = now + self.sweep_seconds
+    self.sweep(now)
+
+  def _evict(self):
+    """Drops the oldest in-memory artifacts until within budget."""
+    now = time.time()
+    for token, (expires_at, content) in list(self._entries.items()):
+      if self._memory_bytes <= self.max_memory_bytes and expires_at > now:
+        break
+      del self._entries[token]
+      self._memory_bytes -= len(content)
+
+  def put(self, content):
+    """Stores an artifact.
+
+    Args:
+        content (bytes): content of the artifact
+
+    Returns:
+        str: token to retrieve the artifact
+    """
+    token = secrets.token_urlsafe(16)
+    path = self._spill_path(token)
+    # Written under another name, the other workers never read half a file.
+    tmp_path = f'{path}.tmp'
+    try:
+      with open(tmp_path, 'wb') as f:
+        f.write(content)
+      os.replace(tmp_path, path)
+    except OSError as ex:
+      # The worker that made it can still use it.
+      print(ex)
+      self._remove_file(tmp_path)
+
+    with self._lock:
+      self._maybe_sweep()
+      self._entries[token] = (time.time() + self.ttl_seconds, content)
+      self._memory_bytes += len(content)
+      self._evict()
+
+    return token
+
+  def get(self, token):
+    """Retrieves an artifact.
+
+    Args:
+        token (str): token returned when the artifact was stored, by any
+          worker
+
+    Returns:
+        bytes: content of the artifact or None if it is unknown or expired
+    """
+    if not _TOKEN.match(token or ''):
+      return None
+    with self._lock:
+      entry = self._entries.get(token)
+      if entry is not None and entry[0] > time.time():
+        return entry[1]
+
+    path = self._spill_path(token)
+    try:
+      with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_mtime + self.ttl_seconds <= time.time():
+          return None
+        return f.read()
+    except FileNotFoundError:
+      return None
+    except OSError as ex:
+      print(ex)
+      return None
+
+  def discard(self, token):
+    """Deletes an artifact once it is no longer needed.
+
+    Args:
+        token (str): token of the artifact
+    """
+    if not _TOKEN.match(token or ''):
+      return
+    with self._lock:
+      self._forget(token)
+    self._remove_file(self._spill_path(token))
@@ -0,0 +1,505 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""ASGI entry point that builds the creatives without blocking a worker.
+
+/build_creative, /generate_zip and /clean are served by async handlers: the
+image, the Vision API and the other HTTP calls go through the async HTTP
+client, the Cloud Storage calls run in a thread pool for I/O and the OpenCV
+work in a bounded thread pool, OpenCV releases the GIL while it works. The
+upload of the image, the signature of its URL and the HTML of the objects are
+done at the same time. A single process serves many creatives at once. The
+Vision API is always called from the loop, VISION_BATCH_SIZE only batches the
+calls of the Flask app.
+
+Every other route is served by the Flask app of main, run in the I/O pool.
+
+Usage: uvicorn asgi_app:app --port 8080
+   or: gunicorn -k uvicorn.workers.UvicornWorker -w 2 asgi_app:app
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import io
+import json
+import os
+import sys
+import time
+from urllib import parse
+import async_http_client
+import creative_service
+import generate_creative
+import image_codec
+import main
+import metrics
+from werkzeug.wrappers import Request
+
+# The OpenCV work is bounded by the cores, the I/O threads mostly wait.
+CPU_WORKERS = int(os.environ.get('ASGI_CPU_WORKERS', os.cpu_count() or 1))
+IO_WORKERS = int(os.environ.get('ASGI_IO_WORKERS', 32))
+MAX_REQUEST_BYTES = int(
+    os.environ.get('ASGI_MAX_REQUEST_MB', 32)) * 1024 * 1024
+VISION_ENDPOINT = 'https://vision.googleapis.com/v1/images:annotate'
+
+CPU_EXECUTOR = None
+IO_EXECUTOR = None
+
+
+async def _run(executor, fn, *args, context=None):
+  """Runs a blocking function in an executor without blocking the loop.
+
+  The function runs in a copy of the current context, so its metric spans are
+  added to the request.
+
+  Args:
+      executor (Executor): CPU_EXECUTOR or IO_EXECUTOR
+      fn (Callable): the function
+      *args: its arguments
+      context (contextvars.Context, optional): context to run it in. Defaults
+        to a copy of the current one
+
+  Returns:
+      object: what the function returns
+  """
+  context = context or contextvars.copy_context()
+  return await asyncio.get_running_loop().run_in_executor(
+      executor, functools.partial(context.run, fn, *args))
+
+
+def _environ(scope, body):
+  """Builds the WSGI environ of an ASGI HTTP request.
+
+  Args:
+      scope (Dict[str, object]): the ASGI scope
+      body (bytes): the whole body of the request
+
+  Returns:
+      Dict[str, object]: the environ
+  """
+  (server_name, server_port) = scope.get('server') or ('localhost', 80)
+  environ = {
+      'REQUEST_METHOD': scope['method'],
+      'SCRIPT_NAME': scope.get('root_path', ''),
+      'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+      'QUERY_STRING': scope['query_string'].decode('latin-1'),
+      'SERVER_NAME': server_name,
+      'SERVER_PORT': str(server_port),
+      'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+      'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+      'CONTENT_LENGTH': str(len(body)),
+      'wsgi.version': (1, 0),
+      'wsgi.url_scheme': scope.get('scheme', 'http'),
+      'wsgi.input': io.BytesIO(body),
+      'wsgi.errors': sys.stderr,
+      'wsgi.multithread': True,
+      'wsgi.multiprocess': True,
+      'wsgi.run_once': False,
+  }
+  for (name, value) in scope['headers']:
+    name = name.decode('latin-1').upper().replace('-', '_')
+    value = value.decode('latin-1')
+    if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+      name = f'HTTP_{name}'
+    if name in environ and name.startswith('HTTP_'):
+      value = f'{environ[name]},{value}'
+    environ[name] = value
+  return environ
+
+
+async def _read_body(receive):
+  """Reads the whole body of the request.
+
+  Returns:
+      bytes: the body or None when it is over MAX_REQUEST_BYTES
+  """
+  body = bytearray()
+  while True:
+    message = await receive()
+    body += message.get('body', b'')
+    if len(body) > MAX_REQUEST_BYTES:
+      return None
+    if not message.get('more_body'):
+      return bytes(body)
+
+
+async def _send_response(send, status, body, content_type=None, headers=()):
+  response_headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                      for (name, value) in headers]
+  if content_type:
+    response_headers.append((b'content-type', content_type.encode('latin-1')))
+  response_headers.append((b'content-length', str(len(body)).encode('ascii')))
+  await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': response_headers
+  })
+  await send({'type': 'http.response.body', 'body': body})
+
+
+def _render(template_name, **context):
+  """Renders a template of the Flask app, outside of any request.
+
+  Returns:
+      bytes: the rendered template
+  """
+  template = main.app.jinja_env.get_template(template_name)
+  return template.render(**context).encode('utf-8')
+
+
+async def _download_image(img_url):
+  """Downloads the source image and checks it is not too big to decode.
+
+  Returns:
+      bytes: content of the image
+  """
+  with metrics.span('download'):
+    img_content = (await async_http_client.get(
+        img_url, max_bytes=generate_creative.MAX_IMAGE_DOWNLOAD_BYTES)).data
+  metrics.TRANSFERRED_BYTES.inc(len(img_content), direction='in',
+                                peer='image')
+  generate_creative.check_image_size(img_content)
+  return img_content
+
+
+async def _annotate(annotate_request):
+  """Sends an annotate request for a single image to the Vision API.
+
+  Returns:
+      Dict[str, Dict]: the response for the image
+  """
+  body = json.dumps({'requests': [annotate_request]}).encode('utf-8')
+  response = await async_http_client.post(
+      f'{VISION_ENDPOINT}?key={creative_service.API_KEY}', body,
+      headers={'Content-Type': 'application/json'})
+  metrics.VISION_CALLS.inc()
+  metrics.VISION_IMAGES.inc()
+  metrics.TRANSFERRED_BYTES.inc(len(body), direction='out', peer='vision')
+  metrics.TRANSFERRED_BYTES.inc(len(response.data), direction='in',
+                                peer='vision')
+  return response.json()['responses'][0]
+
+
+async def _get_objects(img_url, img_content, img, detector):
+  """Gets the objects in the image from the cache or the detector.
+
+  Returns:
+      Dict[str,Dict]: JSON object in the format of the Vision API response
+  """
+  cache = creative_service.ANNOTATION_CACHE
+  cache_key = await _run(CPU_EXECUTOR, cache.make_key, img_url, img_content,
+                         detector.cache_id)
+  objects = await _run(IO_EXECUTOR, cache.get, cache_key)
+  if objects is not None:
+    metrics.ANNOTATION_CACHE.inc(result='hit')
+    print(f'Using cached objects for {img_url}')
+    return objects
+
+  metrics.ANNOTATION_CACHE.inc(result='miss')
+  with metrics.span(detector.name):
+    if isinstance(detector, generate_creative.VisionDetector):
+      content = None
+      if detector.inline_max_side:
+        content = await _run(CPU_EXECUTOR,
+                             generate_creative.encode_for_vision, img,
+                             detector.inline_max_side)
+      # The batcher would wait on a thread of the I/O pool for the sync
+      # client.
+      objects = {
+          'responses': [
+              await _annotate(
+                  generate_creative.build_annotate_request(img_url, content))
+          ]
+      }
+    else:
+      objects = await _run(CPU_EXECUTOR, detector.detect, img_url, img)
+
+  if 'error' in objects['responses'][0]:
+    raise Exception('Error detecting the objects:'
+                    f" {objects['responses'][0]['error']['message']}")
+  await _run(IO_EXECUTOR, cache.put, cache_key, objects)
+  return objects
+
+
+def _decode(img_content, size, min_side):
+  """Decodes the image big enough for the creative and for the detector.
+
+  Returns:
+      ndarray: the decoded image
+  """
+  with metrics.span('decode'):
+    return generate_creative.decode_for_sizes(img_content, [size], min_side)
+
+
+def _write(path, content):
+  with metrics.span('write'), open(path, 'wb') as f:
+    f.write(content)
+
+
+def _render_creative_image(img, objects, threshold, size, img_name):
+  """Crops the image around the objects for the creative size, encodes it and
+  renders the HTML of its polygons.
+
+  Returns:
+      (str, Html5Parts, bytes): the name of the image, the HTML5 strings ready
+      to be inserted in the template and the encoded image
+  """
+  [(img_name, _, _, polygons, encoded_img)] = generate_creative.render_sizes(
+      img, objects, threshold, [size], img_name,
+      creative_service.OUTPUT_IMAGE_FORMAT, creative_service.MAX_IMAGE_BYTES)
+  with metrics.span('html'):
+    return (img_name, generate_creative.generate_html5_parts(polygons),
+            encoded_img)
+
+
+async def _process_image(img_url, threshold, img_dimensions, local):
+  """Async version of creative_service.process_image.
+
+  Returns:
+      (str, str, int, int, Html5Parts, str): the generated URL of the image,
+      its name, its width and height, the HTML5 strings and the token of the
+      image in the artifact store
+  """
+  (width, height) = (int(value) for value in img_dimensions.split('x'))
+  detector = creative_service.DETECTOR
+
+  img_content = await _download_image(img_url)
+  img = await _run(CPU_EXECUTOR, _decode, img_content, (width, height),
+                   detector.min_side)
+  # The crop is centered on the objects, it waits for them.
+  objects = await _get_objects(img_url, img_content, img, detector)
+  (img_name, html5_parts,
+   encoded_img) = await _run(CPU_EXECUTOR, _render_creative_image, img, objects,
+                             float(threshold), (width, height),
+                             img_url.split('/')[-1])
+  del img
+
+  if local:
+    file_name = f'static/images/{img_name}'
+    await _run(IO_EXECUTOR, _write, file_name, encoded_img)
+    new_img_url = f'/{file_name}'
+  else:
+    file_name = f'{creative_service.GCS_ARTIFACT_DIR}/{img_name}'
+    # The URL can be signed while the image is uploaded.
+    (_, new_img_url) = await asyncio.gather(
+        _run(IO_EXECUTOR, generate_creative.upload_file_to_gcs, encoded_img,
+             file_name, creative_service.GCS_BUCKET,
+             image_codec.content_type_for(image_codec.format_for(img_name))),
+        _run(IO_EXECUTOR, _sign, file_name),
+    )
+
+  await _run(IO_EXECUTOR, creative_service.record_artifact, file_name, local,
+             len(encoded_img))
+  artifact_token = creative_service.ARTIFACT_STORE.put(encoded_img)
+  return (parse.unquote(new_img_url), img_name, width, height, html5_parts,
+          artifact_token)
+
+
+def _sign(file_name):
+  with metrics.span('sign'):
+    return creative_service.get_gcs_signed_url(file_name,
+                                               creative_service.GCS_BUCKET)
+
+
+def _is_local(request):
+  return 'localhost' in request.host_url
+
+
+async def build_creative(request):
+  """Detects all the objects in the image, their labels and presents it in HTML.
+
+  Returns:
+      (int, bytes, str, list): status, body, content type and headers of the
+      response
+  """
+  try:
+    (img_url, img_name, width, height, html5_parts,
+     artifact_token) = await _process_image(request.form['img_url'],
+                                            request.form['threshold'],
+                                            request.form['img_dimensions'],
+                                            _is_local(request))
+    body = await _run(
+        CPU_EXECUTOR,
+        functools.partial(_render, '/build_creative.html', img_url=img_url,
+                          img_name=img_name, width=width, height=height,
+                          artifact_token=artifact_token,
+                          **html5_parts._asdict()))
+  except Exception as ex:
+    body = _render('error.html',
+                   message=f'Error while processing the image:{str(ex)}')
+  return (200, body, 'text/html; charset=utf-8', [])
+
+
+async def generate_zip(request):
+  """Generates and save the zip file.
+
+  Returns:
+      (int, bytes, str, list): status, body, content type and headers of the
+      response
+  """
+  try:
+    img_url = parse.unquote(request.form['img_url'])
+    img_name = parse.unquote(request.form['img_name'])
+    html_file = request.files.get('html_file').read()
+    artifact_token = request.form.get('artifact_token')
+    zip_file_name = f'creative_{str(time.time()).replace(".","")}'
+    with metrics.span('zip'):
+      zip_file_url = await _run(IO_EXECUTOR, creative_service.save_zip,
+                                zip_file_name, html_file, img_url, img_name,
+                                artifact_token, request.url_root,
+                                _is_local(request))
+    print(f'Results generated at {zip_file_url}')
+    body = zip_file_url.encode('utf-8')
+  except Exception as ex:
+    body = _render('error.html',
+                   message=f'Error while creating the zip file:{str(ex)}')
+  return (200, body, 'text/html; charset=utf-8', [])
+
+
+async def clean(request):
+  """Deletes the generated artefacts: zip file and image.
+
+  Returns:
+      (int, bytes, str, list): a redirection to the root page
+  """
+  try:
+    await _run(IO_EXECUTOR, creative_service.clean_files,
+               request.args.get('img_url'),
+               request.args.get('zip_file_url'),
+               request.args.get('artifact_token'), _is_local(request))
+  except Exception as ex:
+    print(ex)
+  return (302, b'', None, [('Location', '/')])
+
+
+ROUTES = {
+    ('POST', '/build_creative'): build_creative,
+    ('POST', '/generate_zip'): generate_zip,
+    ('GET', '/clean'): clean,
+}
+
+
+async def _call_flask(scope, body, send):
+  """Serves the request with the Flask app, streaming its response.
+
+  The whole request runs in a single context, as Flask keeps the request
+  context in it between the chunks of a streamed response.
+  """
+  context = contextvars.copy_context()
+  started = {}
+
+  def start_response(status, headers, exc_info=None):
+    del exc_info
+    started['status'] = int(status.split(' ', 1)[0])
+    started['headers'] = headers
+
+  chunks = await _run(IO_EXECUTOR, main.app, _environ(scope, body),
+                      start_response, context=context)
+  try:
+    iterator = iter(chunks)
+    await send({
+        'type': 'http.response.start',
+        'status': started['status'],
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for (name, value) in started['headers']],
+    })
+    while True:
+      chunk = await _run(IO_EXECUTOR, next, iterator, None, context=context)
+      if chunk is None:
+        break
+      if chunk:
+        await send({
+            'type': 'http.response.body',
+            'body': chunk,
+            'more_body': True
+        })
+    await send({'type': 'http.response.body', 'body': b''})
+  finally:
+    if hasattr(chunks, 'close'):
+      await _run(IO_EXECUTOR, chunks.close, context=context)
+
+
+async def _lifespan(receive, send):
+  global CPU_EXECUTOR, IO_EXECUTOR
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      _start_executors()
+      creative_service.ARTIFACT_REGISTRY.start()
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      for executor in (CPU_EXECUTOR, IO_EXECUTOR):
+        if executor is not None:
+          executor.shutdown(wait=False)
+      (CPU_EXECUTOR, IO_EXECUTOR) = (None, None)
+      await async_http_client.aclose()
+      creative_service.ARTIFACT_REGISTRY.stop()
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+
+def _start_executors():
+  """Creates the thread pools of the process, once."""
+  global CPU_EXECUTOR, IO_EXECUTOR
+  if CPU_EXECUTOR is None:
+    CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS,
+                                      thread_name_prefix='cpu')
+    IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS,
+                                     thread_name_prefix='io')
+
+
+async def app(scope, receive, send):
+  """The ASGI application.
+
+  Args:
+      scope (Dict[str, object]): the ASGI scope
+      receive (Callable): receives the messages of the client
+      send (Callable): sends the messages to the client
+  """
+  if scope['type'] == 'lifespan':
+    await _lifespan(receive, send)
+    return
+  if scope['type'] != 'http':
+    return
+
+  # Servers that skip the lifespan events.
+  _start_executors()
+  creative_service.ARTIFACT_REGISTRY.start()
+  body = await _read_body(receive)
+  if body is None:
+    await _send_response(send, 413, b'Request too large', 'text/plain')
+    return
+
+  handler = ROUTES.get((scope['method'], scope['path']))
+  if handler is None:
+    await _call_flask(scope, body, send)
+    return
+
+  start = time.perf_counter()
+  token = metrics.start_request()
+  try:
+    (status, response_body, content_type, headers) = await handler(
+        Request(_environ(scope, body)))
+  except Exception as ex:
+    print(f'Error serving {scope["path"]}: {ex}')
+    (status, response_body, content_type, headers) = (
+        500, b'Internal Server Error', 'text/plain', [])
+  finally:
+    spans = metrics.end_request(token)
+  total = time.perf_counter() - start
+  metrics.REQUEST_DURATION.observe(total, endpoint=handler.__name__,
+                                   status=status)
+  headers = headers + [('Server-Timing', metrics.server_timing(spans, total))]
+  await _send_response(send, status, response_body, content_type, headers)
@@ -0,0 +1,156 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import time
+import zipfile
+import zlib
+
+# Text members are deflated, images are already compressed and stored as is.
+DEFLATED_EXTENSIONS = ('.html', '.htm', '.css', '.js', '.json', '.svg', '.txt')
+# Local header and central directory entry of a member, names included.
+ZIP_MEMBER_OVERHEAD = 160
+
+BundledMember = collections.namedtuple(
+    'BundledMember', ['name', 'data', 'crc', 'file_size', 'compress_type'])
+
+
+def compress_type_for(name):
+  """Chooses the compression of a member according to its type.
+
+  Args:
+      name (str): name of the member
+
+  Returns:
+      int: zipfile.ZIP_DEFLATED for text files, zipfile.ZIP_STORED otherwise
+  """
+  if os.path.splitext(name)[1].lower() in DEFLATED_EXTENSIONS:
+    return zipfile.ZIP_DEFLATED
+  return zipfile.ZIP_STORED
+
+
+def _compress_member(name, content, compress_type):
+  """Compresses the content of a static file the same way zipfile would.
+
+  Args:
+      name (str): path of the member relative to the creative folder
+      content (bytes): raw content of the file
+      compress_type (int): zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+
+  Returns:
+      BundledMember: the member ready to be copied into an archive
+  """
+  crc = zlib.crc32(content) & 0xffffffff
+  if compress_type == zipfile.ZIP_DEFLATED:
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+    data = compressor.compress(content) + compressor.flush()
+  else:
+    data = content
+
+  return BundledMember(name, data, crc, len(content), compress_type)
+
+
+def write_raw_member(zf, arcname, member, date_time=None):
+  """Copies an already compressed member into an open zip file.
+
+  Args:
+      zf (zipfile.ZipFile): archive opened in write mode
+      arcname (str): name of the member inside the archive
+      member (BundledMember): precompressed member
+      date_time (tuple, optional): modification time of the member. Defaults
+        to now
+  """
+  if date_time is None:
+    date_time = time.localtime(time.time())[:6]
+
+  zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+  zinfo.compress_type = member.compress_type
+  zinfo.external_attr = 0o600 << 16
+  zinfo.CRC = member.crc
+  zinfo.file_size = member.file_size
+  zinfo.compress_size = len(member.data)
+  zinfo.header_offset = zf.fp.tell()
+
+  zf.fp.write(zinfo.FileHeader())
+  zf.fp.write(member.data)
+  zf.filelist.append(zinfo)
+  zf.NameToInfo[zinfo.filename] = zinfo
+  zf.start_dir = zf.fp.tell()
+
+
+class AssetBundle:
+  """Static files of the creative, read once and kept compressed in memory."""
+
+  def __init__(self, members):
+    self.members = members
+
+  @classmethod
+  def load(cls, files):
+    """Reads and compresses the static files from the local drive.
+
+    Args:
+        files ([(str, str)]): pairs of path on disk and path of the member
+          relative to the creative folder
+
+    Returns:
+        AssetBundle: the loaded bundle
+    """
+    members = []
+    for file_path, name in files:
+      with open(file_path, 'rb') as f:
+        members.append(
+            _compress_member(name, f.read(), compress_type_for(name)))
+
+    return cls(members)
+
+  def archive_size(self):
+    """Estimates the bytes the bundle adds to an archive.
+
+    Returns:
+        int: size of the compressed members plus their zip headers
+    """
+    return sum(
+        len(member.data) + ZIP_MEMBER_OVERHEAD for member in self.members)
+
+  def content(self, name):
+    """Returns the raw content of a member.
+
+    Args:
+        name (str): path of the member relative to the creative folder
+
+    Returns:
+        bytes: the uncompressed content or None if there is no such member
+    """
+    for member in self.members:
+      if member.name == name:
+        if member.compress_type == zipfile.ZIP_DEFLATED:
+          return zlib.decompress(member.data, -15)
+        return member.data
+    return None
+
+  def write_to(self, zf, prefix, exclude=()):
+    """Copies the members of the bundle into the archive.
+
+    Args:
+        zf (zipfile.ZipFile): archive opened in write mode
+        prefix (str): folder inside the archive to place the members in
+        exclude (Iterable[str], optional): names of the members to leave out
+    """
+    date_time = time.localtime(time.time())[:6]
+    for member in self.members:
+      if member.name in exclude:
+        continue
+      write_raw_member(zf, f'{prefix}/{member.name}', member, date_time)
@@ -0,0 +1,182 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio version of http_client, for the ASGI app.
+
+It is a thin layer over httpx that behaves like http_client: the same default
+headers, keep-alive pool, redirects, size limits, responses and errors.
+"""
+
+import asyncio
+import os
+import httpx
+from http_client import DEFAULT_HEADERS, HttpError, HttpResponse, ResponseTooLarge
+
+
+class AsyncHttpClient:
+  """HTTP client keeping a pool of keep-alive connections.
+
+  The connections belong to the event loop they were opened in, the httpx
+  client is replaced when it is used from another loop or process.
+  """
+
+  def __init__(self, pool_size=4, timeout=30, max_redirects=5):
+    """Initializes the client.
+
+    Args:
+        pool_size (int, optional): maximum number of idle connections kept.
+          Defaults to 4
+        timeout (float, optional): connect and read timeout in seconds.
+          Defaults to 30
+        max_redirects (int, optional): maximum number of redirects to follow.
+          Defaults to 5
+    """
+    self.pool_size = pool_size
+    self.timeout = timeout
+    self.max_redirects = max_redirects
+    self._client = None
+    self._owner = None
+
+  def _get_client(self):
+    """Returns the httpx client of the running loop, opening it if needed.
+
+    Returns:
+        httpx.AsyncClient: the client
+    """
+    owner = (os.getpid(), asyncio.get_running_loop())
+    if self._owner != owner:
+      # The connections of the previous client can not be used, nor closed,
+      # from this loop.
+      self._client = httpx.AsyncClient(
+          headers=DEFAULT_HEADERS,
+          timeout=self.timeout,
+          follow_redirects=True,
+          max_redirects=self.max_redirects,
+          limits=httpx.Limits(max_keepalive_connections=self.pool_size),
+      )
+      self._owner = owner
+    return self._client
+
+  async def request(self, method, url, body=None, headers=None,
+                    max_bytes=None):
+    """Sends a request and follows the redirects.
+
+    Args:
+        method (str): HTTP method
+        url (str): URL of the request
+        body (bytes, optional): body of the request. Defaults to None
+        headers (Dict[str, str], optional): headers to add to the default
+          ones. Defaults to None
+        max_bytes (int, optional): maximum size of the response body, before
+          and after decompressing it. Defaults to None, no limit
+
+    Returns:
+        HttpResponse: the response with the decoded body
+    """
+    client = self._get_client()
+    try:
+      async with client.stream(method, url, content=body,
+                               headers=headers) as response:
+        length = response.headers.get('Content-Length')
+        if (max_bytes is not None and length and length.isdigit() and
+            int(length) > max_bytes):
+          raise ResponseTooLarge(url, max_bytes)
+
+        data = bytearray()
+        async for chunk in response.aiter_bytes():
+          data += chunk
+          if max_bytes is not None and len(data) > max_bytes:
+            raise ResponseTooLarge(url, max_bytes)
+    except httpx.TooManyRedirects as ex:
+      raise HttpError(url, None, 'Too many redirects', b'') from ex
+
+    data = bytes(data)
+    if response.status_code >= 400:
+      raise HttpError(url, response.status_code, response.reason_phrase, data)
+    return HttpResponse(str(response.url), response.status_code,
+                        response.headers, data)
+
+  async def get(self, url, headers=None, max_bytes=None):
+    """Sends a GET request.
+
+    Args:
+        url (str): URL of the request
+        headers (Dict[str, str], optional): extra headers. Defaults to None
+        max_bytes (int, optional): maximum size of the response body. Defaults
+          to None, no limit
+
+    Returns:
+        HttpResponse: the response
+    """
+    return await self.request('GET', url, headers=headers,
+                              max_bytes=max_bytes)
+
+  async def post(self, url, body, headers=None):
+    """Sends a POST request.
+
+    Args:
+        url (str): URL of the request
+        body (bytes): body of the request
+        headers (Dict[str, str], optional): extra headers. Defaults to None
+
+    Returns:
+        HttpResponse: the response
+    """
+    return await self.request('POST', url, body=body, headers=headers)
+
+  async def aclose(self):
+    """Closes the connections opened by the running loop."""
+    if self._owner == (os.getpid(), asyncio.get_running_loop()):
+      await self._client.aclose()
+    (self._client, self._owner) = (None, None)
+
+
+DEFAULT_CLIENT = AsyncHttpClient(
+    pool_size=int(os.environ.get('HTTP_POOL_SIZE', 4)),
+    timeout=float(os.environ.get('HTTP_TIMEOUT', 30)),
+)
+
+
+async def get(url, headers=None, max_bytes=None):
+  """Sends a GET request with the shared client.
+
+  Args:
+      url (str): URL of the request
+      headers (Dict[str, str], optional): extra headers. Defaults to None
+      max_bytes (int, optional): maximum size of the response body. Defaults
+        to None, no limit
+
+  Returns:
+      HttpResponse: the response
+  """
+  return await DEFAULT_CLIENT.get(url, headers, max_bytes)
+
+
+async def post(url, body, headers=None):
+  """Sends a POST request with the shared client.
+
+  Args:
+      url (str): URL of the request
+      body (bytes): body of the request
+      headers (Dict[str, str], optional): extra headers. Defaults to None
+
+  Returns:
+      HttpResponse: the response
+  """
+  return await DEFAULT_CLIENT.post(url, body, headers)
+
+
+async def aclose():
+  """Closes the connections of the shared client, at the end of the loop."""
+  await DEFAULT_CLIENT.aclose()
@@ -0,0 +1,307 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares generate_html5_parts with the per-fragment generators it replaced.
+
+Checks that both produce byte-identical HTML and reports their timings.
+
+Usage: python benchmarks/html5_parts_benchmark.py
+"""
+
+import contextlib
+import io
+import os
+import random
+import sys
+import timeit
+from markupsafe import Markup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import generate_creative  # pylint: disable=g-import-not-at-top
+
+OBJECT_COUNTS = [1, 5, 20, 60]
+LABELS = ['Shoe', 'Top hat', 'Handbag', 'Dress', 'Luggage & bags']
+
+
+# The generators below are kept verbatim from the previous implementation as
+# the reference output.
+
+
+def _generate_rounded_clip_path(polygon, vertices):
+  """Creates the HTML for the rounded clip path corresponding to a polygon.
+
+  Args:
+      polygon (str): label corresponding to the polygon
+      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+
+  Returns:
+      str: HTML with the clip path
+  """
+
+  width = vertices[1][0] - vertices[0][0]
+  height = vertices[2][1] - vertices[0][1]
+
+  return (f'<clipPath id="{polygon}"><rect x="{vertices[0][0]}"'
+          f' y="{vertices[0][1]}"         rx="10" ry="10" width="{width}"'
+          f' height="{height}"/></clipPath>')
+
+
+def _generate_rounded_cut_layer(polygon, vertices, mode):
+  """Creates the HTML for the cut layer corresponding to a polygon.
+
+  Args:
+      polygon (str): label corresponding to the polygon
+      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+      mode (str): hover | active
+
+  Returns:
+      str: HTML with the cut layer
+  """
+
+  count = 0
+  points = ''
+  prefix = (
+      f'#figura #area-{polygon}:{mode} ~ #capaRecorte {{ -webkit-clip-path:'
+      ' inset(')
+
+  suffix = f'round 10px);clip-path: url(#{polygon});}}'
+
+  for vertex in vertices:
+    if count == 0:
+      point = f'{vertex[1]}px'
+    if count == 1:
+      point = f'{vertex[0]}px'
+    if count == 2:
+      point = f'{vertex[1]}px'
+    if count == 3:
+      point = f'{vertex[0]}px'
+
+    points = f'{points}{point} '
+    count = count + 1
+
+  return f'{prefix}{points}{suffix}'
+
+
+def _generate_rounded_tap_areas(polygon, vertices, mode):
+  """Creates the HTML for the tap areas corresponding to a polygon.
+
+  Args:
+      polygon (str): label corresponding to the polygon
+      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+      mode (str): hover | active
+
+  Returns:
+      str: HTML with the cut layer
+  """
+
+  count = 0
+  points = ''
+  prefix = (f'.taparea-{polygon}:{mode} ~ #capaRecorte {{ -webkit-clip-path:'
+            ' inset(')
+
+  suffix = f'round 10px);clip-path: url(#{polygon});}}'
+
+  for vertex in vertices:
+    if count == 0:
+      point = f'{vertex[1]}px'
+    if count == 1:
+      point = f'{vertex[0]}px'
+    if count == 2:
+      point = f'{vertex[1]}px'
+    if count == 3:
+      point = f'{vertex[0]}px'
+
+    points = f'{points}{point} '
+    count = count + 1
+
+  return f'{prefix}{points}{suffix}'
+
+
+def _generate_exit_metrics(polygon):
+  """Creates the HTML for the exit metrics for each object
+
+  Args:
+      polygon (str): label corresponding to the polygon
+      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+
+  Returns:
+      str: HTML with the svg circles
+  """
+  return f'<gwd-metric-event id="exit-metric-{polygon}" source="gwd-taparea-{polygon} event="tapareaexit" metric="" exit="Exit"></gwd-metric-event>'
+
+
+def _generate_circles(polygon, vertices):
+  """Creates the HTML for the cut svg circles corresponding to a polygon
+
+  Args:
+      polygon (str): label corresponding to the polygon
+      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+
+  Returns:
+      str: HTML with the svg circles
+  """
+
+  outer_circle = (
+      f'<circle id="outer-circle-{polygon}" class="outer-circle"'
+      f' cx="{vertices[1][0] - 10}" cy="{vertices[1][1] + 10}" r="10"'
+      ' stroke="white"  stroke-width="1" fill=none />')
+  inner_circle = (
+      f'<circle id="inner-circle-{polygon}" class="inner-circle"'
+      f' cx="{vertices[1][0] - 10}" cy="{vertices[1][1] + 10}" r="5"'
+      ' stroke="white" stroke-width="1" fill="white" />')
+
+  return f'{outer_circle}{inner_circle}'
+
+
+def _generate_map_area(polygon, vertices):
+  """Creates the HTML for the map area corresponding to a polygon
+
+  Args:
+      polygon (str): label corresponding to the polygon
+      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+
+  Returns:
+      str: HTML with the map area
+  """
+  tap_area_prefix = (
+      f'<gwd-taparea id="gwd-taparea-{polygon}" class="taparea-{polygon}">')
+
+  tap_area_suffix = '</gwd-taparea>'
+
+  map_area_prefix = (
+      f'<area id="area-{polygon}" shape="poly" title="{polygon}" coords="')
+  map_area_suffix = f'" target="_blank">'
+  count = 0
+  points = ''
+
+  for vertex in vertices:
+    point = f'{vertex[0]},{vertex[1]}'
+    if count < vertices.shape[0] - 1:
+      points = f'{points}{point},'
+    else:
+      points = f'{points}{point}'
+    count = count + 1
+
+  return f'{tap_area_prefix}{map_area_prefix}{points}{map_area_suffix}{tap_area_suffix}'
+
+
+def _legacy_generate_html5_parts(polygons):
+  """Builds the HTML5 parts the way main.build_creative used to.
+
+  Args:
+      polygons (Polygons): polygons detected in the image
+
+  Returns:
+      [str]: the fragments as they were inserted in the template
+  """
+  clip_paths = []
+  map_areas = []
+  tap_areas_hover = []
+  tap_areas_active = []
+  exit_metrics = []
+  cut_layers_hover = []
+  cut_layers_active = []
+  object_names = []
+  circles = []
+
+  for (polygon, vertices) in zip(polygons.names,
+                                 polygons.printable_vertices):
+    object_names.append(f'"{str(polygon)}"')
+    clip_paths.append(_generate_rounded_clip_path(polygon, vertices))
+    map_areas.append(_generate_map_area(polygon, vertices))
+    tap_areas_hover.append(
+        _generate_rounded_tap_areas(polygon, vertices, 'hover'))
+    tap_areas_active.append(
+        _generate_rounded_tap_areas(polygon, vertices, 'active'))
+    exit_metrics.append(_generate_exit_metrics(polygon))
+    cut_layers_hover.append(
+        _generate_rounded_cut_layer(polygon, vertices, 'hover'))
+    cut_layers_active.append(
+        _generate_rounded_cut_layer(polygon, vertices, 'active'))
+    circles.append(_generate_circles(polygon, vertices))
+
+  return [
+      Markup('\n'.join(clip_paths)).unescape(),
+      Markup('\n'.join(map_areas)).unescape(),
+      Markup('\n'.join(tap_areas_hover)).unescape(),
+      Markup('\n'.join(tap_areas_active)).unescape(),
+      Markup('\n'.join(exit_metrics)).unescape(),
+      Markup('\n'.join(cut_layers_hover)).unescape(),
+      Markup('\n'.join(cut_layers_active)).unescape(),
+      ','.join(object_names),
+      Markup('\n'.join(circles)).unescape(),
+  ]
+
+
+def _synthetic_polygons(object_count, width=300, height=250):
+  """Builds the polygons for a fake Vision API response.
+
+  Args:
+      object_count (int): number of objects in the response
+      width (int, optional): width of the creative. Defaults to 300
+      height (int, optional): height of the creative. Defaults to 250
+
+  Returns:
+      Polygons: polygons as returned by get_polygons
+  """
+  rng = random.Random(object_count)
+  annotations = []
+  for _ in range(object_count):
+    x0 = rng.random() * 0.8
+    y0 = rng.random() * 0.8
+    x1 = x0 + rng.random() * 0.2
+    y1 = y0 + rng.random() * 0.2
+    annotations.append({
+        'name': rng.choice(LABELS),
+        'score': 0.5 + rng.random() / 2,
+        'boundingPoly': {
+            'normalizedVertices': [{'x': x0, 'y': y0}, {'x': x1, 'y': y0},
+                                   {'x': x1, 'y': y1}, {'x': x0, 'y': y1}]
+        },
+    })
+
+  response = {'responses': [{'localizedObjectAnnotations': annotations}]}
+  with contextlib.redirect_stdout(io.StringIO()):
+    return generate_creative.get_polygons(response, width, height, 0.5)
+
+
+def main():
+  print(f'{"objects":>8} {"legacy us":>10} {"single pass us":>15} {"speedup":>8}')
+  for object_count in OBJECT_COUNTS:
+    polygons = _synthetic_polygons(object_count)
+
+    legacy = _legacy_generate_html5_parts(polygons)
+    current = list(generate_creative.generate_html5_parts(polygons))
+    if [part.encode('utf-8') for part in legacy] != [
+        part.encode('utf-8') for part in current
+    ]:
+      raise AssertionError(f'Output differs for {object_count} objects')
+
+    number = max(1, 2000 // object_count)
+    legacy_us = min(
+        timeit.repeat(lambda: _legacy_generate_html5_parts(polygons),
+                      number=number, repeat=5)) / number * 1e6
+    current_us = min(
+        timeit.repeat(
+            lambda: generate_creative.generate_html5_parts(polygons),
+            number=number, repeat=5)) / number * 1e6
+    print(f'{object_count:>8} {legacy_us:>10.1f} {current_us:>15.1f}'
+          f' {legacy_us / current_us:>7.1f}x')
+
+  print('Output is byte-identical')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,444 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times every stage of the creative pipeline without any network access.
+
+The Vision API responses come from benchmarks/fixtures/vision_responses.json
+and the images are generated at several resolutions. They are served by a
+local HTTP server laid out like static/, and the annotation cache is seeded
+with the recorded responses so no call leaves the machine.
+
+Every case reports its timings, throughput and the peak of the memory
+allocated while it runs, as JSON. A previous run can be given as the baseline
+to compare with.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --output results.json
+    python benchmarks/pipeline_benchmark.py --baseline results.json \\
+        --max-regression 0.2
+"""
+
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import cv2
+import numpy as np
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, ROOT_DIR)
+
+from annotation_cache import AnnotationCache  # pylint: disable=g-import-not-at-top
+import generate_creative  # pylint: disable=g-import-not-at-top
+import image_codec  # pylint: disable=g-import-not-at-top
+
+FIXTURES_FILE = os.path.join(os.path.dirname(__file__), 'fixtures',
+                             'vision_responses.json')
+RESOLUTIONS = [(640, 480), (1920, 1080), (4000, 3000)]
+CREATIVE_SIZE = (300, 250)
+THRESHOLD = 0.5
+PIPELINE_FIXTURE = 'objects_20'
+
+# Only the cases containing this text are run, set from the command line.
+_name_filter = None
+
+
+def _synthetic_image(width, height, seed=0):
+  """Generates a photo-like image, smooth gradients with shapes and noise.
+
+  Args:
+      width (int): width in pixels
+      height (int): height in pixels
+      seed (int, optional): seed of the random generator. Defaults to 0
+
+  Returns:
+      ndarray: BGR image
+  """
+  rng = np.random.default_rng(seed)
+  (y, x) = np.mgrid[0:height, 0:width].astype(np.float32)
+  img = np.dstack((x / width * 200, y / height * 200,
+                   (x + y) / (width + height) * 255))
+  for _ in range(12):
+    (x0, y0) = (rng.integers(0, width), rng.integers(0, height))
+    (x1, y1) = (x0 + width // 6, y0 + height // 6)
+    img[y0:y1, x0:x1] = rng.integers(0, 255, 3)
+  img += rng.normal(0, 6, img.shape)
+  return np.clip(img, 0, 255).astype(np.uint8)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+  """Serves files without logging every request."""
+
+  def log_message(self, *args):
+    pass
+
+
+@contextlib.contextmanager
+def _static_server(root):
+  """Serves a directory over HTTP on a free local port.
+
+  Args:
+      root (str): directory to serve
+
+  Yields:
+      str: base URL of the server
+  """
+  handler = functools.partial(_QuietHandler, directory=root)
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+  finally:
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _quiet(fn):
+  """Wraps a function to drop what it prints."""
+
+  def wrapper():
+    with contextlib.redirect_stdout(io.StringIO()):
+      return fn()
+
+  return wrapper
+
+
+def _measure(name, fn, number, repeat, work=None, work_unit=None):
+  """Times a case and measures the memory it allocates.
+
+  The memory is measured on a separate run since tracing slows the code down.
+
+  Args:
+      name (str): name of the case
+      fn (Callable): code to time, without arguments
+      number (int): calls per timing
+      repeat (int): number of timings
+      work (float, optional): amount of work done by every call, i.e: pixels
+      work_unit (str, optional): unit of the work, i.e: pixels
+
+  Returns:
+      Dict[str, object]: results of the case or None if it is filtered out
+  """
+  if _name_filter and _name_filter not in name:
+    return None
+
+  fn = _quiet(fn)
+  fn()
+  timings = [
+      total / number
+      for total in timeit.repeat(fn, number=number, repeat=repeat)
+  ]
+
+  tracemalloc.start()
+  fn()
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  result = {
+      'name': name,
+      'calls': number * repeat,
+      'min_s': min(timings),
+      'median_s': statistics.median(timings),
+      'mean_s': statistics.mean(timings),
+      'calls_per_s': 1 / min(timings),
+      'peak_alloc_bytes': peak,
+  }
+  if work:
+    result[f'{work_unit}_per_s'] = work / min(timings)
+  return result
+
+
+def _parsing_cases(fixtures, scale):
+  """Times the conversion of the Vision responses into HTML fragments."""
+  results = []
+  for (fixture_name, response) in fixtures.items():
+    annotations = response['responses'][0]['localizedObjectAnnotations']
+    count = len(annotations)
+    number = max(1, 2000 // count // scale)
+
+    results.append(
+        _measure(
+            f'vertices_to_np_array/{fixture_name}',
+            lambda annotations=annotations: [
+                generate_creative._vertices_to_np_array(
+                    annotation['boundingPoly']['normalizedVertices'])
+                for annotation in annotations
+            ],
+            number, 5, count, 'objects'))
+
+    results.append(
+        _measure(
+            f'get_polygons/{fixture_name}',
+            lambda response=response: generate_creative.get_polygons(
+                response, *CREATIVE_SIZE, THRESHOLD),
+            number, 5, count, 'objects'))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      polygons = generate_creative.get_polygons(response, *CREATIVE_SIZE,
+                                                 THRESHOLD)
+    results.append(
+        _measure(
+            f'generate_html5_parts/{fixture_name}',
+            lambda polygons=polygons: generate_creative.generate_html5_parts(
+                polygons),
+            number, 5, count, 'objects'))
+  return results
+
+
+def _image_cases(images, scale):
+  """Times the decode, resize and encode of the images on their own."""
+  results = []
+  for ((width, height), content) in images.items():
+    pixels = width * height
+    number = max(1, 20_000_000 // pixels // scale)
+    size = f'{width}x{height}'
+
+    results.append(
+        _measure(f'decode/{size}',
+                 lambda content=content: image_codec.decode_image(content),
+                 number, 3, pixels, 'pixels'))
+    results.append(
+        _measure(
+            f'decode_reduced/{size}',
+            lambda content=content: image_codec.decode_image(
+                content, min_width=CREATIVE_SIZE[0]),
+            number, 3, pixels, 'pixels'))
+
+    img = image_codec.decode_image(content)
+    results.append(
+        _measure(
+            f'image_resize/{size}',
+            lambda img=img: generate_creative.image_resize(
+                img, width=CREATIVE_SIZE[0]),
+            number, 3, pixels, 'pixels'))
+
+  with contextlib.redirect_stdout(io.StringIO()):
+    creative = generate_creative.image_resize(
+        image_codec.decode_image(images[RESOLUTIONS[0]]),
+        width=CREATIVE_SIZE[0])
+  for image_format in image_codec.FORMATS:
+    results.append(
+        _measure(
+            f'encode/{image_format}',
+            lambda image_format=image_format: image_codec.encode_image(
+                creative, image_format),
+            max(1, 50 // scale), 3))
+    results.append(
+        _measure(
+            f'encode_within_budget/{image_format}',
+            lambda image_format=image_format: image_codec.
+            encode_within_budget(creative, image_format, 20 * 1024),
+            max(1, 10 // scale), 3))
+  return results
+
+
+def _pipeline_cases(images, response, base_url, output_dir, scale):
+  """Times detect_objects end to end and the zip of the creative."""
+  annotation_cache = AnnotationCache(max_entries=len(images))
+  results = []
+  for ((width, height), content) in images.items():
+    img_url = f'{base_url}/static/images/source_{width}x{height}.jpg'
+    annotation_cache.put(annotation_cache.make_key(img_url, content),
+                         response)
+    number = max(1, 10_000_000 // (width * height) // scale)
+
+    results.append(
+        _measure(
+            f'detect_objects/{width}x{height}/{PIPELINE_FIXTURE}',
+            lambda img_url=img_url: generate_creative.detect_objects(
+                img_url,
+                output_dir,
+                THRESHOLD,
+                *CREATIVE_SIZE,
+                True,
+                None,
+                annotation_cache=annotation_cache,
+            ),
+            number, 3, width * height, 'pixels'))
+  return results
+
+
+def _zip_cases(images, response, base_url, images_dir, scale):
+  """Times create_zip with the image in the artifact store and without it."""
+  # creative_service loads the static files relative to the working directory.
+  os.chdir(ROOT_DIR)
+  with contextlib.redirect_stdout(io.StringIO()):
+    import creative_service  # pylint: disable=g-import-not-at-top
+
+    polygons = generate_creative.get_polygons(response, *CREATIVE_SIZE,
+                                               THRESHOLD)
+    html_file = ''.join(
+        generate_creative.generate_html5_parts(polygons)).encode('utf-8')
+    img = generate_creative.image_resize(
+        image_codec.decode_image(images[RESOLUTIONS[-1]]),
+        width=CREATIVE_SIZE[0])
+  img_name = 'creative.jpg'
+  encoded_img = image_codec.encode_image(img, 'jpeg')
+  with open(os.path.join(images_dir, img_name), 'wb') as f:
+    f.write(encoded_img)
+  img_url = f'{base_url}/static/images/{img_name}'
+  artifact_token = creative_service.ARTIFACT_STORE.put(encoded_img)
+
+  def create_zip(token):
+    output = io.BytesIO()
+    creative_service.create_zip(output, 'creative', html_file, img_url,
+                                img_name, token)
+    return output
+
+  zip_size = len(create_zip(artifact_token).getvalue())
+  number = max(1, 200 // scale)
+  results = [
+      _measure('create_zip/artifact_store',
+               lambda: create_zip(artifact_token), number, 3, zip_size,
+               'bytes'),
+      _measure('create_zip/download', lambda: create_zip(None), number, 3,
+               zip_size, 'bytes'),
+  ]
+  creative_service.ARTIFACT_STORE.discard(artifact_token)
+  return results
+
+
+def run(quick=False, name_filter=None):
+  """Runs all the benchmarks.
+
+  Args:
+      quick (bool, optional): runs fewer calls per case. Defaults to False
+      name_filter (str, optional): only runs the cases containing this text
+
+  Returns:
+      Dict[str, object]: the environment and the results of every case
+  """
+  global _name_filter
+  _name_filter = name_filter
+  scale = 10 if quick else 1
+  with open(FIXTURES_FILE) as f:
+    fixtures = json.load(f)
+
+  images = {}
+  for (width, height) in RESOLUTIONS:
+    images[(width, height)] = bytearray(
+        image_codec.encode_image(_synthetic_image(width, height), 'jpeg', 90))
+
+  results = []
+  results.extend(_parsing_cases(fixtures, scale))
+  results.extend(_image_cases(images, scale))
+
+  with tempfile.TemporaryDirectory() as root:
+    images_dir = os.path.join(root, 'static', 'images')
+    output_dir = os.path.join(root, 'output')
+    os.makedirs(images_dir)
+    os.makedirs(output_dir)
+    for ((width, height), content) in images.items():
+      with open(os.path.join(images_dir, f'source_{width}x{height}.jpg'),
+                'wb') as f:
+        f.write(content)
+
+    with _static_server(root) as base_url:
+      results.extend(
+          _pipeline_cases(images, fixtures[PIPELINE_FIXTURE], base_url,
+                          output_dir, scale))
+      results.extend(
+          _zip_cases(images, fixtures[PIPELINE_FIXTURE], base_url,
+                     images_dir, scale))
+
+  return {
+      'environment': {
+          'python': platform.python_version(),
+          'numpy': np.__version__,
+          'opencv': cv2.__version__,
+          'machine': platform.machine(),
+          'processor': platform.processor(),
+          'cpu_count': os.cpu_count(),
+          'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+          'quick': quick,
+      },
+      'results': [result for result in results if result is not None],
+  }
+
+
+def compare(current, baseline, max_regression=None):
+  """Prints the change of every case against a previous run.
+
+  Args:
+      current (Dict[str, object]): results of this run
+      baseline (Dict[str, object]): results of the previous run
+      max_regression (float, optional): allowed slowdown, i.e: 0.2 for 20%
+
+  Returns:
+      [str]: names of the cases slower than allowed
+  """
+  previous = {result['name']: result for result in baseline['results']}
+  regressions = []
+  print(f'{"case":<48} {"baseline ms":>12} {"current ms":>11} {"ratio":>7}'
+        f' {"peak KB":>10}', file=sys.stderr)
+  for result in current['results']:
+    before = previous.get(result['name'])
+    if before is None:
+      continue
+    ratio = result['min_s'] / before['min_s']
+    flag = ''
+    if max_regression is not None and ratio > 1 + max_regression:
+      regressions.append(result['name'])
+      flag = ' slower'
+    print(f'{result["name"]:<48} {before["min_s"] * 1000:>12.3f}'
+          f' {result["min_s"] * 1000:>11.3f} {ratio:>6.2f}x'
+          f' {result["peak_alloc_bytes"] / 1024:>10.1f}{flag}',
+          file=sys.stderr)
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--output', help='file to write the JSON results to')
+  parser.add_argument('--baseline', help='JSON results of a previous run')
+  parser.add_argument(
+      '--max-regression', type=float,
+      help='fails when a case is slower than the baseline by this fraction')
+  parser.add_argument('--quick', action='store_true',
+                      help='runs fewer calls per case')
+  parser.add_argument('--filter', help='only runs the cases containing this')
+  args = parser.parse_args()
+
+  current = run(args.quick, args.filter)
+  report = json.dumps(current, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(report)
+  else:
+    print(report)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(current, json.load(f), args.max_regression)
+    if regressions:
+      print(f'{len(regressions)} cases are slower than the baseline',
+            file=sys.stderr)
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,236 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiles the start up of an instance, from the imports to the first request.
+
+Every run is a fresh interpreter, like a new instance. The imports of the app
+are broken down with python -X importtime, by module imported from main and by
+package. The first request is then timed with and without the warmup request
+before it, which also reports the time of its steps.
+
+Usage:
+    python benchmarks/startup_benchmark.py --output startup.json
+    python benchmarks/startup_benchmark.py --module asgi_app --top 30
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+# Namespace packages, their subpackages are reported on their own.
+NAMESPACE_PACKAGES = ('google',)
+
+# Run in a fresh interpreter, prints the timings as JSON on the last line.
+_FIRST_REQUEST_SCRIPT = """
+import json
+import sys
+import time
+start = time.perf_counter()
+import main
+timings = {'import_s': time.perf_counter() - start}
+client = main.app.test_client()
+if sys.argv[1] == 'warm':
+  start = time.perf_counter()
+  response = client.get('/_ah/warmup', base_url='http://localhost:8080')
+  timings['warmup_s'] = time.perf_counter() - start
+  timings['warmup_server_timing'] = response.headers.get('Server-Timing')
+start = time.perf_counter()
+client.get('/', base_url='http://localhost:8080')
+timings['first_request_s'] = time.perf_counter() - start
+print(json.dumps(timings))
+"""
+
+
+def _run_python(args):
+  """Runs the interpreter in the root of the app.
+
+  Args:
+      args ([str]): arguments of the interpreter
+
+  Returns:
+      subprocess.CompletedProcess: the finished process, with its output
+  """
+  env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+  return subprocess.run([sys.executable] + args, cwd=ROOT_DIR, env=env,
+                        capture_output=True, text=True, check=True)
+
+
+def import_profile(module):
+  """Imports a module in a fresh interpreter with -X importtime.
+
+  Args:
+      module (str): module to import, i.e: main
+
+  Returns:
+      [Dict[str, object]]: every module imported, in the order they finished,
+      with its nesting depth and its own and cumulative import time in seconds
+  """
+  stderr = _run_python(['-X', 'importtime', '-c', f'import {module}']).stderr
+  imports = []
+  for line in stderr.splitlines():
+    if not line.startswith('import time:') or '|' not in line:
+      continue
+    (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+    if not self_us.strip().isdigit():
+      # The header line.
+      continue
+    # A space, then two more for every level of nesting.
+    depth = (len(name) - len(name.lstrip()) - 1) // 2
+    imports.append({
+        'module': name.strip(),
+        'depth': depth,
+        'self_s': int(self_us) / 1e6,
+        'cumulative_s': int(cumulative_us) / 1e6,
+    })
+  return imports
+
+
+def _package_of(module):
+  parts = module.split('.')
+  if parts[0] in NAMESPACE_PACKAGES and len(parts) > 1:
+    return '.'.join(parts[:2])
+  return parts[0]
+
+
+def summarize_imports(imports, module, top):
+  """Breaks down the import time of a module.
+
+  Args:
+      imports ([Dict[str, object]]): result of import_profile
+      module (str): the module imported
+      top (int): number of entries kept in every breakdown
+
+  Returns:
+      Dict[str, object]: total time, the slowest imports made by the module
+      itself and the packages taking the most time
+  """
+  root = next(entry for entry in imports
+              if entry['module'] == module and entry['depth'] == 0)
+  direct = [entry for entry in imports if entry['depth'] == 1]
+  packages = {}
+  for entry in imports:
+    package = _package_of(entry['module'])
+    packages[package] = packages.get(package, 0.0) + entry['self_s']
+
+  return {
+      'total_s': root['cumulative_s'],
+      'own_s': root['self_s'],
+      'modules': len(imports),
+      'direct_imports': [{
+          'module': entry['module'],
+          'cumulative_s': entry['cumulative_s'],
+      } for entry in sorted(direct, key=lambda entry: -entry['cumulative_s'])
+                         [:top]],
+      'packages': [{
+          'package': package,
+          'self_s': seconds,
+      } for (package, seconds) in sorted(packages.items(),
+                                         key=lambda item: -item[1])[:top]],
+  }
+
+
+def first_request(mode):
+  """Times the import of the app and its first request in a fresh interpreter.
+
+  Args:
+      mode (str): cold to send the request right away or warm to send the
+        warmup request before it
+
+  Returns:
+      Dict[str, object]: the timings in seconds
+  """
+  stdout = _run_python(['-c', _FIRST_REQUEST_SCRIPT, mode]).stdout
+  return json.loads(stdout.strip().splitlines()[-1])
+
+
+def run(module, runs, top):
+  """Profiles the start up.
+
+  Args:
+      module (str): module to profile the imports of
+      runs (int): number of fresh interpreters per measure
+      top (int): number of entries kept in every breakdown
+
+  Returns:
+      Dict[str, object]: the results
+  """
+  profiles = [import_profile(module) for _ in range(runs)]
+  summaries = [summarize_imports(imports, module, top) for imports in profiles]
+  # The breakdown of the fastest run, the least disturbed by the machine.
+  fastest = min(summaries, key=lambda summary: summary['total_s'])
+  totals = [summary['total_s'] for summary in summaries]
+  results = {
+      'python': sys.version.split()[0],
+      'module': module,
+      'import': dict(
+          fastest, min_s=min(totals), median_s=statistics.median(totals)),
+  }
+
+  if module == 'main':
+    for mode in ('cold', 'warm'):
+      timings = [first_request(mode) for _ in range(runs)]
+      results[f'first_request_{mode}'] = {
+          name: statistics.median(timing[name] for timing in timings)
+          for name in timings[0] if name.endswith('_s')
+      }
+      if mode == 'warm':
+        results['first_request_warm']['warmup_server_timing'] = (
+            timings[-1]['warmup_server_timing'])
+  return results
+
+
+def _print_summary(results):
+  summary = results['import']
+  print(f'import {results["module"]}: {summary["min_s"] * 1000:.1f} ms'
+        f' (median {summary["median_s"] * 1000:.1f} ms,'
+        f' {summary["modules"]} modules)', file=sys.stderr)
+  for entry in summary['direct_imports']:
+    print(f'  {entry["module"]:<40} {entry["cumulative_s"] * 1000:>9.1f} ms',
+          file=sys.stderr)
+  for mode in ('cold', 'warm'):
+    timings = results.get(f'first_request_{mode}')
+    if timings:
+      print(f'first request, {mode}: ' + ', '.join(
+          f'{name[:-2]} {value * 1000:.1f} ms'
+          for (name, value) in timings.items() if name.endswith('_s')),
+            file=sys.stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--output', help='file to write the JSON results to')
+  parser.add_argument('--module', default='main',
+                      help='module to profile the imports of')
+  parser.add_argument('--runs', type=int, default=5,
+                      help='fresh interpreters per measure')
+  parser.add_argument('--top', type=int, default=15,
+                      help='entries kept in every breakdown')
+  args = parser.parse_args()
+
+  results = run(args.module, args.runs, args.top)
+  _print_summary(results)
+  report = json.dumps(results, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(report)
+  else:
+    print(report)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,542 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builds the creatives of a product feed from the command line.
+
+Every row of the feed, CSV or JSON Lines, has the URL of an image, the landing
+URL the creative leads to and the creative sizes, i.e:
+
+    id,img_url,landing_url,sizes
+    sku-1,https://example.com/shoe.jpg,https://example.com/shoe,300x250 728x90
+
+The objects are detected once per image and every size is cropped around them,
+rendered with the build_creative template, with every object and the whole
+creative leading to the landing URL, and packed in its own zip. The web app is
+not involved, only the configuration of creative_service: detector, annotation
+cache, image format and budgets.
+
+Downloads, object detection and packing run on a thread pool, decoding,
+resizing and encoding the images on a process pool, in a single call per row
+that only sends the content of the image and gets the encoded images back. Every finished row is
+appended to a manifest in the output directory, running the same feed again
+skips the rows already built, so a run that crashed continues where it stopped.
+
+Usage:
+    python bulk_generate.py feed.csv --output-dir creatives
+    python bulk_generate.py feed.jsonl --io-workers 16 --cpu-workers 4
+"""
+
+import argparse
+import collections
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import contextlib
+import csv
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from urllib import parse
+import generate_creative
+import image_codec
+import jinja2
+from lazy_import import lazy_import
+import static_assets
+
+cv2 = lazy_import('cv2')
+
+MANIFEST_FILE = 'manifest.jsonl'
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'templates')
+DEFAULT_SIZES = '300x250'
+DEFAULT_THRESHOLD = 0.85
+# Rows queued per I/O worker, the feed is not all held in flight at once.
+PENDING_PER_WORKER = 2
+CSV_EXTENSIONS = ('.csv',)
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson', '.json')
+
+_SIZE = re.compile(r'(\d+)\s*x\s*(\d+)', re.IGNORECASE)
+_UNSAFE_NAME_CHARACTERS = re.compile(r'[^\w.-]')
+_AREA_TITLE = re.compile(r'(<area\b[^>]*?)\s+title="[^"]*"')
+
+FeedItem = collections.namedtuple(
+    'FeedItem', ['id', 'img_url', 'landing_url', 'sizes', 'threshold'])
+FeedItem.__doc__ = """A row of the feed.
+
+  id (str): id of the row, from the feed or derived from its values
+  img_url (str): URL of the image
+  landing_url (str): URL the creative leads to
+  sizes ([(int, int)]): creative sizes as width, height in pixels
+  threshold (float): confidence level for object detection
+"""
+
+
+def _parse_sizes(value):
+  """Reads creative sizes, i.e: '300x250 728x90' or ['300x250', '728x90'].
+
+  Returns:
+      [(int, int)]: the sizes as width, height in pixels
+  """
+  if isinstance(value, (list, tuple)):
+    value = ' '.join(str(size) for size in value)
+  return [(int(width), int(height))
+          for (width, height) in _SIZE.findall(value or '')]
+
+
+def _read_rows(path):
+  """Reads the rows of a CSV or JSON Lines file as dictionaries."""
+  extension = os.path.splitext(path)[1].lower()
+  with open(path, newline='', encoding='utf-8') as f:
+    if extension in CSV_EXTENSIONS:
+      yield from csv.DictReader(f)
+    elif extension in JSONL_EXTENSIONS:
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+    else:
+      raise Exception(f'Unsupported feed {path}, use one of'
+                      f' {CSV_EXTENSIONS + JSONL_EXTENSIONS}')
+
+
+def read_feed(path, default_sizes=DEFAULT_SIZES,
+              default_threshold=DEFAULT_THRESHOLD):
+  """Reads and checks every row of a feed before anything is built.
+
+  Args:
+      path (str): CSV or JSON Lines file
+      default_sizes (str, optional): sizes of the rows without any. Defaults
+        to DEFAULT_SIZES
+      default_threshold (float, optional): threshold of the rows without one.
+        Defaults to DEFAULT_THRESHOLD
+
+  Returns:
+      [FeedItem]: the rows
+  """
+  items = []
+  ids = set()
+  for (number, row) in enumerate(_read_rows(path), start=1):
+    img_url = (row.get('img_url') or '').strip()
+    landing_url = (row.get('landing_url') or '').strip()
+    if not img_url or not landing_url:
+      raise Exception(f'Row {number} of {path} needs an img_url and a'
+                      ' landing_url')
+    sizes = _parse_sizes(row.get('sizes') or default_sizes)
+    if not sizes:
+      raise Exception(f'Row {number} of {path} has no valid size')
+    threshold = float(row.get('threshold') or default_threshold)
+
+    item_id = str(row.get('id') or '').strip()
+    if not item_id:
+      # Stable across runs, so the manifest still matches the row.
+      item_id = hashlib.sha1(
+          json.dumps([img_url, landing_url, sizes, threshold]).encode(
+              'utf-8')).hexdigest()[:16]
+    if item_id in ids:
+      raise Exception(f'Row {number} of {path} repeats the id {item_id}')
+    ids.add(item_id)
+    items.append(FeedItem(item_id, img_url, landing_url, sizes, threshold))
+  return items
+
+
+class Manifest:
+  """Append only record of the rows of a feed already processed.
+
+  One JSON object per line, written and synced as every row finishes, so a run
+  that stops at any point loses at most the rows in flight.
+  """
+
+  def __init__(self, path):
+    """Loads the rows recorded by the previous runs.
+
+    Args:
+        path (str): path of the JSON Lines file
+    """
+    self.path = path
+    self.entries = {}
+    self._lock = threading.Lock()
+    if os.path.exists(path):
+      with open(path, encoding='utf-8') as f:
+        lines = f.read().split('\n')
+      for line in lines:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          # The last line of a run that crashed while writing it.
+          continue
+        self.entries[entry['id']] = entry
+      if lines[-1]:
+        # Ends that line, the next entry goes on its own.
+        with open(path, 'a', encoding='utf-8') as f:
+          f.write('\n')
+
+  def is_done(self, item_id, output_dir):
+    """Checks if a row was built and its zips are still there.
+
+    Args:
+        item_id (str): id of the row
+        output_dir (str): directory of the zips
+
+    Returns:
+        bool: True if the row can be skipped
+    """
+    entry = self.entries.get(item_id)
+    return bool(entry and entry['status'] == 'done' and all(
+        os.path.exists(os.path.join(output_dir, name))
+        for name in entry['zips']))
+
+  def record(self, entry):
+    """Appends the outcome of a row.
+
+    Args:
+        entry (Dict[str, object]): JSON object with the id and status of the
+          row
+    """
+    line = json.dumps(entry) + '\n'
+    with self._lock:
+      with open(self.path, 'a', encoding='utf-8') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+      self.entries[entry['id']] = entry
+
+
+class Throughput:
+  """Counts the rows and creatives built and the time spent in every stage.
+
+  The stages overlap across the workers, their busy time tells which pool to
+  grow.
+  """
+
+  def __init__(self, total):
+    self.total = total
+    self.done = 0
+    self.failed = 0
+    self.skipped = 0
+    self.creatives = 0
+    self.bytes_written = 0
+    self.stages = collections.defaultdict(float)
+    self._start = time.perf_counter()
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """Times a stage of a row.
+
+    Args:
+        name (str): name of the stage, i.e: download
+    """
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      with self._lock:
+        self.stages[name] += time.perf_counter() - start
+
+  def add(self, done=0, failed=0, skipped=0, creatives=0, bytes_written=0):
+    with self._lock:
+      self.done += done
+      self.failed += failed
+      self.skipped += skipped
+      self.creatives += creatives
+      self.bytes_written += bytes_written
+
+  def summary(self):
+    """Describes the progress of the run.
+
+    Returns:
+        Dict[str, object]: counts, rates and busy seconds of every stage
+    """
+    with self._lock:
+      elapsed = time.perf_counter() - self._start
+      built = self.done + self.failed
+      return {
+          'rows': self.total,
+          'done': self.done,
+          'failed': self.failed,
+          'skipped': self.skipped,
+          'creatives': self.creatives,
+          'megabytes': self.bytes_written / 1024 / 1024,
+          'elapsed_s': elapsed,
+          'rows_per_s': built / elapsed if elapsed else 0.0,
+          'creatives_per_s': self.creatives / elapsed if elapsed else 0.0,
+          'stage_busy_s': dict(self.stages),
+      }
+
+  def report(self):
+    summary = self.summary()
+    processed = summary['done'] + summary['failed'] + summary['skipped']
+    print(f'{processed}/{summary["rows"]} rows, {summary["creatives"]}'
+          f' creatives, {summary["rows_per_s"]:.2f} rows/s,'
+          f' {summary["creatives_per_s"]:.2f} creatives/s,'
+          f' {summary["megabytes"]:.1f} MB, {summary["failed"]} failed')
+
+
+def _template_environment(asset_manifest):
+  """Loads the templates of the web app without the Flask app.
+
+  Args:
+      asset_manifest (Dict[str, str]): fingerprinted names of the static files
+
+  Returns:
+      jinja2.Environment: the environment, with the globals the templates use
+  """
+  environment = jinja2.Environment(
+      loader=jinja2.FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+  environment.globals['asset_url'] = functools.partial(
+      static_assets.asset_url, asset_manifest)
+  return environment
+
+
+def _init_worker():
+  # One OpenCV thread per process, the pool already uses every core.
+  cv2.setNumThreads(1)
+
+
+class BulkGenerator:
+  """Builds the creatives of the rows of a feed concurrently."""
+
+  def __init__(self, output_dir, io_workers=8, cpu_workers=None,
+               report_seconds=10):
+    """Initializes the generator.
+
+    Args:
+        output_dir (str): directory of the zips and the manifest
+        io_workers (int, optional): rows built at the same time, they wait on
+          the network and on the CPU workers. Defaults to 8
+        cpu_workers (int, optional): processes decoding, resizing and
+          encoding the images, 0 to do it in the I/O workers. Defaults to
+          None, one per CPU
+        report_seconds (int, optional): time between progress reports.
+          Defaults to 10
+    """
+    # Imported here, the worker processes import this module and only need
+    # the image functions.
+    import creative_service  # pylint: disable=g-import-not-at-top
+
+    self.output_dir = output_dir
+    self.io_workers = io_workers
+    self.cpu_workers = os.cpu_count() if cpu_workers is None else cpu_workers
+    self.report_seconds = report_seconds
+    self._service = creative_service
+    self._template = _template_environment(
+        creative_service.ASSET_MANIFEST).get_template('/build_creative.html')
+    self._cpu_pool = None
+    self._throughput = None
+    os.makedirs(output_dir, exist_ok=True)
+
+  def _run_cpu(self, fn, *args):
+    if self._cpu_pool is None:
+      return fn(*args)
+    return self._cpu_pool.submit(fn, *args).result()
+
+  def _render_html(self, img_name, width, height, polygons, landing_url):
+    """Renders the exported HTML of a creative, like saveToZip in the browser.
+
+    Returns:
+        bytes: the HTML
+    """
+    html5_parts = generate_creative.generate_html5_parts(polygons)
+    exits = [('default', landing_url)]
+    exits.extend((name, landing_url) for name in polygons.names)
+    html = self._template.render(
+        export=True,
+        img_url=f'images/{img_name}',
+        img_name=img_name,
+        width=width,
+        height=height,
+        artifact_token='',
+        **html5_parts._asdict(),
+        **generate_creative.generate_exit_scripts(exits)._asdict(),
+    )
+    html = _AREA_TITLE.sub(r'\1', html)
+    html = html.replace('static/images/transparent.gif',
+                        'images/transparent.gif').replace('static/', '')
+    return html.encode('utf-8')
+
+  def _write_zip(self, zip_file_name, html_file, img_name, img_file):
+    """Writes a creative zip, complete or not at all.
+
+    Returns:
+        int: size of the zip in bytes
+    """
+    path = os.path.join(self.output_dir, f'{zip_file_name}.zip')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+      self._service.write_zip(f, zip_file_name, html_file, img_name, img_file)
+      size = f.tell()
+    os.replace(tmp_path, path)
+    return size
+
+  def build(self, item):
+    """Builds the creatives of a row.
+
+    Args:
+        item (FeedItem): the row
+
+    Returns:
+        Dict[str, object]: manifest entry of the row
+    """
+    start = time.perf_counter()
+    service = self._service
+    throughput = self._throughput
+    img_name = (os.path.basename(parse.urlsplit(item.img_url).path) or
+                'image')
+
+    with throughput.stage('download'):
+      img_content = generate_creative.download_image(item.img_url)
+    with throughput.stage('detect'):
+      img = None
+      if service.DETECTOR.min_side:
+        # Only a detector that reads the pixels needs them, at its own size.
+        img = image_codec.decode_image(img_content,
+                                       min_side=service.DETECTOR.min_side)
+      objects = generate_creative.get_objects(item.img_url, img_content, img,
+                                              service.DETECTOR,
+                                              service.ANNOTATION_CACHE)
+      del img
+    with throughput.stage('decode_resize_encode'):
+      renders = self._run_cpu(generate_creative.decode_and_render_sizes,
+                              img_content, objects, item.threshold,
+                              item.sizes, img_name,
+                              service.OUTPUT_IMAGE_FORMAT,
+                              service.MAX_IMAGE_BYTES)
+
+    zips = []
+    bytes_written = 0
+    for (size_img_name, width, height, polygons, encoded_img) in renders:
+      with throughput.stage('package'):
+        html_file = self._render_html(size_img_name, width, height, polygons,
+                                      item.landing_url)
+        zip_file_name = _UNSAFE_NAME_CHARACTERS.sub(
+            '_', f'{item.id}_{width}x{height}')
+        bytes_written += self._write_zip(zip_file_name, html_file,
+                                         size_img_name, encoded_img)
+      zips.append(f'{zip_file_name}.zip')
+
+    throughput.add(done=1, creatives=len(zips), bytes_written=bytes_written)
+    return {
+        'id': item.id,
+        'status': 'done',
+        'img_url': item.img_url,
+        'zips': zips,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+  def _build_or_fail(self, item):
+    try:
+      return self.build(item)
+    except Exception as ex:
+      print(f'Error building {item.id} from {item.img_url}: {ex}')
+      self._throughput.add(failed=1)
+      return {
+          'id': item.id,
+          'status': 'failed',
+          'img_url': item.img_url,
+          'error': str(ex),
+      }
+
+  def _report_until(self, stop):
+    while not stop.wait(self.report_seconds):
+      self._throughput.report()
+
+  def run(self, items, manifest):
+    """Builds the rows not in the manifest yet.
+
+    Args:
+        items ([FeedItem]): rows of the feed
+        manifest (Manifest): record of the rows already built, updated as
+          every row finishes
+
+    Returns:
+        Dict[str, object]: summary of the run, see Throughput.summary
+    """
+    self._throughput = Throughput(len(items))
+    pending_items = []
+    for item in items:
+      if manifest.is_done(item.id, self.output_dir):
+        self._throughput.add(skipped=1)
+      else:
+        pending_items.append(item)
+    print(f'Building {len(pending_items)} rows,'
+          f' {len(items) - len(pending_items)} already done')
+
+    stop = threading.Event()
+    reporter = threading.Thread(target=self._report_until, args=(stop,),
+                                daemon=True)
+    reporter.start()
+    if self.cpu_workers:
+      # Spawned, forking would copy the locks of the threads of the web app.
+      self._cpu_pool = ProcessPoolExecutor(
+          max_workers=self.cpu_workers,
+          mp_context=multiprocessing.get_context('spawn'),
+          initializer=_init_worker)
+    try:
+      with ThreadPoolExecutor(max_workers=self.io_workers) as io_pool:
+        in_flight = set()
+        for item in pending_items:
+          if len(in_flight) >= self.io_workers * PENDING_PER_WORKER:
+            (finished, in_flight) = wait(in_flight,
+                                         return_when=FIRST_COMPLETED)
+            for future in finished:
+              manifest.record(future.result())
+          in_flight.add(io_pool.submit(self._build_or_fail, item))
+        for future in wait(in_flight).done:
+          manifest.record(future.result())
+    finally:
+      stop.set()
+      if self._cpu_pool is not None:
+        self._cpu_pool.shutdown()
+        self._cpu_pool = None
+
+    self._throughput.report()
+    return self._throughput.summary()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('feed', help='CSV or JSON Lines file with the rows')
+  parser.add_argument('--output-dir', default='creatives',
+                      help='directory of the zips and the manifest')
+  parser.add_argument('--manifest',
+                      help=f'manifest file, defaults to {MANIFEST_FILE} in'
+                      ' the output directory')
+  parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                      help='sizes of the rows without any, i.e: 300x250,728x90')
+  parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                      help='threshold of the rows without one')
+  parser.add_argument('--io-workers', type=int, default=8,
+                      help='rows built at the same time')
+  parser.add_argument('--cpu-workers', type=int,
+                      help='processes for the images, defaults to one per CPU')
+  parser.add_argument('--report-seconds', type=int, default=10,
+                      help='time between progress reports')
+  args = parser.parse_args()
+
+  items = read_feed(args.feed, args.sizes, args.threshold)
+  generator = BulkGenerator(args.output_dir, args.io_workers,
+                            args.cpu_workers, args.report_seconds)
+  manifest = Manifest(args.manifest or
+                      os.path.join(args.output_dir, MANIFEST_FILE))
+  summary = generator.run(items, manifest)
+  print(json.dumps(summary, indent=2))
+  if summary['failed']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
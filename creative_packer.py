@@ -0,0 +1,399 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+HOSTED_ENABLER_URL = 'https://s0.2mdn.net/ads/studio/Enabler.js'
+ENABLER_MEMBER = 'js/Enabler.js'
+# At-rules holding rules instead of declarations.
+NESTED_AT_RULES = ('@media', '@supports', '@document', '@layer', '@keyframes',
+                   '@-webkit-keyframes')
+
+_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+_SPACES = re.compile(r'\s+')
+_SELECTOR_SPACES = re.compile(r'\s*([,>~+])\s*')
+_PROTECTED_BLOCK = re.compile(
+    r'(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2\s*>)',
+    re.DOTALL | re.IGNORECASE)
+# Parts of a selector with their weight in the specificity.
+_SELECTOR_PARTS = re.compile(
+    r'(?P<attribute>\[[^\]]*\])|(?P<pseudo>::?[\w-]+(?:\([^)]*\))?)'
+    r'|(?P<id>#[\w-]+)|(?P<class>\.[\w-]+)|(?P<type>[a-zA-Z][\w-]*)')
+# Pseudo-classes whose specificity depends on their arguments.
+_SELECTOR_LIST_PSEUDO_CLASSES = (':not(', ':is(', ':where(', ':has(',
+                                 ':matches(')
+# Pseudo-elements that can be written with a single colon.
+_LEGACY_PSEUDO_ELEMENTS = (':before', ':after', ':first-line', ':first-letter')
+_HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+_TAG = re.compile(r'<[a-zA-Z!/][^"\'>]*(?:(?:"[^"]*"|\'[^\']*\')[^"\'>]*)*>')
+_ATTRIBUTE_VALUE_OR_SPACES = re.compile(r'("[^"]*"|\'[^\']*\')|\s+')
+_STYLESHEET_LINK = re.compile(
+    r'<link\b[^>]*\bhref="(?P<href>[^"]+\.css)"[^>]*>', re.IGNORECASE)
+_DATA_ATTRIBUTE = re.compile(r'\sdata-[\w-]+="[^"]*"')
+_ENABLER_SCRIPT = re.compile(
+    r'(<script\b[^>]*\bsrc=")' + re.escape(ENABLER_MEMBER) + '"',
+    re.IGNORECASE)
+
+
+def _skip_string(css, position):
+  """Returns the position after the quoted string starting at position."""
+  quote = css[position]
+  position += 1
+  while position < len(css) and css[position] != quote:
+    position += 2 if css[position] == '\\' else 1
+  return position + 1
+
+
+def _split_outside(text, separator):
+  """Splits the text on a character that is not inside quotes or brackets."""
+  parts = []
+  depth = 0
+  start = 0
+  position = 0
+  while position < len(text):
+    char = text[position]
+    if char in '"\'':
+      position = _skip_string(text, position)
+      continue
+    if char in '([':
+      depth += 1
+    elif char in ')]':
+      depth -= 1
+    elif char == separator and depth == 0:
+      parts.append(text[start:position])
+      start = position + 1
+    position += 1
+  parts.append(text[start:])
+  return parts
+
+
+def _parse_rules(css, position=0):
+  """Parses a list of CSS rules until the end of the text or of the block.
+
+  Args:
+      css (str): style sheet without comments
+      position (int, optional): where the list starts. Defaults to 0
+
+  Returns:
+      ([tuple], int): the rules, as ('rule', selector, declarations),
+      ('block', prelude, rules) or ('statement', text, None), and the position
+      after the list
+  """
+  rules = []
+  start = position
+  while position < len(css):
+    char = css[position]
+    if char in '"\'':
+      position = _skip_string(css, position)
+    elif char == ';':
+      statement = css[start:position].strip()
+      if statement:
+        rules.append(('statement', statement, None))
+      position += 1
+      start = position
+    elif char == '}':
+      return (rules, position + 1)
+    elif char == '{':
+      prelude = css[start:position].strip()
+      if prelude.lower().startswith(NESTED_AT_RULES):
+        (children, position) = _parse_rules(css, position + 1)
+        rules.append(('block', prelude, children))
+      else:
+        end = position + 1
+        while end < len(css) and css[end] != '}':
+          end = _skip_string(css, end) if css[end] in '"\'' else end + 1
+        rules.append(('rule', prelude, css[position + 1:end]))
+        position = end + 1
+      start = position
+    else:
+      position += 1
+
+  statement = css[start:].strip()
+  if statement:
+    rules.append(('statement', statement, None))
+  return (rules, position)
+
+
+def _minify_declarations(declarations):
+  """Minifies the body of a rule, i.e: ' color : red ; ' to 'color:red'."""
+  minified = []
+  for declaration in _split_outside(declarations, ';'):
+    if ':' not in declaration:
+      continue
+    (name, value) = declaration.split(':', 1)
+    value = value.strip()
+    # Whitespace inside strings is part of the value.
+    if '"' not in value and "'" not in value:
+      value = _SPACES.sub(' ', value)
+    minified.append(f'{name.strip()}:{value}')
+  return ';'.join(minified)
+
+
+def _minify_selector(selector):
+  """Minifies a selector or an at-rule prelude."""
+  return _SELECTOR_SPACES.sub(r'\1', _SPACES.sub(' ', selector.strip()))
+
+
+def _specificity(selector):
+  """Works out the specificity of a single selector.
+
+  Args:
+      selector (str): the selector, i.e: #figura .area:hover
+
+  Returns:
+      (int, int, int): the id, class and type counts or None when the
+      selector is too complex to tell
+  """
+  if '\\' in selector or any(
+      pseudo in selector for pseudo in _SELECTOR_LIST_PSEUDO_CLASSES):
+    return None
+
+  (ids, classes, types) = (0, 0, 0)
+  for match in _SELECTOR_PARTS.finditer(selector):
+    if match['id']:
+      ids += 1
+    elif match['class'] or match['attribute']:
+      classes += 1
+    elif match['pseudo']:
+      pseudo = match['pseudo'].lower()
+      if pseudo.startswith('::') or pseudo in _LEGACY_PSEUDO_ELEMENTS:
+        types += 1
+      else:
+        classes += 1
+    elif match['type']:
+      types += 1
+  return (ids, classes, types)
+
+
+def _declarations(body):
+  """Returns the values of the properties set by the minified declarations."""
+  declarations = {}
+  for declaration in _split_outside(body, ';'):
+    if ':' in declaration:
+      (name, value) = declaration.split(':', 1)
+      declarations[name.strip().lower()] = value
+  return declarations
+
+
+def _conflicts(declarations, other_declarations):
+  """Checks if two rules set a property to different values."""
+  return any(
+      other_declarations.get(name, value) != value
+      for (name, value) in declarations.items())
+
+
+def _can_move_over(selectors, declarations, rules):
+  """Checks if moving a rule before others keeps the cascade the same.
+
+  The order of two rules only matters when they set the same property to
+  different values with selectors of the same specificity.
+
+  Args:
+      selectors ([str]): selectors of the moved rule
+      declarations (Dict[str, str]): values of the properties set by the moved
+        rule
+      rules ([tuple]): the rules it is moved over
+
+  Returns:
+      bool: True if the rule can be moved
+  """
+  specificities = {_specificity(selector) for selector in selectors}
+  for (kind, prelude, body) in rules:
+    if kind == 'block':
+      if not _can_move_over(selectors, declarations, body):
+        return False
+    elif kind == 'rule' and _conflicts(declarations, _declarations(body)):
+      if None in specificities:
+        return False
+      for selector in prelude:
+        specificity = _specificity(selector)
+        if specificity is None or specificity in specificities:
+          return False
+  return True
+
+
+def _merge_rules(rules):
+  """Groups the rules with the same declarations under a combined selector.
+
+  A rule is only moved up to an earlier one with the same declarations when
+  that does not change which declarations win, see _can_move_over.
+
+  Args:
+      rules ([tuple]): parsed rules with minified declarations
+
+  Returns:
+      [tuple]: the merged rules
+  """
+  merged = []
+  groups = {}
+  for rule in rules:
+    (kind, prelude, body) = rule
+    if kind == 'block':
+      merged.append((kind, prelude, _merge_rules(body)))
+      continue
+    if kind != 'rule' or prelude.startswith('@'):
+      merged.append(rule)
+      continue
+
+    selectors = _split_outside(prelude, ',')
+    index = groups.get(body)
+    if index is not None and _can_move_over(selectors, _declarations(body),
+                                            merged[index + 1:]):
+      merged_selectors = merged[index][1]
+      for selector in selectors:
+        if selector not in merged_selectors:
+          merged_selectors.append(selector)
+      continue
+
+    groups[body] = len(merged)
+    merged.append((kind, selectors, body))
+  return merged
+
+
+def _serialize(rules):
+  parts = []
+  for (kind, prelude, body) in rules:
+    if kind == 'rule':
+      selector = ','.join(prelude) if isinstance(prelude, list) else prelude
+      parts.append(f'{selector}{{{body}}}')
+    elif kind == 'block':
+      parts.append(f'{prelude}{{{_serialize(body)}}}')
+    else:
+      parts.append(f'{prelude};')
+  return ''.join(parts)
+
+
+def _minify_parsed(rules):
+  """Minifies the selectors and declarations of the parsed rules."""
+  minified = []
+  for (kind, prelude, body) in rules:
+    if kind == 'rule':
+      minified.append((kind, _minify_selector(prelude),
+                       _minify_declarations(body)))
+    elif kind == 'block':
+      minified.append((kind, _minify_selector(prelude), _minify_parsed(body)))
+    else:
+      minified.append((kind, _SPACES.sub(' ', prelude), body))
+  return minified
+
+
+def pack_css(css):
+  """Minifies a style sheet and merges the rules with the same declarations.
+
+  Args:
+      css (str): the style sheet
+
+  Returns:
+      str: the packed style sheet
+  """
+  (rules, _) = _parse_rules(_COMMENT.sub('', css))
+  return _serialize(_merge_rules(_minify_parsed(rules)))
+
+
+def _collapse_spaces(html):
+  """Collapses the whitespace of markup, except in quoted attribute values."""
+  parts = []
+  position = 0
+  for match in _TAG.finditer(html):
+    parts.append(_SPACES.sub(' ', html[position:match.start()]))
+    parts.append(_ATTRIBUTE_VALUE_OR_SPACES.sub(
+        lambda part: part.group(1) or ' ', match.group(0)))
+    position = match.end()
+  parts.append(_SPACES.sub(' ', html[position:]))
+  return ''.join(parts)
+
+
+def minify_html(html):
+  """Collapses the whitespace and drops the comments of an HTML document.
+
+  Runs of whitespace become a single space so inline content renders the same,
+  the attribute values are kept as they are. Scripts, preformatted text and text areas are kept as they are and the style
+  sheets are packed.
+
+  Args:
+      html (str): the document
+
+  Returns:
+      str: the minified document
+  """
+  parts = []
+  position = 0
+  for match in _PROTECTED_BLOCK.finditer(html):
+    text = _HTML_COMMENT.sub('', html[position:match.start()])
+    parts.append(_collapse_spaces(text))
+    (opening, tag, content, closing) = match.groups()
+    if tag.lower() == 'style':
+      content = pack_css(content)
+    parts.append(f'{_collapse_spaces(opening)}{content}{closing}')
+    position = match.end()
+  parts.append(_collapse_spaces(_HTML_COMMENT.sub('', html[position:])))
+  return ''.join(parts).strip()
+
+
+class CreativePacker:
+  """Makes the exported creatives smaller and with fewer files.
+
+  The small style sheets are packed once, when the packer is created, and
+  inlined in every creative. The members they replace are left out of the zip.
+  """
+
+  def __init__(self, bundle, inline_css_max_bytes=4096, hosted_enabler=False):
+    """Initializes the packer.
+
+    Args:
+        bundle (AssetBundle): the static files shipped in every creative
+        inline_css_max_bytes (int, optional): style sheets up to this size are
+          inlined. Defaults to 4096
+        hosted_enabler (bool, optional): references the Enabler hosted by
+          Google instead of shipping it. Defaults to False
+    """
+    self.hosted_enabler = hosted_enabler
+    self._inline_styles = {}
+    for member in bundle.members:
+      if (member.name.endswith('.css') and
+          member.file_size <= inline_css_max_bytes):
+        self._inline_styles[member.name] = pack_css(
+            bundle.content(member.name).decode('utf-8'))
+
+  def pack(self, html):
+    """Packs an exported creative.
+
+    Args:
+        html (bytes): the exported HTML
+
+    Returns:
+        (bytes, set): the packed HTML and the names of the static files it no
+        longer needs
+    """
+    text = html.decode('utf-8', 'surrogateescape')
+    unused = set()
+
+    def inline(match):
+      style = self._inline_styles.get(match['href'])
+      if style is None:
+        return match.group(0)
+      unused.add(match['href'])
+      attributes = ''.join(_DATA_ATTRIBUTE.findall(match.group(0)))
+      return f'<style{attributes}>{style}</style>'
+
+    text = _STYLESHEET_LINK.sub(inline, text)
+    if self.hosted_enabler:
+      (text, count) = _ENABLER_SCRIPT.subn(rf'\g<1>{HOSTED_ENABLER_URL}"', text)
+      if count:
+        unused.add(ENABLER_MEMBER)
+
+    packed = minify_html(text).encode('utf-8', 'surrogateescape')
+    print(f'Packed the creative from {len(html)} to {len(packed)} bytes,'
+          f' leaving out {sorted(unused)}')
+    return (packed, unused)
@@ -0,0 +1,506 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The creative pipeline shared by the web apps and the command line tools.
+
+It holds the configuration read from the environment, the long-lived objects
+built from it, i.e: detector, caches and asset bundle, and the steps that build
+a creative, save its zip and delete them. main serves them with Flask,
+asgi_app with async handlers and bulk_generate for a whole feed. Nothing here
+depends on a request, whether the files go to the local drive or to Cloud
+Storage is passed in.
+"""
+
+import functools
+import os
+from urllib import parse
+import zipfile
+from annotation_cache import AnnotationCache
+import artifact_registry
+from artifact_store import ArtifactStore
+from asset_bundle import AssetBundle, compress_type_for
+from creative_packer import CreativePacker
+from dnn_detector import DnnDetector
+from generate_creative import MAX_IMAGE_DOWNLOAD_BYTES, VisionDetector, annotate_images, detect_objects, detect_objects_multi_size, generate_html5_parts
+from gcs_storage import get_storage_manager
+import http_client
+import metrics
+import static_assets
+from vision_batcher import VisionBatcher
+
+GCS_BUCKET = f"{os.environ.get('GOOGLE_CLOUD_PROJECT')}.appspot.com"
+API_KEY = os.environ.get('API_KEY')
+VISION_INLINE_MAX_SIDE = int(os.environ.get('VISION_INLINE_MAX_SIDE', 0))
+# Batching the Vision calls of concurrent requests is opt-in, set it above 1.
+VISION_BATCH_SIZE = int(os.environ.get('VISION_BATCH_SIZE', 1))
+VISION_BATCH_WAIT_MS = int(os.environ.get('VISION_BATCH_WAIT_MS', 10))
+# vision or dnn, an ONNX model run locally with OpenCV.
+DETECTOR_BACKEND = os.environ.get('DETECTOR_BACKEND', 'vision')
+DNN_MODEL_PATH = os.environ.get('DNN_MODEL_PATH', 'models/detector.onnx')
+DNN_LABELS_PATH = os.environ.get('DNN_LABELS_PATH', 'models/labels.txt')
+DNN_INPUT_SIZE = int(os.environ.get('DNN_INPUT_SIZE', 640))
+DNN_BATCH_SIZE = int(os.environ.get('DNN_BATCH_SIZE', 8))
+# yolov5 or yolov8, told apart by the shape of the output when not set.
+DNN_LAYOUT = os.environ.get('DNN_LAYOUT') or None
+TRANSPARENT_GIF = 'static/images/transparent.gif'
+OUTPUT_HTML_FILE_NAME = 'creative.html'
+MINUTES_TO_EXPIRE = 60
+# Folder of the generated blobs, the bucket deletes the ones the janitor
+# misses, see storage_lifecycle.json.
+GCS_ARTIFACT_DIR = 'creatives'
+ZIP_UPLOAD_CHUNK_SIZE = 256 * 1024
+OUTPUT_IMAGE_FORMAT = os.environ.get('OUTPUT_IMAGE_FORMAT') or None
+IMAGE_BUDGET_KB = int(os.environ.get('IMAGE_BUDGET_KB', 0))
+CREATIVE_BUDGET_KB = int(os.environ.get('CREATIVE_BUDGET_KB', 0))
+CREATIVE_HTML_RESERVE_KB = 16
+PACK_CREATIVES = os.environ.get('PACK_CREATIVES', 'true').lower() in ('1',
+                                                                     'true')
+INLINE_CSS_MAX_KB = int(os.environ.get('INLINE_CSS_MAX_KB', 4))
+HOSTED_ENABLER = os.environ.get('HOSTED_ENABLER', '').lower() in ('1', 'true')
+CSS_FILES = ['gwdgooglead_style.css', 'gwdpage_style.css', 'gwdimage_style.css', 'gwdpagedeck_style.css', 'gwdtaparea_style.css']
+JS_FILES = ['Enabler.js', 'gwdtaparea_min.js', 'gwdpage_min.js', 'gwd-events-support.1.0.js', 'gwd_webcomponents_v1_min.js', 'gwdgooglead_min.js', 'gwdpagedeck_min.js', 'gwdimage_min.js']
+
+
+def _load_asset_bundle():
+  """Reads the static files shipped in every creative from the local drive.
+
+  Returns:
+      AssetBundle: the compressed static files ready to be copied into a zip
+  """
+  files = [(TRANSPARENT_GIF, f'images/{TRANSPARENT_GIF.split("/")[-1]}')]
+  for file_name in CSS_FILES:
+    files.append((f'static/css/{file_name}', f'css/{file_name}'))
+  for file_name in JS_FILES:
+    files.append((f'static/js/{file_name}', f'js/{file_name}'))
+
+  return AssetBundle.load(files)
+
+
+ASSET_BUNDLE = _load_asset_bundle()
+ASSET_MANIFEST = static_assets.load_manifest()
+CREATIVE_PACKER = None
+if PACK_CREATIVES:
+  CREATIVE_PACKER = CreativePacker(
+      ASSET_BUNDLE,
+      inline_css_max_bytes=INLINE_CSS_MAX_KB * 1024,
+      hosted_enabler=HOSTED_ENABLER)
+
+
+def _get_max_image_bytes():
+  """Works out the image budget from the image and creative weight budgets.
+
+  The creative budget has to fit the static files, the HTML file and the image.
+
+  Returns:
+      int: maximum size of the image in bytes or None if there is no budget
+  """
+  budgets = []
+  if IMAGE_BUDGET_KB:
+    budgets.append(IMAGE_BUDGET_KB * 1024)
+  if CREATIVE_BUDGET_KB:
+    budgets.append(CREATIVE_BUDGET_KB * 1024 - ASSET_BUNDLE.archive_size() -
+                   CREATIVE_HTML_RESERVE_KB * 1024)
+
+  if not budgets:
+    return None
+  return max(1, min(budgets))
+
+
+MAX_IMAGE_BYTES = _get_max_image_bytes()
+ANNOTATION_CACHE = AnnotationCache(
+    max_entries=int(os.environ.get('ANNOTATION_CACHE_SIZE', 256)),
+    ttl_seconds=int(os.environ.get('ANNOTATION_CACHE_TTL', 3600)),
+    cache_dir=os.environ.get('ANNOTATION_CACHE_DIR'),
+    max_disk_bytes=int(
+        os.environ.get('ANNOTATION_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+)
+ARTIFACT_STORE = ArtifactStore(
+    max_memory_bytes=int(os.environ.get('ARTIFACT_STORE_MAX_MEMORY_MB', 64))
+    * 1024 * 1024,
+    ttl_seconds=MINUTES_TO_EXPIRE * 60,
+    spill_dir=os.environ.get('ARTIFACT_STORE_DIR'),
+)
+VISION_BATCHER = None
+if VISION_BATCH_SIZE > 1:
+  VISION_BATCHER = VisionBatcher(
+      functools.partial(annotate_images, api_key=API_KEY),
+      max_batch_size=VISION_BATCH_SIZE,
+      max_wait_ms=VISION_BATCH_WAIT_MS,
+      # As long as a call of its own, then the request is sent on its own.
+      timeout=http_client.DEFAULT_CLIENT.timeout + VISION_BATCH_WAIT_MS / 1000,
+  )
+if DETECTOR_BACKEND == 'dnn':
+  DETECTOR = DnnDetector(
+      DNN_MODEL_PATH,
+      DNN_LABELS_PATH,
+      input_size=DNN_INPUT_SIZE,
+      max_batch_size=DNN_BATCH_SIZE,
+      layout=DNN_LAYOUT,
+  )
+else:
+  DETECTOR = VisionDetector(API_KEY, VISION_INLINE_MAX_SIDE, VISION_BATCHER)
+# Deletes the generated images and zips when they expire, even if the browser
+# never reaches /clean.
+ARTIFACT_REGISTRY = artifact_registry.ArtifactRegistry(
+    ttl_seconds=MINUTES_TO_EXPIRE * 60,
+    index_path=os.environ.get('ARTIFACT_INDEX_PATH'),
+    bucket_name=GCS_BUCKET,
+    max_local_bytes=int(os.environ.get('ARTIFACT_MAX_LOCAL_MB', 512)) * 1024 *
+    1024,
+    sweep_interval_seconds=int(os.environ.get('ARTIFACT_SWEEP_SECONDS', 60)),
+    min_keep_seconds=int(os.environ.get('ARTIFACT_MIN_KEEP_SECONDS', 300)),
+)
+
+
+def clean_files(img_url, zip_file_url, artifact_token, local):
+  """Delete the generated files
+
+  Args:
+      img_url (str): URL of the image
+      zip_file_url (str): URL of the zip file
+      artifact_token (str): token of the image in the artifact store
+      local (boolean): describes if the server is running on localhost
+  """
+  if artifact_token:
+    ARTIFACT_STORE.discard(artifact_token)
+  img_name = img_url.split('/')[-1]
+  zip_name = zip_file_url.split('/')[-1]
+  if local:
+    _delete_from_local(img_name, zip_name)
+    ARTIFACT_REGISTRY.forget(artifact_registry.LOCAL,
+                             f'static/images/{img_name}')
+    ARTIFACT_REGISTRY.forget(artifact_registry.LOCAL, f'static/{zip_name}')
+  else:
+    img_name = f"{GCS_ARTIFACT_DIR}/{img_name.split('?')[0]}"
+    zip_name = f"{GCS_ARTIFACT_DIR}/{zip_name.split('?')[0]}"
+    _delete_from_gcs(img_name, zip_name)
+    ARTIFACT_REGISTRY.forget(artifact_registry.GCS, img_name)
+    ARTIFACT_REGISTRY.forget(artifact_registry.GCS, zip_name)
+
+
+def record_artifact(name, local, size):
+  """Adds a generated file to the registry, the janitor deletes it once it
+
+  expires.
+
+  Args:
+      name (str): path of the local file or name of the blob
+      local (boolean): describes if the server is running on localhost
+      size (int): size of the file in bytes
+  """
+  location = artifact_registry.LOCAL if local else artifact_registry.GCS
+  try:
+    ARTIFACT_REGISTRY.record(location, name, size)
+  except artifact_registry.DiskBudgetExceeded as ex:
+    # The request still gets its file, the janitor deletes it when it expires.
+    print(f'{ex}, kept over budget')
+    ARTIFACT_REGISTRY.record(location, name, size, force=True)
+
+
+def _delete_from_local(img_name, zip_name):
+  """Removes the files from static directory in local drive
+
+  Args:
+      img_name (str): name of the image file
+      zip_name (str): name of the zip file
+  """
+
+  try:
+    os.remove(f'static/images/{img_name}')
+    os.remove(f'static/{zip_name}')
+  except Exception as ex:
+    print(ex)
+
+
+def _delete_from_gcs(img_name, zip_name):
+  """Deletes blobs from the bucket
+
+  Args:
+      img_name (str): URL of the image file
+      zip_name (str): URL of the zip file
+  """
+  try:
+    print(f'Trying to delete {img_name} and {zip_name}.')
+    # A single batch request, missing blobs are not an error.
+    failed = get_storage_manager(GCS_BUCKET).delete_blobs([img_name, zip_name])
+    print(f'Blobs deleted, except {failed}.' if failed else 'Blobs deleted.')
+  except Exception as ex:
+    print(ex)
+
+
+def read_image(image_url):
+  """Reads an image from internet
+
+  Args:
+      image_url (str): URL for the image
+
+  Returns:
+      bytearray: Bytes for the image
+  """
+  return http_client.get(image_url, max_bytes=MAX_IMAGE_DOWNLOAD_BYTES).data
+
+
+def create_zip(output, zip_file_name, html_file, img_url, img_name,
+               artifact_token):
+  """Writes a zip file with the html and images files into a stream.
+
+  The static files come from the preloaded asset bundle and the image from the
+  artifact store, the image is only downloaded again if it is no longer there.
+  Text members are deflated while the images are stored as they are. When
+  packing is on, the HTML is minified and the static files it inlines are left
+  out.
+
+  Args:
+      output (file): writable stream, it does not need to be seekable
+      zip_file_name (str): Name for the zip file
+      html_file (bytearray): Bytes of the HTML file
+      img_url (str): URL for the image
+      img_name (str): Name of the image
+      artifact_token (str): token of the image in the artifact store
+  """
+  img_file = ARTIFACT_STORE.get(artifact_token) if artifact_token else None
+  if img_file is None:
+    metrics.ARTIFACT_STORE.inc(result='miss')
+    with metrics.span('image_fetch'):
+      img_file = read_image(img_url)
+    metrics.TRANSFERRED_BYTES.inc(len(img_file), direction='in',
+                                  peer='image')
+  else:
+    metrics.ARTIFACT_STORE.inc(result='hit')
+
+  write_zip(output, zip_file_name, html_file, img_name, img_file)
+
+
+def write_zip(output, zip_file_name, html_file, img_name, img_file):
+  """Writes the creative zip with the exported HTML and the image.
+
+  Args:
+      output (file): writable stream, it does not need to be seekable
+      zip_file_name (str): Name for the zip file
+      html_file (bytes): Bytes of the exported HTML file
+      img_name (str): Name of the image
+      img_file (bytes): the encoded image
+  """
+  # The exported HTML references the fingerprinted copies of the static files.
+  html_file = static_assets.unfingerprint(html_file, ASSET_MANIFEST)
+  unused_members = ()
+  if CREATIVE_PACKER is not None:
+    with metrics.span('pack'):
+      (html_file, unused_members) = CREATIVE_PACKER.pack(html_file)
+
+  with zipfile.ZipFile(output, mode='w') as zf:
+    img_member = f'{zip_file_name}/images/{img_name}'
+    zf.writestr(img_member, img_file, compress_type_for(img_member))
+    ASSET_BUNDLE.write_to(zf, zip_file_name, exclude=unused_members)
+    zf.writestr(f'{zip_file_name}/{OUTPUT_HTML_FILE_NAME}', html_file,
+                compress_type_for(OUTPUT_HTML_FILE_NAME))
+
+
+def save_zip(zip_file_name, html_file, img_url, img_name, artifact_token,
+             base_url, local):
+  """Builds the zip file and saves it while it is written.
+
+  Args:
+      zip_file_name (str): the name to give to the saved file
+      html_file (bytearray): Bytes of the HTML file
+      img_url (str): URL for the image
+      img_name (str): Name of the image
+      artifact_token (str): token of the image in the artifact store
+      base_url (str): base URL to use in the resulting URL for the saved file
+      local (boolean): describes if the server is running on localhost
+
+  Returns:
+      str: URL for the saved file
+  """
+  if local:
+    tmp_dir = 'static'
+    file_path = f'{tmp_dir}/{zip_file_name}.zip'
+    with open(file_path, 'wb') as f:
+      create_zip(f, zip_file_name, html_file, img_url, img_name,
+                 artifact_token)
+      record_artifact(file_path, local, f.tell())
+    return f'{base_url}{file_path}'
+
+  else:
+    file_name = f'{GCS_ARTIFACT_DIR}/{zip_file_name}.zip'
+    storage_manager = get_storage_manager(GCS_BUCKET)
+    blob = storage_manager.blob(file_name)
+    # The resumable upload sends every chunk as soon as it is written.
+    with blob.open('wb', chunk_size=ZIP_UPLOAD_CHUNK_SIZE, ignore_flush=True,
+                   content_type='application/zip') as f:
+      create_zip(f, zip_file_name, html_file, img_url, img_name,
+                 artifact_token)
+      zip_size = f.tell()
+    record_artifact(file_name, local, zip_size)
+    metrics.TRANSFERRED_BYTES.inc(zip_size, direction='out', peer='gcs')
+    with metrics.span('sign'):
+      return storage_manager.signed_url(file_name, MINUTES_TO_EXPIRE)
+
+
+def get_gcs_signed_url(file_name, bucket_name):
+  """Builds the signed URL to temporary access the GCS files from any client
+
+  Args:
+      file_name (str): the file to generate the signed URL for
+      bucket_name (stre): name of the Google Cloud Storage bucket
+
+  Returns:
+      str: signed URL
+  """
+  return get_storage_manager(bucket_name).signed_url(file_name,
+                                                     MINUTES_TO_EXPIRE)
+
+
+def process_image(img_url, threshold, img_dimensions, local, progress=None):
+  """Detects all the objects in the image, their labels and returns the HTML bits for later
+
+  composition.
+
+  Args:
+      img_url (str): URL of the image to analyse
+      threshold (float): number between 0 and 1 to use as confidence threshold
+        for detection
+      img_dimensions (str): image dimensions in widthxheight format. i.e:
+        300x600
+      local (boolean): describes if the server is running on localhost
+      progress (Callable, optional): called with the name of every stage as it
+        starts. Defaults to None
+
+  Returns:
+      (str,
+       str,
+       int,
+       int,
+       Html5Parts,
+       str): the generated URL after saving the image in the server, name of
+       the image, image width, image height, the HTML5 strings ready to be
+       inserted in the template and the token of the image in the artifact
+       store
+  """
+
+  if progress is None:
+    progress = lambda stage: None
+
+  bucket = None
+  if local:
+    tmp_dir = 'static/images'
+  else:
+    tmp_dir = GCS_ARTIFACT_DIR
+    bucket = GCS_BUCKET
+
+  desired_width = int(img_dimensions.split('x')[0])
+  desired_height = int(img_dimensions.split('x')[1])
+
+  (new_img_url, img_name, width, height, polygons, encoded_img) = detect_objects(
+      img_url,
+      tmp_dir,
+      threshold,
+      desired_width,
+      desired_height,
+      local,
+      API_KEY,
+      bucket,
+      annotation_cache=ANNOTATION_CACHE,
+      output_format=OUTPUT_IMAGE_FORMAT,
+      max_image_bytes=MAX_IMAGE_BYTES,
+      progress=progress,
+      detector=DETECTOR,
+  )
+  record_artifact(f'{tmp_dir}/{img_name}', local, len(encoded_img))
+
+  if not local:
+    progress('signing')
+    with metrics.span('sign'):
+      new_img_url = get_gcs_signed_url(new_img_url, bucket)
+    print(f'Replacing the image with the signed GCS URL {new_img_url}')
+
+  new_img_url = parse.unquote(new_img_url)
+  artifact_token = ARTIFACT_STORE.put(encoded_img)
+
+  progress('rendering')
+  with metrics.span('html'):
+    html5_parts = generate_html5_parts(polygons)
+
+  return (
+      new_img_url,
+      img_name,
+      width,
+      height,
+      html5_parts,
+      artifact_token,
+  )
+
+
+def process_image_sizes(img_url, threshold, sizes, local):
+  """Detects the objects in the image once and returns the HTML bits for every
+
+  creative size.
+
+  Args:
+      img_url (str): URL of the image to analyse
+      threshold (float): number between 0 and 1 to use as confidence threshold
+        for detection
+      sizes ([str]): image dimensions in widthxheight format. i.e: 300x600
+      local (boolean): describes if the server is running on localhost
+
+  Returns:
+      [Dict[str, object]]: for every size, the generated URL after saving the
+      image in the server, name of the image, image width, image height, the
+      HTML5 strings and the token of the image in the artifact store
+  """
+
+  bucket = None
+  if local:
+    tmp_dir = 'static/images'
+  else:
+    tmp_dir = GCS_ARTIFACT_DIR
+    bucket = GCS_BUCKET
+
+  desired_sizes = [
+      (int(size.split('x')[0]), int(size.split('x')[1])) for size in sizes
+  ]
+
+  results = detect_objects_multi_size(
+      img_url,
+      tmp_dir,
+      threshold,
+      desired_sizes,
+      local,
+      API_KEY,
+      bucket,
+      annotation_cache=ANNOTATION_CACHE,
+      output_format=OUTPUT_IMAGE_FORMAT,
+      max_image_bytes=MAX_IMAGE_BYTES,
+      detector=DETECTOR,
+  )
+
+  creatives = []
+  for (new_img_url, img_name, width, height, polygons, encoded_img) in results:
+    record_artifact(f'{tmp_dir}/{img_name}', local, len(encoded_img))
+    if not local:
+      with metrics.span('sign'):
+        new_img_url = get_gcs_signed_url(new_img_url, bucket)
+
+    with metrics.span('html'):
+      html5_parts = generate_html5_parts(polygons)
+    creatives.append({
+        'img_url': parse.unquote(new_img_url),
+        'img_name': img_name,
+        'width': width,
+        'height': height,
+        'artifact_token': ARTIFACT_STORE.put(encoded_img),
+        **html5_parts._asdict(),
+    })
+
+  return creatives
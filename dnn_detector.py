@@ -0,0 +1,309 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import threading
+from lazy_import import lazy_import
+from vision_batcher import VisionBatcher
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# Gray used by the YOLO exports to pad the images to a square.
+PADDING_COLOR = (114, 114, 114)
+MAX_DETECTIONS = 100
+# Candidates with an objectness score before the class scores, i.e: YOLOv5.
+YOLOV5 = 'yolov5'
+# Candidates with the class scores only, i.e: YOLOv8.
+YOLOV8 = 'yolov8'
+
+
+def _letterbox(img, size):
+  """Scales the image to fit a square and pads the right and bottom sides.
+
+  Args:
+      img (ndarray): decoded image
+      size (int): side of the square in pixels
+
+  Returns:
+      (ndarray, float, float): the square BGR image and the fraction of its
+      width and height covered by the image
+  """
+  if img.ndim == 2:
+    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+  elif img.shape[2] == 4:
+    img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+
+  (h, w) = img.shape[:2]
+  r = size / float(max(h, w))
+  (new_w, new_h) = (max(1, int(round(w * r))), max(1, int(round(h * r))))
+  if (new_w, new_h) != (w, h):
+    img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+  square = cv2.copyMakeBorder(img, 0, size - new_h, 0, size - new_w,
+                              cv2.BORDER_CONSTANT, value=PADDING_COLOR)
+  return (square, new_w / size, new_h / size)
+
+
+def _to_annotations(rows, labels, layout, coverage, score_threshold,
+                    nms_threshold):
+  """Translates the raw output of the model for one image to Vision objects.
+
+  Args:
+      rows (ndarray): A x (4 + C) or A x (5 + C) candidates, boxes as center
+        x, center y, width and height in pixels of the model input, then the
+        objectness for the latter and the score of every class
+      labels ([str]): names of the C classes
+      layout (str): YOLOV5 for candidates with an objectness, YOLOV8 without
+      coverage ((float, float, int)): fraction of the input width and height
+        covered by the image and side of the input in pixels
+      score_threshold (float): minimum score of the objects kept
+      nms_threshold (float): overlap over which the weaker of two boxes of
+        the same class is dropped
+
+  Returns:
+      [Dict[str, object]]: localizedObjectAnnotations of the Vision API
+  """
+  if layout == YOLOV5:
+    class_scores = rows[:, 5:] * rows[:, 4:5]
+  else:
+    class_scores = rows[:, 4:]
+  class_ids = class_scores.argmax(axis=1)
+  scores = class_scores[np.arange(len(rows)), class_ids]
+
+  keep = scores >= score_threshold
+  (boxes, scores, class_ids) = (rows[keep, :4], scores[keep], class_ids[keep])
+  if not len(scores):
+    return []
+
+  # Top left corner and size, as NMSBoxes expects them.
+  boxes = np.concatenate((boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, 2:]),
+                         axis=1)
+  indices = cv2.dnn.NMSBoxesBatched(boxes.tolist(), scores.tolist(),
+                                    class_ids.tolist(), score_threshold,
+                                    nms_threshold, top_k=MAX_DETECTIONS)
+
+  (width_fraction, height_fraction, size) = coverage
+  scale = np.array((width_fraction, height_fraction)) * size
+  annotations = []
+  for index in np.asarray(indices, dtype=int).reshape(-1):
+    (x0, y0) = np.clip(boxes[index, :2] / scale, 0.0, 1.0)
+    (x1, y1) = np.clip((boxes[index, :2] + boxes[index, 2:]) / scale, 0.0,
+                       1.0)
+    label = labels[class_ids[index]]
+    annotations.append({
+        'name': label[:1].upper() + label[1:],
+        'score': float(scores[index]),
+        'boundingPoly': {
+            'normalizedVertices': [
+                {'x': float(x0), 'y': float(y0)},
+                {'x': float(x1), 'y': float(y0)},
+                {'x': float(x1), 'y': float(y1)},
+                {'x': float(x0), 'y': float(y1)},
+            ]
+        },
+    })
+  return annotations
+
+
+class DnnDetector:
+  """Detects the objects locally, on the CPU, with an ONNX model and OpenCV.
+
+  The model is a YOLO style detector, i.e: YOLOv5 or YOLOv8 exported to ONNX,
+  with one label per line in the labels file. The objects come back in the
+  format of the Vision API response so nothing downstream changes. The model
+  is loaded once per process and the images of concurrent requests are run
+  through it in a single batch, which needs a model exported with a dynamic
+  batch axis; other models run the images of a batch one by one. Nothing is
+  read from the drive until the detector is first used.
+  """
+
+  name = 'dnn'
+
+  def __init__(self, model_path, labels_path, input_size=640,
+               score_threshold=0.25, nms_threshold=0.45, max_batch_size=8,
+               max_wait_ms=10, layout=None):
+    """Initializes the detector.
+
+    Args:
+        model_path (str): path of the ONNX model
+        labels_path (str): path of the text file with the names of the classes
+        input_size (int, optional): side of the square input of the model.
+          Defaults to 640
+        score_threshold (float, optional): minimum score of the objects
+          returned. Defaults to 0.25
+        nms_threshold (float, optional): overlap over which the weaker of two
+          boxes of the same class is dropped. Defaults to 0.45
+        max_batch_size (int, optional): maximum number of images run through
+          the model together. Defaults to 8
+        max_wait_ms (int, optional): maximum time to wait for the batch to
+          fill up. Defaults to 10
+        layout (str, optional): YOLOV5 or YOLOV8, the layout of the
+          candidates. Defaults to None, YOLOv8 when the model puts them in the
+          last axis of its output, as YOLOv8 exports do, YOLOv5 otherwise
+    """
+    if layout not in (None, YOLOV5, YOLOV8):
+      raise Exception(f'Unknown layout {layout}, use {YOLOV5} or {YOLOV8}')
+    self.model_path = model_path
+    self.labels_path = labels_path
+    self.input_size = input_size
+    self.score_threshold = score_threshold
+    self.nms_threshold = nms_threshold
+    self.layout = layout
+
+    self._lock = threading.Lock()
+    self._pid = None
+    self._net = None
+    self._labels = None
+    self._cache_id = None
+    self._batched = max_batch_size > 1
+    self._batcher = None
+    if self._batched:
+      # What a batch takes in memory is its input blob, float32 B x 3 x S x S,
+      # whatever the size of the decoded images.
+      blob_bytes = 3 * input_size * input_size * 4
+      # The model is not thread safe, the batches are run one at a time.
+      self._batcher = VisionBatcher(self.detect_batch,
+                                    max_batch_size=max_batch_size,
+                                    max_wait_ms=max_wait_ms,
+                                    max_batch_bytes=max_batch_size * blob_bytes,
+                                    max_in_flight=1,
+                                    size_of=lambda img: blob_bytes)
+
+  @property
+  def min_side(self):
+    return self.input_size
+
+  @property
+  def labels(self):
+    """Returns the names of the classes, read on first use.
+
+    Returns:
+        [str]: the names, one per class of the model
+    """
+    if self._labels is None:
+      with open(self.labels_path) as f:
+        self._labels = [line.strip() for line in f if line.strip()]
+    return self._labels
+
+  @property
+  def cache_id(self):
+    """Returns the id of the annotations in the cache, hashing the model on
+    first use.
+
+    Returns:
+        str: the id
+    """
+    if self._cache_id is None:
+      with open(self.model_path, 'rb') as f:
+        model_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+      # Other models or settings give other annotations for the same image.
+      self._cache_id = (f'dnn:{model_hash}:{self.input_size}:'
+                        f'{self.score_threshold}:{self.nms_threshold}')
+    return self._cache_id
+
+  def warm_up(self):
+    """Loads the model ahead of the first request."""
+    self.cache_id  # pylint: disable=pointless-statement
+    with self._lock:
+      self._load()
+
+  def _load(self):
+    """Loads the model once per process.
+
+    Returns:
+        cv2.dnn.Net: the model
+    """
+    if self._pid != os.getpid():
+      print(f'Loading the detection model {self.model_path}')
+      self._net = cv2.dnn.readNetFromONNX(self.model_path)
+      self._net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+      self._net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+      self._pid = os.getpid()
+    return self._net
+
+  def _forward(self, net, squares):
+    """Runs square images through the model.
+
+    Returns:
+        (ndarray, str): B x A x K candidates for the B images and their
+        layout
+    """
+    blob = cv2.dnn.blobFromImages(squares, 1 / 255.0,
+                                  (self.input_size, self.input_size),
+                                  swapRB=True, crop=False)
+    net.setInput(blob)
+    output = net.forward()
+    # There are always far more candidates than values per candidate.
+    candidates_last = output.shape[2] > output.shape[1]
+    if candidates_last:
+      output = output.transpose(0, 2, 1)
+    layout = self.layout or (YOLOV8 if candidates_last else YOLOV5)
+
+    classes = output.shape[2] - (5 if layout == YOLOV5 else 4)
+    if classes != len(self.labels):
+      raise Exception(f'The {layout} model {self.model_path} has {classes}'
+                      f' classes but {self.labels_path} has'
+                      f' {len(self.labels)} labels')
+    return (output, layout)
+
+  def detect_batch(self, images):
+    """Detects the objects in several images in a single run of the model.
+
+    Args:
+        images ([ndarray]): decoded images
+
+    Returns:
+        [Dict[str, object]]: one Vision API response per image, in the same
+        order
+    """
+    letterboxed = [_letterbox(img, self.input_size) for img in images]
+    squares = [square for (square, _, _) in letterboxed]
+    with self._lock:
+      net = self._load()
+      if self._batched and len(squares) > 1:
+        try:
+          (outputs, layout) = self._forward(net, squares)
+        except cv2.error as ex:
+          print(f'The model does not take batches, running images one by one:'
+                f' {ex}')
+          self._batched = False
+      if not self._batched or len(squares) == 1:
+        forwarded = [self._forward(net, [square]) for square in squares]
+        outputs = np.concatenate([output for (output, _) in forwarded])
+        layout = forwarded[0][1]
+
+    return [{
+        'localizedObjectAnnotations':
+            _to_annotations(rows, self.labels, layout,
+                            (width_fraction, height_fraction, self.input_size),
+                            self.score_threshold, self.nms_threshold)
+    } for (rows, (_, width_fraction, height_fraction)) in zip(
+        outputs, letterboxed)]
+
+  def detect(self, img_url, img):
+    """Detects the objects in an image.
+
+    Args:
+        img_url (str): URL of the image
+        img (ndarray): decoded image
+
+    Returns:
+        Dict[str,Dict]: JSON object in the format of the Vision API response
+    """
+    print(f'Detecting the objects of {img_url} with {self.model_path}')
+    if self._batcher is not None:
+      return {'responses': [self._batcher.call(img)]}
+    return {'responses': self.detect_batch([img])}
@@ -0,0 +1,174 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import threading
+import time
+
+# Signed URLs are handed out again until this many seconds before they expire.
+SIGNED_URL_REFRESH_MARGIN = 300
+# Maximum number of calls in a batch request of the JSON API.
+MAX_BATCH_SIZE = 100
+
+
+class StorageManager:
+  """Long-lived Google Cloud Storage client, bucket and credentials.
+
+  Everything is created on first use and reused by the later requests of the
+  process. Signed URLs are cached per blob until shortly before they expire,
+  since on App Engine signing them is a remote call.
+  """
+
+  def __init__(self, bucket_name):
+    self.bucket_name = bucket_name
+    self._client = None
+    self._bucket = None
+    self._pid = None
+    self._signed_urls = {}
+    self._lock = threading.Lock()
+
+  @property
+  def bucket(self):
+    """Returns the bucket handle, creating the client on first use.
+
+    Returns:
+        storage.Bucket: the bucket
+    """
+    if self._pid != os.getpid():
+      with self._lock:
+        if self._pid != os.getpid():
+          # Imported on first use, they take a good part of the start up of
+          # an instance and the local server never needs them.
+          from google.auth import app_engine  # pylint: disable=g-import-not-at-top
+          from google.cloud import storage  # pylint: disable=g-import-not-at-top
+
+          # Clients created before a fork can not be shared with the parent.
+          credentials = app_engine.Credentials()
+          self._client = storage.Client(credentials=credentials)
+          self._bucket = self._client.bucket(self.bucket_name)
+          self._signed_urls = {}
+          self._pid = os.getpid()
+
+    return self._bucket
+
+  def blob(self, blob_name):
+    """Returns a handle to a blob, without any round trip.
+
+    Args:
+        blob_name (str): name of the blob
+
+    Returns:
+        storage.Blob: the blob
+    """
+    return self.bucket.blob(blob_name)
+
+  def signed_url(self, blob_name, expiration_minutes):
+    """Builds the signed URL to temporary access a blob from any client.
+
+    Args:
+        blob_name (str): name of the blob
+        expiration_minutes (int): validity of the URL in minutes
+
+    Returns:
+        str: signed URL
+    """
+    key = (blob_name, expiration_minutes)
+    now = time.time()
+    with self._lock:
+      cached = self._signed_urls.get(key)
+    if cached is not None and cached[1] > now:
+      return cached[0]
+
+    url = self.blob(blob_name).generate_signed_url(
+        version='v4',
+        expiration=datetime.timedelta(minutes=expiration_minutes),
+        method='GET',
+    )
+    refresh_at = now + max(0, expiration_minutes * 60 -
+                           SIGNED_URL_REFRESH_MARGIN)
+    with self._lock:
+      self._signed_urls = {
+          cached_key: value
+          for cached_key, value in self._signed_urls.items()
+          if value[1] > now
+      }
+      self._signed_urls[key] = (url, refresh_at)
+
+    return url
+
+  def forget(self, blob_name):
+    """Drops the cached signed URLs of a blob, i.e: once it is deleted.
+
+    Args:
+        blob_name (str): name of the blob
+    """
+    with self._lock:
+      for key in [key for key in self._signed_urls if key[0] == blob_name]:
+        del self._signed_urls[key]
+
+  def delete_blobs(self, blob_names):
+    """Deletes blobs in batch requests, without reading them first.
+
+    Blobs that no longer exist count as deleted. When a batch fails, its blobs
+    are deleted one by one to find out which ones are left.
+
+    Args:
+        blob_names ([str]): names of the blobs
+
+    Returns:
+        [str]: names of the blobs that could not be deleted
+    """
+    from google.api_core import exceptions  # pylint: disable=g-import-not-at-top
+
+    bucket = self.bucket
+    failed = []
+    for start in range(0, len(blob_names), MAX_BATCH_SIZE):
+      names = blob_names[start:start + MAX_BATCH_SIZE]
+      try:
+        with bucket.client.batch():
+          for name in names:
+            bucket.delete_blob(name)
+      except exceptions.GoogleAPICallError:
+        for name in names:
+          try:
+            bucket.delete_blob(name)
+          except exceptions.NotFound:
+            pass
+          except exceptions.GoogleAPICallError as ex:
+            print(f'Could not delete {name}: {ex}')
+            failed.append(name)
+
+    for name in blob_names:
+      self.forget(name)
+    return failed
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_storage_manager(bucket_name):
+  """Returns the process-wide storage manager for a bucket.
+
+  Args:
+      bucket_name (str): name of the Google Cloud Storage bucket
+
+  Returns:
+      StorageManager: the manager of the bucket
+  """
+  with _managers_lock:
+    if bucket_name not in _managers:
+      _managers[bucket_name] = StorageManager(bucket_name)
+    return _managers[bucket_name]
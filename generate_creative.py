@@ -12,288 +12,308 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from base64 import b64encode
+import collections
 import json
+import os
 from typing import Dict
-from urllib.request import Request
-from urllib.request import urlopen
-import cv2
-from google.cloud import storage
-import numpy as np
+from gcs_storage import get_storage_manager
+import http_client
+import image_codec
+from lazy_import import lazy_import
+import metrics
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
 
 OBJECT_FILTERS = ['Person']
+VISION_ANNOTATE_URL = 'https://vision.googleapis.com/v1/images:annotate'
 SCORE_THRESHOLD = 0.85
-
-
-def localize_objects(img_url, api_key):
-  """Detect objects in the image using Google Vision API.
+# Downloads over this size and images over this number of pixels are refused
+# before they are decoded.
+MAX_IMAGE_DOWNLOAD_BYTES = int(
+    os.environ.get('MAX_IMAGE_DOWNLOAD_MB', 20)) * 1024 * 1024
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_MEGAPIXELS', 50)) * 1000000
+
+Polygons = collections.namedtuple('Polygons', [
+    'names', 'scores', 'label_ids', 'labels', 'vertices', 'printable_vertices'
+])
+Polygons.__doc__ = """Objects detected in the image, one row per object.
+
+  names ([str]): unique name of every object, i.e: Shoe_2
+  scores (ndarray): N confidence levels
+  label_ids (ndarray): N indexes into labels
+  labels (ndarray): the distinct labels of the objects
+  vertices (ndarray): N x 4 x 2 normalized x, y coordinates of the vertices
+  printable_vertices (ndarray): N x 4 x 2 x, y coordinates in pixels
+"""
+
+Html5Parts = collections.namedtuple('Html5Parts', [
+    'clip_paths', 'map_areas', 'tap_areas_hover', 'tap_areas_active',
+    'exit_metrics', 'cut_layers_hover', 'cut_layers_active', 'object_names',
+    'circles'
+])
+
+ExitScripts = collections.namedtuple(
+    'ExitScripts',
+    ['handler_functions', 'handlers_registration', 'studio_exports'])
+
+
+def build_annotate_request(img_url, content=None):
+  """Builds the object localization request for a single image.
 
   Args:
       img_url (str): the URL to get the image from
-      api_key (str): API key for Google Vision API
+      content (bytes, optional): encoded image to send inline instead of
+        letting the API fetch the URL. Defaults to None
 
   Returns:
-      Dict[str,Dict]: JSON object with the Vision API response
+      Dict[str, Dict]: request for the images:annotate endpoint
   """
+  if content is not None:
+    image = {'content': b64encode(content).decode('ascii')}
+  else:
+    image = {'source': {'imageUri': f'{img_url}'}}
 
-  endpoint = f'https://vision.googleapis.com/v1/images:annotate?key={api_key}'
-  data = {
-      'requests': [{
-          'image': {
-              'source': {
-                  'imageUri': f'{img_url}'
-              }
-          },
-          'features': [{
-              'type': 'OBJECT_LOCALIZATION'
-          }],
-      }]
+  return {
+      'image': image,
+      'features': [{
+          'type': 'OBJECT_LOCALIZATION'
+      }],
   }
 
-  req = Request(endpoint)
-  req.add_header('Content-Type', 'application/json')
-  print(json.dumps(data))
-  response = urlopen(req, json.dumps(data).encode('utf-8'))
-  return json.load(response)
-
 
-def _vertices_to_np_array(vertices):
-  """Translates the vertices format in the Vision AI response to Numpy array.
+def annotate_images(annotate_requests, api_key):
+  """Sends several image requests to Google Vision API in a single call.
 
   Args:
-      vertices (Dict[str, str]): Dictionary of containing the x, y coordinates
-        for each vertex
+      annotate_requests ([Dict[str, Dict]]): one request per image
+      api_key (str): API key for Google Vision API
 
   Returns:
-      ndarray: numpy array
+      [Dict[str, Dict]]: one response per image, in the same order
   """
-  temp_array = []
-  x = 0.0
-  y = 0.0
-  for vertex in vertices:
-    if not 'x' in vertex:
-      x = 0.0
-    else:
-      x = vertex['x']
-    if not 'y' in vertex:
-      y = 0.0
-    else:
-      y = vertex['y']
 
-    temp_array.append((x, y))
+  endpoint = f'{VISION_ANNOTATE_URL}?key={api_key}'
+  data = {'requests': annotate_requests}
 
-  return np.array(temp_array)
+  body = json.dumps(data).encode('utf-8')
+  response = http_client.post(endpoint, body,
+                              headers={'Content-Type': 'application/json'})
+  metrics.VISION_CALLS.inc()
+  metrics.VISION_IMAGES.inc(len(annotate_requests))
+  metrics.TRANSFERRED_BYTES.inc(len(body), direction='out', peer='vision')
+  metrics.TRANSFERRED_BYTES.inc(len(response.data), direction='in',
+                                peer='vision')
+  return response.json()['responses']
 
 
-def _get_polygons(objects_response, width, height, threshold):
-  """Filters & Calculates the vertices according to image dimesions so they
-  could be printed.
+def localize_objects(img_url, api_key, content=None, batcher=None):
+  """Detect objects in the image using Google Vision API.
 
   Args:
-      objects_response (Dict[str, str]): the response from Google Vision API
-      width (int): width of the image in pixels
-      height (int): height of the image in pixels
-      threshold (float): threshold to use for object detection confidence level
+      img_url (str): the URL to get the image from
+      api_key (str): API key for Google Vision API
+      content (bytes, optional): encoded image to send inline instead of
+        letting the API fetch the URL. Defaults to None
+      batcher (VisionBatcher, optional): batcher to group the call with the
+        ones of other requests. Defaults to None
 
   Returns:
-      Dict[str, Dict]: JSON object containing the polygon information
+      Dict[str,Dict]: JSON object with the Vision API response
   """
-  polygons = {}
-  name_counter = {}
-  print(objects_response)
-  for localized_object in objects_response['responses'][0][
-      'localizedObjectAnnotations']:
-    normalized_vertices = localized_object['boundingPoly']['normalizedVertices']
-    name = localized_object['name'].replace(' ', '_')
-    score = localized_object['score']
-
-    if not name in OBJECT_FILTERS and score >= threshold:
-      np_vertices_array = _vertices_to_np_array(normalized_vertices)
-
-      if np_vertices_array.any():
-        if name in name_counter:
-          name_counter[name] = name_counter[name] + 1
-        else:
-          name_counter[name] = 1
-        name = f"{name}_{name_counter[name]}"
-        print(name)
-        polygons[name] = {
-            'score': localized_object['score'],
-            'vertices': np_vertices_array,
-        }
-        vertices_array = np.array([(int(vertex[0] * width),
-                                    int(vertex[1] * height))
-                                   for vertex in polygons[name]['vertices']])
-        polygons[name]['printable_vertices'] = vertices_array
-
-  return polygons
-
-
-def _generate_rounded_clip_path(polygon, vertices):
-  """Creates the HTML for the rounded clip path corresponding to a polygon.
-
-  Args:
-      polygon (str): label corresponding to the polygon
-      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+  annotate_request = build_annotate_request(img_url, content)
+  if content is None:
+    print(json.dumps(annotate_request))
+  else:
+    print(f'Sending {len(content)} bytes inline for {img_url}')
 
-  Returns:
-      str: HTML with the clip path
-  """
+  if batcher is not None:
+    return {'responses': [batcher.call(annotate_request)]}
 
-  width = vertices[1][0] - vertices[0][0]
-  height = vertices[2][1] - vertices[0][1]
+  return {'responses': annotate_images([annotate_request], api_key)}
 
-  return (f'<clipPath id="{polygon}"><rect x="{vertices[0][0]}"'
-          f' y="{vertices[0][1]}"         rx="10" ry="10" width="{width}"'
-          f' height="{height}"/></clipPath>')
 
+def encode_for_vision(image, max_side):
+  """Downscales the image and encodes it as JPEG to send it inline.
 
-def _generate_rounded_cut_layer(polygon, vertices, mode):
-  """Creates the HTML for the cut layer corresponding to a polygon.
+  The vertices in the response are normalized so they do not depend on the
+  resolution of the image sent.
 
   Args:
-      polygon (str): label corresponding to the polygon
-      vertices ([(int, int)]): array with the x,y coordintes or the vertices
-      mode (str): hover | active
+      image (ndarray): decoded image
+      max_side (int): maximum width or height in pixels
 
   Returns:
-      str: HTML with the cut layer
+      bytes: JPEG encoded image
   """
+  (h, w) = image.shape[:2]
+  if max(h, w) > max_side:
+    r = max_side / float(max(h, w))
+    image = cv2.resize(image, (max(1, int(w * r)), max(1, int(h * r))),
+                       interpolation=cv2.INTER_AREA)
 
-  count = 0
-  points = ''
-  prefix = (
-      f'#figura #area-{polygon}:{mode} ~ #capaRecorte {{ -webkit-clip-path:'
-      ' inset(')
-
-  suffix = f'round 10px);clip-path: url(#{polygon});}}'
+  if image.ndim == 3 and image.shape[2] == 4:
+    image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
 
-  for vertex in vertices:
-    if count == 0:
-      point = f'{vertex[1]}px'
-    if count == 1:
-      point = f'{vertex[0]}px'
-    if count == 2:
-      point = f'{vertex[1]}px'
-    if count == 3:
-      point = f'{vertex[0]}px'
+  return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
 
-    points = f'{points}{point} '
-    count = count + 1
 
-  return f'{prefix}{points}{suffix}'
+class VisionDetector:
+  """Detects the objects with the Google Vision API.
 
+  Every detector has a name, used for the metrics, a cache id that tells apart
+  the annotations of different backends in the annotation cache, the minimum
+  side the image is decoded to, a warm_up method getting it ready ahead of the
+  first request and a detect method returning the objects in the format of the
+  Vision API response.
+  """
 
-def _generate_rounded_tap_areas(polygon, vertices, mode):
-  """Creates the HTML for the tap areas corresponding to a polygon.
+  name = 'vision'
+  cache_id = 'vision'
 
-  Args:
-      polygon (str): label corresponding to the polygon
-      vertices ([(int, int)]): array with the x,y coordintes or the vertices
-      mode (str): hover | active
+  def __init__(self, api_key, inline_max_side=None, batcher=None):
+    """Initializes the detector.
 
-  Returns:
-      str: HTML with the cut layer
-  """
+    Args:
+        api_key (str): API key for Google Vision API
+        inline_max_side (int, optional): when set, the image is downscaled to
+          this size and sent inline instead of its URL. Defaults to None
+        batcher (VisionBatcher, optional): batcher to group the calls with the
+          ones of other requests. Defaults to None
+    """
+    self.api_key = api_key
+    self.inline_max_side = inline_max_side
+    self.batcher = batcher
 
-  count = 0
-  points = ''
-  prefix = (f'.taparea-{polygon}:{mode} ~ #capaRecorte {{ -webkit-clip-path:'
-            ' inset(')
+  @property
+  def min_side(self):
+    return self.inline_max_side or 0
 
-  suffix = f'round 10px);clip-path: url(#{polygon});}}'
+  def warm_up(self):
+    """Opens a connection to the Vision API ahead of the first request."""
+    http_client.DEFAULT_CLIENT.preconnect(VISION_ANNOTATE_URL)
 
-  for vertex in vertices:
-    if count == 0:
-      point = f'{vertex[1]}px'
-    if count == 1:
-      point = f'{vertex[0]}px'
-    if count == 2:
-      point = f'{vertex[1]}px'
-    if count == 3:
-      point = f'{vertex[0]}px'
+  def detect(self, img_url, img):
+    """Detects the objects in an image.
 
-    points = f'{points}{point} '
-    count = count + 1
+    Args:
+        img_url (str): URL of the image
+        img (ndarray): decoded image
 
-  return f'{prefix}{points}{suffix}'
+    Returns:
+        Dict[str,Dict]: JSON object with the Vision API response
+    """
+    content = None
+    if self.inline_max_side:
+      content = encode_for_vision(img, self.inline_max_side)
+    return localize_objects(img_url, self.api_key, content, self.batcher)
 
 
-def _generate_exit_metrics(polygon):
-  """Creates the HTML for the exit metrics for each object
+def _vertices_to_np_array(vertices):
+  """Translates the vertices format in the Vision AI response to Numpy array.
 
   Args:
-      polygon (str): label corresponding to the polygon
-      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+      vertices (Dict[str, str]): Dictionary of containing the x, y coordinates
+        for each vertex
 
   Returns:
-      str: HTML with the svg circles
+      ndarray: numpy array
   """
-  return f'<gwd-metric-event id="exit-metric-{polygon}" source="gwd-taparea-{polygon} event="tapareaexit" metric="" exit="Exit"></gwd-metric-event>'
+  return np.array([(vertex.get('x', 0.0), vertex.get('y', 0.0))
+                   for vertex in vertices],
+                  dtype=float).reshape(-1, 2)
 
 
-def _generate_circles(polygon, vertices):
-  """Creates the HTML for the cut svg circles corresponding to a polygon
+def _annotations_to_arrays(objects_response):
+  """Translates the objects in the Vision AI response to Numpy arrays.
 
   Args:
-      polygon (str): label corresponding to the polygon
-      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+      objects_response (Dict[str, str]): the response from Google Vision API
 
   Returns:
-      str: HTML with the svg circles
+      ([str], ndarray, ndarray): label of every object, N scores and N x 4 x 2
+      normalized vertices
   """
-
-  outer_circle = (
-      f'<circle id="outer-circle-{polygon}" class="outer-circle"'
-      f' cx="{vertices[1][0] - 10}" cy="{vertices[1][1] + 10}" r="10"'
-      ' stroke="white"  stroke-width="1" fill=none />')
-  inner_circle = (
-      f'<circle id="inner-circle-{polygon}" class="inner-circle"'
-      f' cx="{vertices[1][0] - 10}" cy="{vertices[1][1] + 10}" r="5"'
-      ' stroke="white" stroke-width="1" fill="white" />')
-
-  return f'{outer_circle}{inner_circle}'
-
-
-def _generate_map_area(polygon, vertices):
-  """Creates the HTML for the map area corresponding to a polygon
+  annotations = objects_response['responses'][0].get(
+      'localizedObjectAnnotations', [])
+
+  names = [annotation['name'].replace(' ', '_') for annotation in annotations]
+  scores = np.array([annotation['score'] for annotation in annotations],
+                    dtype=float)
+  vertices = np.zeros((len(annotations), 4, 2))
+  for index, annotation in enumerate(annotations):
+    object_vertices = _vertices_to_np_array(
+        annotation['boundingPoly']['normalizedVertices'])
+    if object_vertices.shape[0] == 4:
+      vertices[index] = object_vertices
+    elif object_vertices.shape[0]:
+      # Keep the bounding box of any other shape, in the Vision vertex order.
+      (x0, y0) = object_vertices.min(axis=0)
+      (x1, y1) = object_vertices.max(axis=0)
+      vertices[index] = ((x0, y0), (x1, y0), (x1, y1), (x0, y1))
+
+  return (names, scores, vertices)
+
+
+def get_polygons(objects_response, width, height, threshold, crop=None):
+  """Filters & Calculates the vertices according to image dimesions so they
+  could be printed.
 
   Args:
-      polygon (str): label corresponding to the polygon
-      vertices ([(int, int)]): array with the x,y coordintes or the vertices
+      objects_response (Dict[str, str]): the response from Google Vision API
+      width (int): width of the image in pixels
+      height (int): height of the image in pixels
+      threshold (float): threshold to use for object detection confidence level
+      crop ((float, float, float, float), optional): normalized x0, y0, x1, y1
+        of the region of the original image shown in the creative. Defaults to
+        None, the whole image
 
   Returns:
-      str: HTML with the map area
+      Polygons: the polygons found in the image
   """
-  tap_area_prefix = (
-      f'<gwd-taparea id="gwd-taparea-{polygon}" class="taparea-{polygon}">')
+  print(objects_response)
+  (names, scores, vertices) = _annotations_to_arrays(objects_response)
+  (labels, label_ids) = np.unique(np.array(names, dtype=str),
+                                  return_inverse=True)
+  label_ids = label_ids.reshape(-1)
 
-  tap_area_suffix = '</gwd-taparea>'
+  keep = ((scores >= threshold) & ~np.isin(labels[label_ids], OBJECT_FILTERS) &
+          vertices.any(axis=(1, 2)))
 
-  map_area_prefix = (
-      f'<area id="area-{polygon}" shape="poly" title="{polygon}" coords="')
-  map_area_suffix = f'" target="_blank">'
-  count = 0
-  points = ''
+  if crop is not None:
+    crop = np.asarray(crop, dtype=float)
+    vertices = np.clip((vertices - crop[:2]) / (crop[2:] - crop[:2]), 0.0, 1.0)
+    keep &= np.ptp(vertices, axis=1).min(axis=1) > 0
 
-  for vertex in vertices:
-    point = f'{vertex[0]},{vertex[1]}'
-    if count < vertices.shape[0] - 1:
-      points = f'{points}{point},'
-    else:
-      points = f'{points}{point}'
-    count = count + 1
+  scores = scores[keep]
+  label_ids = label_ids[keep]
+  vertices = vertices[keep]
+
+  # Number the objects of every label in order of appearance: Shoe_1, Shoe_2
+  occurrences = np.cumsum(
+      label_ids[:, np.newaxis] == np.arange(len(labels)), axis=0)
+  counters = occurrences[np.arange(len(label_ids)), label_ids]
+  names = [
+      f'{labels[label_id]}_{counter}'
+      for label_id, counter in zip(label_ids, counters)
+  ]
 
-  return f'{tap_area_prefix}{map_area_prefix}{points}{map_area_suffix}{tap_area_suffix}'
+  printable_vertices = (vertices * (width, height)).astype(int)
 
+  return Polygons(names, scores, label_ids, labels, vertices,
+                  printable_vertices)
 
-def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
+
+def image_resize(image, width=None, height=None, inter=None):
   """Modifies the image according to the given width and height.
 
   Args:
       image (bytearray): image content
       width (int, optional): width in pixels. Defaults to None
       height (int, optional): height in pixels. Defaults to None
-      inter (int, optional): cv2 interpolation method
+      inter (int, optional): cv2 interpolation method. Defaults to None,
+        cv2.INTER_AREA
 
   Returns:
       bytearray: transformed image content
@@ -326,6 +346,8 @@ def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
     dim = (width, int(h * r))
 
   # resize the image
+  if inter is None:
+    inter = cv2.INTER_AREA
   resized = cv2.resize(image, dim, fx=1, fy=1, interpolation=inter)
 
   # return the resized image
@@ -335,77 +357,309 @@ def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
 def generate_html5_parts(polygons):
   """Builds all the HTML5 parts according to the detected polygons in the image
 
+  The coordinates of every polygon are formatted once and all the fragments are
+  written in a single pass, ready to be inserted in the templates.
+
   Args:
-      polygons (Dict[str, Dict]): polygons detected by Google Vision API
+      polygons (Polygons): polygons detected by Google Vision API
 
   Returns:
-      ([str], [str], [str], [str], [str]): arrays with the HTML5 strings for
-      clip paths cut layers, map areas, object names and circles
+      Html5Parts: HTML5 strings for clip paths, map areas, tap areas, exit
+      metrics, cut layers, object names and circles
   """
-  clip_paths = []
-  map_areas = []
-  tap_areas_hover = []
-  tap_areas_active = []
-  exit_metrics = []
-  cut_layers_hover = []
-  cut_layers_active = []
-  object_names = []
-  circles = []
-
-  for polygon in polygons:
-    print(polygon)
-    object_names.append(f'"{str(polygon)}"')
-    clip_paths.append(
-        _generate_rounded_clip_path(polygon,
-                                    polygons[polygon]['printable_vertices']))
-    map_areas.append(
-        _generate_map_area(polygon, polygons[polygon]['printable_vertices']))
-    tap_areas_hover.append(
-        _generate_rounded_tap_areas(polygon,
-                                    polygons[polygon]['printable_vertices'],
-                                    'hover'))
-    tap_areas_active.append(
-        _generate_rounded_tap_areas(polygon,
-                                    polygons[polygon]['printable_vertices'],
-                                    'active'))
-
-    exit_metrics.append(_generate_exit_metrics(polygon))
-
-    cut_layers_hover.append(
-        _generate_rounded_cut_layer(polygon,
-                                    polygons[polygon]['printable_vertices'],
-                                    'hover'))
-    cut_layers_active.append(
-        _generate_rounded_cut_layer(polygon,
-                                    polygons[polygon]['printable_vertices'],
-                                    'active'))
-    circles.append(
-        _generate_circles(polygon, polygons[polygon]['printable_vertices']))
-
-  return (clip_paths, map_areas, tap_areas_hover, tap_areas_active,
-          exit_metrics, cut_layers_hover, cut_layers_active, object_names,
-          circles)
-
-
-def _upload_file_to_gcs(file_url, file_name, bucket_name):
+  count = len(polygons.names)
+  clip_paths = [''] * count
+  map_areas = [''] * count
+  tap_areas_hover = [''] * count
+  tap_areas_active = [''] * count
+  exit_metrics = [''] * count
+  cut_layers_hover = [''] * count
+  cut_layers_active = [''] * count
+  object_names = [''] * count
+  circles = [''] * count
+
+  for index, (polygon, vertices) in enumerate(
+      zip(polygons.names, polygons.printable_vertices.tolist())):
+    ((x0, y0), (x1, y1), (x2, y2), (x3, y3)) = vertices
+    inset = (f' ~ #capaRecorte {{ -webkit-clip-path: inset({y0}px {x1}px'
+             f' {y2}px {x3}px round 10px);clip-path: url(#{polygon});}}')
+    cx = x1 - 10
+    cy = y1 + 10
+
+    object_names[index] = f'"{polygon}"'
+    clip_paths[index] = (
+        f'<clipPath id="{polygon}"><rect x="{x0}" y="{y0}"         rx="10"'
+        f' ry="10" width="{x1 - x0}" height="{y2 - y0}"/></clipPath>')
+    map_areas[index] = (
+        f'<gwd-taparea id="gwd-taparea-{polygon}" class="taparea-{polygon}">'
+        f'<area id="area-{polygon}" shape="poly" title="{polygon}"'
+        f' coords="{x0},{y0},{x1},{y1},{x2},{y2},{x3},{y3}"'
+        ' target="_blank"></gwd-taparea>')
+    tap_areas_hover[index] = f'.taparea-{polygon}:hover{inset}'
+    tap_areas_active[index] = f'.taparea-{polygon}:active{inset}'
+    exit_metrics[index] = (
+        f'<gwd-metric-event id="exit-metric-{polygon}"'
+        f' source="gwd-taparea-{polygon} event="tapareaexit" metric=""'
+        ' exit="Exit"></gwd-metric-event>')
+    cut_layers_hover[index] = f'#figura #area-{polygon}:hover{inset}'
+    cut_layers_active[index] = f'#figura #area-{polygon}:active{inset}'
+    circles[index] = (
+        f'<circle id="outer-circle-{polygon}" class="outer-circle"'
+        f' cx="{cx}" cy="{cy}" r="10" stroke="white"  stroke-width="1"'
+        f' fill=none /><circle id="inner-circle-{polygon}"'
+        f' class="inner-circle" cx="{cx}" cy="{cy}" r="5" stroke="white"'
+        ' stroke-width="1" fill="white" />')
+
+  return Html5Parts(
+      clip_paths='\n'.join(clip_paths),
+      map_areas='\n'.join(map_areas),
+      tap_areas_hover='\n'.join(tap_areas_hover),
+      tap_areas_active='\n'.join(tap_areas_active),
+      exit_metrics='\n'.join(exit_metrics),
+      cut_layers_hover='\n'.join(cut_layers_hover),
+      cut_layers_active='\n'.join(cut_layers_active),
+      object_names=','.join(object_names),
+      circles='\n'.join(circles),
+  )
+
+
+def _js_string(value):
+  """Quotes a value as a JavaScript string that can go inside a script tag."""
+  return json.dumps(value).replace('</', '<\\/')
+
+
+def generate_exit_scripts(exits):
+  """Builds the scripts sending the clicks on the tap areas to their URLs.
+
+  It is the server side version of what the editor does in the browser when
+  the URLs are filled in, see modifyElements in build_creative.html.
+
+  Args:
+      exits ([(str, str)]): name of every object, or default for the whole
+        creative, and the URL it leads to
+
+  Returns:
+      ExitScripts: contents of the handler-functions, handlers-registration
+      and studio-exports scripts
+  """
+  handlers = ['window.gwd = window.gwd || {};']
+  register = ['gwd.actions.events.registerEventHandlers = function(event) {']
+  deregister = [
+      'gwd.actions.events.deregisterEventHandlers = function(event) {'
+  ]
+  studio_exports = ['function StudioExports() {']
+  for (name, url) in exits:
+    # Labels can have spaces, i.e: Top hat_1.
+    handler = f'gwd[{_js_string(f"auto_Taparea_{name}Click")}]'
+    exit_id = _js_string(f'exit-{name}')
+    tap_area = _js_string(f'gwd-taparea-{name}')
+    handlers.append(
+        f'{handler} = function(event) {{ event.preventDefault();'
+        'event.stopPropagation();event.cancelBubble = true;'
+        f"gwd.actions.gwdGoogleAd.exit('gwd-ad', {exit_id}, {_js_string(url)},"
+        " true, true, 'page1');};")
+    for event in ('click', 'touchend'):
+      register.append(f'gwd.actions.events.addHandler({tap_area}, '
+                      f"'{event}', {handler}, false);")
+      deregister.append(f'gwd.actions.events.removeHandler({tap_area}, '
+                        f"'{event}', {handler}, false);")
+    studio_exports.append(f'Enabler.exit({exit_id},{_js_string(url)});')
+
+  return ExitScripts(
+      handler_functions=''.join(handlers),
+      handlers_registration=(
+          ''.join(register) + '};' + ''.join(deregister) + '};'
+          'document.addEventListener("DOMContentLoaded",'
+          ' gwd.actions.events.registerEventHandlers);'
+          'document.addEventListener("unload",'
+          ' gwd.actions.events.deregisterEventHandlers);'),
+      studio_exports=''.join(studio_exports) + '}',
+  )
+
+
+def upload_file_to_gcs(content, file_name, bucket_name, content_type):
   """Uploads the file to Google Cloud Storage.
 
   Args:
-      file_url (str): URL to get the file from
+      content (bytes): content of the file
       file_name (str): name of the file to use in Google Cloud Storage
       bucket_name (str): name of the Google Cloud Storage bucket
+      content_type (str): content type of the file
 
   Returns:
       str: the URL for the resulting Google Cloud Storage blob
   """
-  storage_client = storage.Client()
-  bucket = storage_client.bucket(bucket_name)
-  blob = bucket.blob(file_name)
-  blob.upload_from_filename(file_url)
+  blob = get_storage_manager(bucket_name).blob(file_name)
+  with metrics.span('upload'):
+    blob.upload_from_string(content, content_type=content_type)
+  metrics.TRANSFERRED_BYTES.inc(len(content), direction='out', peer='gcs')
 
   return f'https://storage.cloud.google.com/{bucket_name}/{file_name}'
 
 
+def download_image(img_url):
+  """Downloads the source image and checks it is not too big to decode.
+
+  The size is read from the header of the image, formats it can not be read
+  from are left to the limits of OpenCV.
+
+  Args:
+      img_url (str): URL to get the image from
+
+  Returns:
+      bytearray: content of the image
+  """
+  with metrics.span('download'):
+    img_content = http_client.get(img_url,
+                                  max_bytes=MAX_IMAGE_DOWNLOAD_BYTES).data
+  metrics.TRANSFERRED_BYTES.inc(len(img_content), direction='in',
+                                peer='image')
+  check_image_size(img_content)
+  return img_content
+
+
+def check_image_size(img_content):
+  """Refuses the images over the pixel limit before they are decoded.
+
+  Args:
+      img_content (bytes): content of the image
+  """
+  size = image_codec.image_size(img_content)
+  if size is not None and size[0] * size[1] > MAX_IMAGE_PIXELS:
+    raise Exception(f'The image is {size[0]}x{size[1]}, over the limit of'
+                    f' {MAX_IMAGE_PIXELS} pixels')
+
+
+def get_objects(img_url, img_content, img, detector, annotation_cache):
+  """Gets the objects in the image from the cache or the detector.
+
+  Args:
+      img_url (str): URL of the image
+      img_content (bytes): content of the image
+      img (ndarray): decoded image
+      detector (VisionDetector or DnnDetector): backend detecting the objects
+      annotation_cache (AnnotationCache): cache for the detector responses
+
+  Returns:
+      Dict[str,Dict]: JSON object in the format of the Vision API response
+  """
+  objects = None
+  if annotation_cache is not None:
+    cache_key = annotation_cache.make_key(img_url, img_content,
+                                          detector.cache_id)
+    objects = annotation_cache.get(cache_key)
+
+  if objects is None:
+    if annotation_cache is not None:
+      metrics.ANNOTATION_CACHE.inc(result='miss')
+    with metrics.span(detector.name):
+      objects = detector.detect(img_url, img)
+
+    if 'error' in objects['responses'][0]:
+      raise Exception(
+          f"Error detecting the objects: {objects['responses'][0]['error']['message']}"
+      )
+
+    if annotation_cache is not None:
+      annotation_cache.put(cache_key, objects)
+  else:
+    metrics.ANNOTATION_CACHE.inc(result='hit')
+    print(f'Using cached objects for {img_url}')
+
+  return objects
+
+
+def output_name(img_name, output_format=None):
+  """Chooses the format of the saved image and fixes its extension to match.
+
+  Args:
+      img_name (str): name of the source image
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+
+  Returns:
+      (str, str): name of the saved image and its format
+  """
+  image_format = image_codec.format_for(output_format or img_name)
+  (stem, extension) = os.path.splitext(img_name)
+  if image_codec.format_for(extension) != image_format:
+    img_name = f'{stem}{image_codec.extension_for(image_format)}'
+  return (img_name, image_format)
+
+
+def _encode_image(img, img_name, output_format=None, max_image_bytes=None):
+  """Encodes the image in its output format.
+
+  Args:
+      img (ndarray): image to encode
+      img_name (str): name of the source image
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+      max_image_bytes (int, optional): maximum size of the encoded image.
+        Defaults to None, no limit
+
+  Returns:
+      (str, bytes): name of the image with the extension of the format and
+      the encoded image
+  """
+  (img_name, image_format) = output_name(img_name, output_format)
+  with metrics.span('encode'):
+    (encoded_img, _) = image_codec.encode_within_budget(img, image_format,
+                                                        max_image_bytes)
+  return (img_name, encoded_img)
+
+
+def _store_image(encoded_img, img_name, tmp_dir, local, bucket):
+  """Stores an encoded image locally or in Google Cloud Storage.
+
+  Args:
+      encoded_img (bytes): the encoded image
+      img_name (str): name of the image file
+      tmp_dir (str): temporary directory to store the image, or folder of
+        the blob in Google Cloud Storage
+      local (boolean): describes if the server is running on localhost
+      bucket (str): Name of the Google Cloud Storage
+
+  Returns:
+      str: URL of the saved image or name of the blob
+  """
+  if not local:
+    blob_name = f'{tmp_dir}/{img_name}'
+    upload_file_to_gcs(
+        encoded_img, blob_name, bucket,
+        image_codec.content_type_for(image_codec.format_for(img_name)))
+    return blob_name
+
+  new_img_url = f'{tmp_dir}/{img_name}'
+  with metrics.span('write'), open(new_img_url, 'wb') as f:
+    f.write(encoded_img)
+  return f'/{new_img_url}'
+
+
+def _save_image(img, img_name, tmp_dir, local, bucket, output_format=None,
+                max_image_bytes=None):
+  """Encodes the image and stores it locally or in Google Cloud Storage.
+
+  Args:
+      img (ndarray): image to save
+      img_name (str): name of the image file
+      tmp_dir (str): temporary directory to store the image
+      local (boolean): describes if the server is running on localhost
+      bucket (str): Name of the Google Cloud Storage
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+      max_image_bytes (int, optional): maximum size of the encoded image.
+        Defaults to None, no limit
+
+  Returns:
+      (str, str, bytes): URL of the saved image, its name and the encoded image
+  """
+  (img_name, encoded_img) = _encode_image(img, img_name, output_format,
+                                          max_image_bytes)
+  new_img_url = _store_image(encoded_img, img_name, tmp_dir, local, bucket)
+  return (new_img_url, img_name, encoded_img)
+
+
 def detect_objects(
     img_url,
     tmp_dir,
@@ -415,67 +669,312 @@ def detect_objects(
     local,
     api_key,
     bucket=None,
+    annotation_cache=None,
+    inline_max_side=None,
+    vision_batcher=None,
+    output_format=None,
+    max_image_bytes=None,
+    progress=None,
+    detector=None,
 ):
   """Detects all the objects in the image.
 
+  With both a width and a height, the image is cropped around the detected
+  objects and resized to exactly that size, see render_sizes. With only a
+  width, it is resized to that width.
+
   Args:
       img_url (str): URL to get the image from
       tmp_dir (str): temporary directory to store the image
       threshold (float): confidence level for object detection
       desired_width (int): desired image width in pixels
-      desired_height (int): desired image height in pixels
+      desired_height (int): desired image height in pixels, 0 to keep the
+        aspect ratio of the image
       local (boolean): describes if the server is running on localhost
       api_key (str): key for the Google Vision API
       bucket (str, optional): Name of the Google Cloud Storage. Defaults to None
+      annotation_cache (AnnotationCache, optional): cache for the Vision API
+        responses. Defaults to None
+      inline_max_side (int, optional): when set, the downloaded image is
+        downscaled to this size and sent inline to the Vision API instead of
+        its URL. Defaults to None
+      vision_batcher (VisionBatcher, optional): batcher for the Vision API
+        calls. Defaults to None
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+      max_image_bytes (int, optional): maximum size of the encoded image, the
+        quality is lowered to fit. Defaults to None, no limit
+      progress (Callable, optional): called with the name of every stage as it
+        starts. Defaults to None
+      detector (VisionDetector or DnnDetector, optional): backend detecting
+        the objects. Defaults to None, the Vision API with the key, inline
+        size and batcher above
 
   Returns:
       (str,
        str,
        int,
        int,
-       Dict[str,Dict]): the generated URL after saving the image in the server,
-       name of the image, image width, image height and the polygons found in
-       the image
+       Polygons,
+       bytes): the generated URL after saving the image in the server, name of
+       the image, image width, image height, the polygons found in the image
+       and the encoded image
   """
-  headers = {
-      'User-Agent':
-          ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like'
-           ' Gecko) Chrome/23.0.1271.64 Safari/537.11'),
-      'Accept':
-          'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-      'Accept-Encoding':
-          'gzip, deflate, br',
-      'Accept-Language':
-          'en-US,en;q=0.9,es;q=0.8',
-      'Connection':
-          'keep-alive',
-  }
-  del desired_height
-  objects = localize_objects(img_url, api_key)
+  if progress is None:
+    progress = lambda stage: None
+  if detector is None:
+    detector = VisionDetector(api_key, inline_max_side, vision_batcher)
+
+  progress('downloading')
+  img_content = download_image(img_url)
+
+  with metrics.span('decode'):
+    if desired_width and desired_height:
+      img = decode_for_sizes(img_content, [(desired_width, desired_height)],
+                             detector.min_side)
+    elif desired_width:
+      # Big enough for the creative and for the image the detector sees.
+      img = image_codec.decode_image(img_content, min_width=desired_width,
+                                     min_side=detector.min_side)
+    else:
+      img = image_codec.decode_image(img_content)
 
-  if 'error' in objects['responses'][0]:
-    raise Exception(
-        f"Error detecting the objects: {objects['responses'][0]['error']['message']}"
-    )
+  progress('detecting')
+  objects = get_objects(img_url, img_content, img, detector, annotation_cache)
 
-  req = Request(img_url, headers=headers)
-  resp = urlopen(req)
-  arr = np.asarray(bytearray(resp.read()), dtype=np.uint8)
-  img = cv2.imdecode(arr, -1)
+  progress('resizing')
+  if desired_width and desired_height:
+    [(img_name, width, height, polygons, encoded_img)] = render_sizes(
+        img, objects, threshold, [(desired_width, desired_height)],
+        img_url.split('/')[-1], output_format, max_image_bytes)
+    progress('saving')
+    new_img_url = _store_image(encoded_img, img_name, tmp_dir, local, bucket)
+    return (new_img_url, img_name, width, height, polygons, encoded_img)
 
   if desired_width:
-    img = image_resize(img, width=desired_width)
+    with metrics.span('resize'):
+      img = image_resize(img, width=desired_width)
+  progress('saving')
   img_name = img_url.split('/')[-1]
-  new_img_url = f'{tmp_dir}/{img_name}'
-  cv2.imwrite(new_img_url, img)
+  (new_img_url, img_name, encoded_img) = _save_image(img, img_name, tmp_dir,
+                                                     local, bucket,
+                                                     output_format,
+                                                     max_image_bytes)
   height, width = img.shape[:2]
 
-  polygons = _get_polygons(objects, width, height, float(threshold))
+  with metrics.span('polygons'):
+    polygons = get_polygons(objects, width, height, float(threshold))
 
-  if not local:
-    _upload_file_to_gcs(new_img_url, img_name, bucket)
-    new_img_url = img_name
-  else:
-    new_img_url = f'/{new_img_url}'
+  return (new_img_url, img_name, width, height, polygons, encoded_img)
+
+
+def _get_crop_box(objects_response, threshold, img_width, img_height, width,
+                  height):
+  """Chooses the region of the image to keep for a creative size.
+
+  The image is scaled to cover the whole creative and the region is centered on
+  the detected objects, or on the best scored one when they do not all fit.
+
+  Args:
+      objects_response (Dict[str, str]): the response from Google Vision API
+      threshold (float): threshold to use for object detection confidence level
+      img_width (int): width of the original image in pixels
+      img_height (int): height of the original image in pixels
+      width (int): width of the creative in pixels
+      height (int): height of the creative in pixels
+
+  Returns:
+      (int, int, int, int): x0, y0, x1, y1 of the region in pixels
+  """
+  scale = max(width / img_width, height / img_height)
+  crop_width = min(img_width, max(1, int(round(width / scale))))
+  crop_height = min(img_height, max(1, int(round(height / scale))))
+
+  (names, scores, vertices) = _annotations_to_arrays(objects_response)
+  keep = ((scores >= threshold) & ~np.isin(names, OBJECT_FILTERS) &
+          vertices.any(axis=(1, 2)))
+  scores = scores[keep]
+  box_min = vertices[keep].min(axis=1)
+  box_max = vertices[keep].max(axis=1)
+
+  center = np.array((0.5, 0.5))
+  if keep.any():
+    union_min = box_min.min(axis=0)
+    union_max = box_max.max(axis=0)
+    center = (union_min + union_max) / 2
+    best = np.argmax(scores)
+    best_center = (box_min[best] + box_max[best]) / 2
+    if (union_max[0] - union_min[0]) * img_width > crop_width:
+      center[0] = best_center[0]
+    if (union_max[1] - union_min[1]) * img_height > crop_height:
+      center[1] = best_center[1]
+
+  x0 = int(round(center[0] * img_width - crop_width / 2))
+  y0 = int(round(center[1] * img_height - crop_height / 2))
+  x0 = min(max(x0, 0), img_width - crop_width)
+  y0 = min(max(y0, 0), img_height - crop_height)
+
+  return (x0, y0, x0 + crop_width, y0 + crop_height)
+
+
+def detect_objects_multi_size(
+    img_url,
+    tmp_dir,
+    threshold,
+    sizes,
+    local,
+    api_key,
+    bucket=None,
+    annotation_cache=None,
+    inline_max_side=None,
+    vision_batcher=None,
+    output_format=None,
+    max_image_bytes=None,
+    detector=None,
+):
+  """Detects all the objects in the image once and renders every size.
+
+  Each size is cropped from the single decoded image, around the detected
+  objects, and resized to exactly width x height.
+
+  Args:
+      img_url (str): URL to get the image from
+      tmp_dir (str): temporary directory to store the images
+      threshold (float): confidence level for object detection
+      sizes ([(int, int)]): creative sizes as width, height in pixels
+      local (boolean): describes if the server is running on localhost
+      api_key (str): key for the Google Vision API
+      bucket (str, optional): Name of the Google Cloud Storage. Defaults to None
+      annotation_cache (AnnotationCache, optional): cache for the Vision API
+        responses. Defaults to None
+      inline_max_side (int, optional): when set, the downloaded image is
+        downscaled to this size and sent inline to the Vision API instead of
+        its URL. Defaults to None
+      vision_batcher (VisionBatcher, optional): batcher for the Vision API
+        calls. Defaults to None
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+      max_image_bytes (int, optional): maximum size of the encoded image, the
+        quality is lowered to fit. Defaults to None, no limit
+      detector (VisionDetector or DnnDetector, optional): backend detecting
+        the objects. Defaults to None, the Vision API with the key, inline
+        size and batcher above
+
+  Returns:
+      [(str, str, int, int, Polygons, bytes)]: for every size, the same
+      values returned by detect_objects
+  """
+  if detector is None:
+    detector = VisionDetector(api_key, inline_max_side, vision_batcher)
+  img_content = download_image(img_url)
+
+  with metrics.span('decode'):
+    img = decode_for_sizes(img_content, sizes, detector.min_side)
+
+  objects = get_objects(img_url, img_content, img, detector, annotation_cache)
+
+  results = []
+  for (img_name, width, height, polygons,
+       encoded_img) in render_sizes(img, objects, threshold, sizes,
+                                    img_url.split('/')[-1], output_format,
+                                    max_image_bytes):
+    new_img_url = _store_image(encoded_img, img_name, tmp_dir, local, bucket)
+    results.append(
+        (new_img_url, img_name, width, height, polygons, encoded_img))
 
-  return (new_img_url, img_name, width, height, polygons)
+  return results
+
+
+def decode_for_sizes(img_content, sizes, min_side=0):
+  """Decodes the image big enough to crop every creative size from it.
+
+  Args:
+      img_content (bytes): content of the image
+      sizes ([(int, int)]): creative sizes as width, height in pixels
+      min_side (int, optional): minimum longest side, i.e: the one of the
+        detector. Defaults to 0
+
+  Returns:
+      ndarray: the decoded image
+  """
+  return image_codec.decode_image(
+      img_content,
+      min_width=max((width for (width, _) in sizes), default=0),
+      min_height=max((height for (_, height) in sizes), default=0),
+      min_side=min_side,
+  )
+
+
+def render_sizes(img, objects, threshold, sizes, img_name, output_format=None,
+                 max_image_bytes=None):
+  """Crops, resizes and encodes the image for every creative size.
+
+  Each size is cropped around the detected objects and resized to exactly
+  width x height. It only takes plain values, so it can run in a worker
+  process.
+
+  Args:
+      img (ndarray): decoded image, it covers all the sizes
+      objects (Dict[str, str]): the response from Google Vision API
+      threshold (float): confidence level for object detection
+      sizes ([(int, int)]): creative sizes as width, height in pixels
+      img_name (str): name of the source image
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+      max_image_bytes (int, optional): maximum size of the encoded image, the
+        quality is lowered to fit. Defaults to None, no limit
+
+  Returns:
+      [(str, int, int, Polygons, bytes)]: for every size, the name of the
+      image, its width and height, the polygons and the encoded image
+  """
+  threshold = float(threshold)
+  (img_height, img_width) = img.shape[:2]
+  (stem, extension) = os.path.splitext(img_name)
+
+  results = []
+  for (width, height) in sizes:
+    (x0, y0, x1, y1) = _get_crop_box(objects, threshold, img_width,
+                                     img_height, width, height)
+    # The crop is a view on the decoded image, only the resize copies pixels.
+    with metrics.span('resize'):
+      resized = cv2.resize(img[y0:y1, x0:x1], (width, height),
+                           interpolation=cv2.INTER_AREA)
+    (size_img_name, encoded_img) = _encode_image(
+        resized, f'{stem}_{width}x{height}{extension}', output_format,
+        max_image_bytes)
+    crop = np.array((x0 / img_width, y0 / img_height, x1 / img_width,
+                     y1 / img_height))
+    with metrics.span('polygons'):
+      polygons = get_polygons(objects, width, height, threshold, crop)
+    results.append((size_img_name, width, height, polygons, encoded_img))
+
+  return results
+
+
+def decode_and_render_sizes(img_content, objects, threshold, sizes, img_name,
+                            output_format=None, max_image_bytes=None):
+  """Decodes the image and renders every creative size in a single call.
+
+  Only the content of the image goes in and only the encoded images come out,
+  the decoded image never leaves the worker process running it.
+
+  Args:
+      img_content (bytes): content of the image
+      objects (Dict[str, str]): the response from Google Vision API
+      threshold (float): confidence level for object detection
+      sizes ([(int, int)]): creative sizes as width, height in pixels
+      img_name (str): name of the source image
+      output_format (str, optional): jpeg, webp or png. Defaults to None, the
+        format of the source image
+      max_image_bytes (int, optional): maximum size of the encoded image, the
+        quality is lowered to fit. Defaults to None, no limit
+
+  Returns:
+      [(str, int, int, Polygons, bytes)]: for every size, the same values
+      returned by render_sizes
+  """
+  with metrics.span('decode'):
+    img = decode_for_sizes(img_content, sizes)
+  return render_sizes(img, objects, threshold, sizes, img_name, output_format,
+                      max_image_bytes)
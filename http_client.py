@@ -0,0 +1,364 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import http.client
+import json
+import os
+import threading
+from urllib import parse
+import zlib
+
+DEFAULT_HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like'
+        ' Gecko) Chrome/23.0.1271.64 Safari/537.11'
+    ),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept-Language': 'en-US,en;q=0.9,es;q=0.8',
+    'Connection': 'keep-alive',
+}
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class HttpError(Exception):
+  """Raised when the server answers with an error status."""
+
+  def __init__(self, url, status, reason, data):
+    super().__init__(f'HTTP Error {status}: {reason} ({url})')
+    self.url = url
+    self.status = status
+    self.reason = reason
+    self.data = data
+
+
+class ResponseTooLarge(Exception):
+  """Raised when the body of the response is over the allowed size."""
+
+  def __init__(self, url, max_bytes):
+    super().__init__(f'The response of {url} is over {max_bytes} bytes')
+    self.url = url
+    self.max_bytes = max_bytes
+
+
+class HttpResponse:
+  """Response of a request, with the body already read and decoded."""
+
+  def __init__(self, url, status, headers, data):
+    self.url = url
+    self.status = status
+    self.headers = headers
+    self.data = data
+
+  def json(self):
+    """Parses the body as JSON.
+
+    Returns:
+        object: the parsed body
+    """
+    return json.loads(self.data)
+
+
+def _decode(data, content_encoding, max_length=0):
+  """Decompresses the body according to its Content-Encoding.
+
+  Args:
+      data (bytes): body as received
+      content_encoding (str): value of the Content-Encoding header
+      max_length (int, optional): maximum number of bytes to decompress, the
+        rest is dropped. Defaults to 0, no limit
+
+  Returns:
+      bytes: decompressed body
+  """
+  content_encoding = (content_encoding or '').strip().lower()
+  if content_encoding in ('gzip', 'x-gzip'):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data, max_length)
+  if content_encoding == 'deflate':
+    try:
+      return zlib.decompressobj().decompress(data, max_length)
+    except zlib.error:
+      # Some servers send raw deflate data without the zlib header.
+      return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, max_length)
+  return data
+
+
+def _read_body(response, url, max_bytes):
+  """Reads the body into a single buffer, up to a maximum size.
+
+  The buffer is allocated once when the server sends the Content-Length and
+  doubled as needed otherwise, the body is never copied around in chunks.
+
+  Args:
+      response (HTTPResponse): response with the body still unread
+      url (str): URL of the request
+      max_bytes (int): maximum size of the body
+
+  Returns:
+      bytearray: the body
+  """
+  length = response.getheader('Content-Length')
+  length = int(length) if length and length.isdigit() else None
+  if length is not None and length > max_bytes:
+    raise ResponseTooLarge(url, max_bytes)
+
+  buffer = bytearray(
+      length if length is not None else min(READ_CHUNK_SIZE, max_bytes + 1))
+  received = 0
+  while True:
+    if received == len(buffer):
+      if length is not None or received > max_bytes:
+        break
+      buffer.extend(bytearray(min(received, max_bytes + 1 - received)))
+    with memoryview(buffer) as view:
+      count = response.readinto(view[received:])
+    if not count:
+      break
+    received += count
+
+  if received > max_bytes:
+    raise ResponseTooLarge(url, max_bytes)
+  del buffer[received:]
+  return buffer
+
+
+class HttpClient:
+  """HTTP client keeping a pool of keep-alive connections per host."""
+
+  def __init__(self, pool_size=4, timeout=30, max_redirects=5):
+    """Initializes the client.
+
+    Args:
+        pool_size (int, optional): maximum number of idle connections kept
+          per host. Defaults to 4
+        timeout (float, optional): connect and read timeout in seconds.
+          Defaults to 30
+        max_redirects (int, optional): maximum number of redirects to follow.
+          Defaults to 5
+    """
+    self.pool_size = pool_size
+    self.timeout = timeout
+    self.max_redirects = max_redirects
+    self._pools = {}
+    self._pid = os.getpid()
+    self._lock = threading.Lock()
+
+  def _acquire(self, scheme, host, port):
+    """Returns an idle connection to the host or a new one.
+
+    Args:
+        scheme (str): http or https
+        host (str): host name
+        port (int): port number
+
+    Returns:
+        (HTTPConnection, bool): the connection and whether it was reused
+    """
+    with self._lock:
+      if self._pid != os.getpid():
+        # Connections inherited from the parent process can not be shared.
+        self._pools = {}
+        self._pid = os.getpid()
+      pool = self._pools.get((scheme, host, port))
+      if pool:
+        return (pool.pop(), True)
+
+    if scheme == 'https':
+      connection = http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+    else:
+      connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+    return (connection, False)
+
+  def preconnect(self, url):
+    """Opens a connection to the host of a URL and keeps it in the pool.
+
+    The DNS lookup, TCP and TLS handshakes are then done before the first
+    request to the host.
+
+    Args:
+        url (str): any URL on the host
+    """
+    parts = parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    port = parts.port or (443 if scheme == 'https' else 80)
+    (connection, reused) = self._acquire(scheme, parts.hostname, port)
+    if not reused:
+      try:
+        connection.connect()
+      except Exception:
+        connection.close()
+        raise
+    self._release(scheme, parts.hostname, port, connection)
+
+  def _release(self, scheme, host, port, connection):
+    with self._lock:
+      pool = self._pools.setdefault((scheme, host, port), [])
+      if len(pool) < self.pool_size and self._pid == os.getpid():
+        pool.append(connection)
+        return
+    connection.close()
+
+  def _send(self, method, url, body, headers, max_bytes=None):
+    """Sends a single request, without following redirects.
+
+    Args:
+        method (str): HTTP method
+        url (str): URL of the request
+        body (bytes): body of the request or None
+        headers (Dict[str, str]): headers of the request
+        max_bytes (int, optional): maximum size of the response body. Defaults
+          to None, no limit
+
+    Returns:
+        (int, str, HTTPMessage, bytes): status, reason, headers and raw body
+    """
+    parts = parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+      raise ValueError(f'Unsupported URL scheme: {url}')
+    host = parts.hostname
+    port = parts.port or (443 if scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+      path = f'{path}?{parts.query}'
+
+    while True:
+      (connection, reused) = self._acquire(scheme, host, port)
+      try:
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        if max_bytes is None:
+          data = response.read()
+        else:
+          data = _read_body(response, url, max_bytes)
+      except (http.client.RemoteDisconnected, ConnectionResetError,
+              BrokenPipeError, http.client.BadStatusLine):
+        connection.close()
+        if reused:
+          # The server closed the idle connection, retry on a new one.
+          continue
+        raise
+      except Exception:
+        connection.close()
+        raise
+
+      if response.will_close:
+        connection.close()
+      else:
+        self._release(scheme, host, port, connection)
+      return (response.status, response.reason, response.headers, data)
+
+  def request(self, method, url, body=None, headers=None, max_bytes=None):
+    """Sends a request and follows the redirects.
+
+    Args:
+        method (str): HTTP method
+        url (str): URL of the request
+        body (bytes, optional): body of the request. Defaults to None
+        headers (Dict[str, str], optional): headers to add to the default
+          ones. Defaults to None
+        max_bytes (int, optional): maximum size of the response body, before
+          and after decompressing it. Defaults to None, no limit
+
+    Returns:
+        HttpResponse: the response with the decoded body
+    """
+    request_headers = dict(DEFAULT_HEADERS)
+    request_headers.update(headers or {})
+
+    for _ in range(self.max_redirects + 1):
+      (status, reason, response_headers,
+       data) = self._send(method, url, body, request_headers, max_bytes)
+
+      if status in REDIRECT_STATUSES and 'Location' in response_headers:
+        url = parse.urljoin(url, response_headers['Location'])
+        if status == 303 or (status in (301, 302) and method == 'POST'):
+          method = 'GET'
+          body = None
+          request_headers.pop('Content-Type', None)
+        continue
+
+      data = _decode(data, response_headers.get('Content-Encoding'),
+                     max_bytes + 1 if max_bytes is not None else 0)
+      if max_bytes is not None and len(data) > max_bytes:
+        raise ResponseTooLarge(url, max_bytes)
+      if status >= 400:
+        raise HttpError(url, status, reason, data)
+      return HttpResponse(url, status, response_headers, data)
+
+    raise HttpError(url, status, 'Too many redirects', data)
+
+  def get(self, url, headers=None, max_bytes=None):
+    """Sends a GET request.
+
+    Args:
+        url (str): URL of the request
+        headers (Dict[str, str], optional): extra headers. Defaults to None
+        max_bytes (int, optional): maximum size of the response body. Defaults
+          to None, no limit
+
+    Returns:
+        HttpResponse: the response
+    """
+    return self.request('GET', url, headers=headers, max_bytes=max_bytes)
+
+  def post(self, url, body, headers=None):
+    """Sends a POST request.
+
+    Args:
+        url (str): URL of the request
+        body (bytes): body of the request
+        headers (Dict[str, str], optional): extra headers. Defaults to None
+
+    Returns:
+        HttpResponse: the response
+    """
+    return self.request('POST', url, body=body, headers=headers)
+
+
+DEFAULT_CLIENT = HttpClient(
+    pool_size=int(os.environ.get('HTTP_POOL_SIZE', 4)),
+    timeout=float(os.environ.get('HTTP_TIMEOUT', 30)),
+)
+
+
+def get(url, headers=None, max_bytes=None):
+  """Sends a GET request with the shared client.
+
+  Args:
+      url (str): URL of the request
+      headers (Dict[str, str], optional): extra headers. Defaults to None
+      max_bytes (int, optional): maximum size of the response body. Defaults
+        to None, no limit
+
+  Returns:
+      HttpResponse: the response
+  """
+  return DEFAULT_CLIENT.get(url, headers, max_bytes)
+
+
+def post(url, body, headers=None):
+  """Sends a POST request with the shared client.
+
+  Args:
+      url (str): URL of the request
+      body (bytes): body of the request
+      headers (Dict[str, str], optional): extra headers. Defaults to None
+
+  Returns:
+      HttpResponse: the response
+  """
+  return DEFAULT_CLIENT.post(url, body, headers)
@@ -0,0 +1,306 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from lazy_import import lazy_import
+
+cv2 = lazy_import('cv2')
+np = lazy_import('numpy')
+
+# Extension, content type and name of the quality flag of every supported
+# output format. The flags are looked up on cv2 when encoding, so importing this
+# module does not load OpenCV.
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', 'IMWRITE_JPEG_QUALITY'),
+    'webp': ('.webp', 'image/webp', 'IMWRITE_WEBP_QUALITY'),
+    'png': ('.png', 'image/png', None),
+}
+EXTENSIONS = {
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.jpe': 'jpeg',
+    '.webp': 'webp',
+    '.png': 'png',
+}
+MIN_QUALITY = 30
+MAX_QUALITY = 95
+# Start of frame markers, every JPEG marker from SOF0 to SOF15 but DHT, JPG and
+# DAC which share the range.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_SOS_MARKER = 0xDA
+# Names of the flags to decode a JPEG at a fraction of its size, in color and in
+# grayscale.
+REDUCED_DECODE_FLAGS = {
+    8: ('IMREAD_REDUCED_COLOR_8', 'IMREAD_REDUCED_GRAYSCALE_8'),
+    4: ('IMREAD_REDUCED_COLOR_4', 'IMREAD_REDUCED_GRAYSCALE_4'),
+    2: ('IMREAD_REDUCED_COLOR_2', 'IMREAD_REDUCED_GRAYSCALE_2'),
+}
+
+
+def format_for(name_or_format):
+  """Finds the output format for a format name or a file extension.
+
+  Formats OpenCV can not write, i.e: GIF, are saved as PNG.
+
+  Args:
+      name_or_format (str): jpeg, webp, png or a file name or extension
+
+  Returns:
+      str: jpeg, webp or png
+  """
+  value = (name_or_format or '').lower().split('?')[0]
+  if value in FORMATS:
+    return value
+  return EXTENSIONS.get('.' + value.rsplit('.', 1)[-1], 'png')
+
+
+def extension_for(image_format):
+  """Returns the file extension of a format, i.e: .jpg for jpeg."""
+  return FORMATS[image_format][0]
+
+
+def content_type_for(image_format):
+  """Returns the content type of a format, i.e: image/jpeg for jpeg."""
+  return FORMATS[image_format][1]
+
+
+def jpeg_header(content):
+  """Reads the size of a JPEG image from its frame header.
+
+  Args:
+      content (bytes): encoded image
+
+  Returns:
+      (int, int, int): width, height and number of color components or None
+      if the content is not a JPEG image
+  """
+  if content[:2] != b'\xff\xd8':
+    return None
+
+  position = 2
+  while position + 4 <= len(content):
+    if content[position] != 0xFF:
+      return None
+    marker = content[position + 1]
+    if marker == 0xFF:
+      # Markers may be preceded by any number of fill bytes.
+      position += 1
+      continue
+    if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+      # Standalone markers, without a length.
+      position += 2
+      continue
+    if marker == JPEG_SOS_MARKER:
+      return None
+
+    length = int.from_bytes(content[position + 2:position + 4], 'big')
+    if marker in JPEG_SOF_MARKERS:
+      if position + 10 > len(content):
+        return None
+      height = int.from_bytes(content[position + 5:position + 7], 'big')
+      width = int.from_bytes(content[position + 7:position + 9], 'big')
+      return (width, height, content[position + 9])
+    position += 2 + length
+
+  return None
+
+
+def image_size(content):
+  """Reads the size of an image from its header, without decoding it.
+
+  JPEG, PNG, GIF, WebP and BMP images are recognized.
+
+  Args:
+      content (bytes): encoded image
+
+  Returns:
+      (int, int): width and height in pixels or None if the format is unknown
+  """
+  header = jpeg_header(content)
+  if header is not None:
+    return header[:2]
+
+  if content[:8] == b'\x89PNG\r\n\x1a\n' and content[12:16] == b'IHDR':
+    return (int.from_bytes(content[16:20], 'big'),
+            int.from_bytes(content[20:24], 'big'))
+
+  if content[:6] in (b'GIF87a', b'GIF89a'):
+    return (int.from_bytes(content[6:8], 'little'),
+            int.from_bytes(content[8:10], 'little'))
+
+  if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+    chunk = content[12:16]
+    if chunk == b'VP8 ' and len(content) >= 30:
+      return (int.from_bytes(content[26:28], 'little') & 0x3FFF,
+              int.from_bytes(content[28:30], 'little') & 0x3FFF)
+    if chunk == b'VP8L' and len(content) >= 25:
+      bits = int.from_bytes(content[21:25], 'little')
+      return ((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b'VP8X' and len(content) >= 30:
+      return (int.from_bytes(content[24:27], 'little') + 1,
+              int.from_bytes(content[27:30], 'little') + 1)
+    return None
+
+  if content[:2] == b'BM' and len(content) >= 26:
+    return (abs(int.from_bytes(content[18:22], 'little', signed=True)),
+            abs(int.from_bytes(content[22:26], 'little', signed=True)))
+
+  return None
+
+
+def reduction_for(width, height, min_width=0, min_height=0, min_side=0):
+  """Chooses the largest scale down factor that keeps the image big enough.
+
+  Args:
+      width (int): width of the image in pixels
+      height (int): height of the image in pixels
+      min_width (int, optional): minimum width after the reduction
+      min_height (int, optional): minimum height after the reduction
+      min_side (int, optional): minimum longest side after the reduction
+
+  Returns:
+      int: 8, 4, 2 or 1 for no reduction
+  """
+  for factor in sorted(REDUCED_DECODE_FLAGS, reverse=True):
+    # The decoder rounds the scaled size up.
+    reduced_width = -(-width // factor)
+    reduced_height = -(-height // factor)
+    if (reduced_width >= min_width and reduced_height >= min_height and
+        max(reduced_width, reduced_height) >= min_side):
+      return factor
+  return 1
+
+
+def decode_image(content, min_width=0, min_height=0, min_side=0):
+  """Decodes the image, at a reduced resolution when it is a large JPEG.
+
+  JPEG images can be decoded at 1/2, 1/4 or 1/8 of their size for a fraction of
+  the time and memory. The largest reduction that keeps the decoded image at
+  least as big as requested is used, the caller still resizes it to the exact
+  size. Without any minimum size the image is decoded at full resolution.
+
+  Args:
+      content (bytes): encoded image
+      min_width (int, optional): minimum width of the decoded image
+      min_height (int, optional): minimum height of the decoded image
+      min_side (int, optional): minimum longest side of the decoded image
+
+  Returns:
+      ndarray: decoded image, like cv2.imdecode with IMREAD_UNCHANGED
+  """
+  flags = cv2.IMREAD_UNCHANGED
+  header = jpeg_header(content)
+  if header is not None and (min_width or min_height or min_side):
+    (width, height, components) = header
+    factor = reduction_for(width, height, min_width, min_height, min_side)
+    if factor > 1:
+      # IMREAD_UNCHANGED ignores the EXIF orientation, the reduced decode must
+      # too so the size and the detected objects still match.
+      flags = (getattr(cv2, REDUCED_DECODE_FLAGS[factor][components == 1]) |
+               cv2.IMREAD_IGNORE_ORIENTATION)
+      print(f'Decoding the {width}x{height} image at 1/{factor} of its size')
+
+  img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), flags)
+  if img is None:
+    raise Exception('Error decoding the image')
+  return img
+
+
+def _flatten_alpha(img):
+  """Composes an image with transparency over a white background.
+
+  Args:
+      img (ndarray): BGRA image
+
+  Returns:
+      ndarray: BGR image
+  """
+  alpha = img[:, :, 3:4].astype(np.float32) / 255.0
+  white = np.full(img.shape[:2] + (3,), 255.0, dtype=np.float32)
+  return (img[:, :, :3] * alpha + white * (1.0 - alpha)).astype(img.dtype)
+
+
+def encode_image(img, image_format, quality=None):
+  """Encodes the image in memory.
+
+  Args:
+      img (ndarray): decoded image
+      image_format (str): jpeg, webp or png
+      quality (int, optional): quality between 1 and 100 for the lossy
+        formats. Defaults to OpenCV defaults
+
+  Returns:
+      bytes: the encoded image
+  """
+  (extension, _, quality_flag) = FORMATS[image_format]
+  params = []
+  if image_format == 'jpeg' and img.ndim == 3 and img.shape[2] == 4:
+    img = _flatten_alpha(img)
+  if image_format == 'png':
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 9]
+  elif quality is not None:
+    params = [getattr(cv2, quality_flag), int(quality)]
+
+  (success, encoded) = cv2.imencode(extension, img, params)
+  if not success:
+    raise Exception(f'Error encoding the image as {image_format}')
+  return encoded.tobytes()
+
+
+def encode_within_budget(img, image_format, max_bytes=None):
+  """Encodes the image with the best quality that fits in the budget.
+
+  The quality is found with a binary search, PNG is lossless so it is only
+  encoded once with the maximum compression.
+
+  Args:
+      img (ndarray): decoded image
+      image_format (str): jpeg, webp or png
+      max_bytes (int, optional): maximum size of the encoded image. Defaults
+        to None, no limit
+
+  Returns:
+      (bytes, int): the encoded image and the quality used, None for the
+      default one
+  """
+  if FORMATS[image_format][2] is None:
+    encoded = encode_image(img, image_format)
+    if max_bytes and len(encoded) > max_bytes:
+      print(f'The image takes {len(encoded)} bytes, over the budget of'
+            f' {max_bytes} bytes, a lossy format would make it smaller')
+    return (encoded, None)
+
+  if not max_bytes:
+    return (encode_image(img, image_format), None)
+
+  best = None
+  low = MIN_QUALITY
+  high = MAX_QUALITY
+  while low <= high:
+    quality = (low + high) // 2
+    encoded = encode_image(img, image_format, quality)
+    if len(encoded) <= max_bytes:
+      best = (encoded, quality)
+      low = quality + 1
+    else:
+      high = quality - 1
+
+  if best is None:
+    encoded = encode_image(img, image_format, MIN_QUALITY)
+    print(f'The image takes {len(encoded)} bytes at the minimum quality, over'
+          f' the budget of {max_bytes} bytes')
+    return (encoded, MIN_QUALITY)
+
+  print(f'Encoded the image as {image_format} with quality {best[1]} in'
+        f' {len(best[0])} bytes')
+  return best
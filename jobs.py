@@ -0,0 +1,325 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from gcs_storage import get_storage_manager
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueueFull(Exception):
+  """Raised when there are already too many jobs waiting to run."""
+
+
+class JobStore(abc.ABC):
+  """Store of the jobs and their progress shared by all the workers.
+
+  The job runs in the worker that received it, but its status and result can
+  be read by any other one. Only the runner of a job writes it once created,
+  so it keeps its own copy and the updates write the whole job without reading
+  it or locking. The stages are written at most every min_progress_seconds. A
+  running job that is not updated for max_idle_seconds is reported as failed,
+  its worker is gone. The subclasses load and save the jobs, see _load and
+  _save.
+  """
+
+  def __init__(self, ttl_seconds=3600, max_idle_seconds=600,
+               min_progress_seconds=2):
+    """Initializes the store.
+
+    Args:
+        ttl_seconds (int, optional): time to keep the finished jobs. Defaults
+          to 3600
+        max_idle_seconds (int, optional): time after which a running job that
+          is not updated is reported as failed. Defaults to 600
+        min_progress_seconds (int, optional): minimum time between two writes
+          of the stage of a job. Defaults to 2
+    """
+    self.ttl_seconds = ttl_seconds
+    self.max_idle_seconds = max_idle_seconds
+    self.min_progress_seconds = min_progress_seconds
+    # The unfinished jobs written by this process.
+    self._own_jobs = {}
+    self._lock = threading.Lock()
+
+  @abc.abstractmethod
+  def _load(self, job_id):
+    """Reads a job.
+
+    Args:
+        job_id (str): id of the job
+
+    Returns:
+        Dict[str, object]: the job or None if it does not exist
+    """
+
+  @abc.abstractmethod
+  def _save(self, job):
+    """Writes a job, replacing the previous version.
+
+    Args:
+        job (Dict[str, object]): the job
+    """
+
+  def create(self):
+    """Creates a new queued job.
+
+    Returns:
+        str: id of the job
+    """
+    job_id = secrets.token_urlsafe(12)
+    now = time.time()
+    job = {
+        'id': job_id,
+        'status': QUEUED,
+        'stage': None,
+        'result': None,
+        'error': None,
+        'created_at': now,
+        'updated_at': now,
+    }
+    self._save(job)
+    with self._lock:
+      self._own_jobs[job_id] = job
+    return job_id
+
+  def update(self, job_id, **fields):
+    """Updates the fields of a job.
+
+    Args:
+        job_id (str): id of the job
+        **fields: fields to change, i.e: status, stage, result or error
+    """
+    with self._lock:
+      job = self._own_jobs.get(job_id)
+    if job is None:
+      job = self._load(job_id)
+      if job is None:
+        return
+    job = dict(job, **fields, updated_at=time.time())
+    self._save(job)
+    with self._lock:
+      if job['status'] in (DONE, FAILED):
+        self._own_jobs.pop(job_id, None)
+      else:
+        self._own_jobs[job_id] = job
+
+  def report_progress(self, job_id, stage):
+    """Updates the stage of a job, unless it was written very recently.
+
+    Args:
+        job_id (str): id of the job
+        stage (str): name of the current stage
+    """
+    with self._lock:
+      job = self._own_jobs.get(job_id)
+      if (job is not None and
+          time.time() - job['updated_at'] < self.min_progress_seconds):
+        # Written with the next update, if it still is the current stage.
+        self._own_jobs[job_id] = dict(job, stage=stage)
+        return
+    self.update(job_id, stage=stage)
+
+  def get(self, job_id):
+    """Returns the job.
+
+    Args:
+        job_id (str): id of the job
+
+    Returns:
+        Dict[str, object]: the job or None if it does not exist or expired
+    """
+    job = self._load(job_id)
+    if job is None:
+      return None
+    idle_seconds = time.time() - job['updated_at']
+    if job['status'] in (DONE, FAILED):
+      return job if idle_seconds < self.ttl_seconds else None
+    # A queued job waits for a free worker, it is not updated meanwhile.
+    if job['status'] == RUNNING and idle_seconds >= self.max_idle_seconds:
+      job.update(status=FAILED, error='The job stopped responding')
+    return job
+
+
+class SqliteJobStore(JobStore):
+  """Keeps the jobs in a SQLite file shared by the workers of a machine."""
+
+  def __init__(self, ttl_seconds=3600, max_idle_seconds=600,
+               min_progress_seconds=2, path=None):
+    """Initializes the store.
+
+    Args:
+        ttl_seconds (int, optional): time to keep the finished jobs. Defaults
+          to 3600
+        max_idle_seconds (int, optional): time after which a running job that
+          is not updated is reported as failed. Defaults to 600
+        min_progress_seconds (int, optional): minimum time between two writes
+          of the stage of a job. Defaults to 2
+        path (str, optional): path of the SQLite file. Defaults to a file in
+          the temporary directory
+    """
+    super().__init__(ttl_seconds, max_idle_seconds, min_progress_seconds)
+    self.path = path or os.path.join(tempfile.gettempdir(),
+                                     'creative_jobs.sqlite3')
+    with self._connect() as db:
+      db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job'
+                 ' TEXT, updated_at REAL)')
+
+  @contextlib.contextmanager
+  def _connect(self):
+    db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+    try:
+      yield db
+    finally:
+      db.close()
+
+  def _load(self, job_id):
+    with self._connect() as db:
+      row = db.execute('SELECT job FROM jobs WHERE id = ?',
+                       (job_id,)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+  def _save(self, job):
+    with self._connect() as db:
+      db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)',
+                 (job['id'], json.dumps(job), job['updated_at']))
+      if job['status'] == QUEUED:
+        # Any job older than that is finished or gone.
+        db.execute('DELETE FROM jobs WHERE updated_at <= ?',
+                   (time.time() - max(self.ttl_seconds,
+                                      self.max_idle_seconds),))
+
+
+class GcsJobStore(JobStore):
+  """Keeps every job in a JSON blob, shared by all the instances.
+
+  The blobs are deleted by the lifecycle rule of the bucket, see
+  storage_lifecycle.json.
+  """
+
+  def __init__(self, bucket_name, ttl_seconds=3600, max_idle_seconds=600,
+               min_progress_seconds=2, prefix='jobs/'):
+    """Initializes the store.
+
+    Args:
+        bucket_name (str): name of the Google Cloud Storage bucket
+        ttl_seconds (int, optional): time to keep the finished jobs. Defaults
+          to 3600
+        max_idle_seconds (int, optional): time after which a running job that
+          is not updated is reported as failed. Defaults to 600
+        min_progress_seconds (int, optional): minimum time between two writes
+          of the stage of a job. Defaults to 2
+        prefix (str, optional): prefix of the names of the blobs. Defaults to
+          jobs/
+    """
+    super().__init__(ttl_seconds, max_idle_seconds, min_progress_seconds)
+    self.bucket_name = bucket_name
+    self.prefix = prefix
+
+  def _blob(self, job_id):
+    return get_storage_manager(self.bucket_name).blob(
+        f'{self.prefix}{job_id}.json')
+
+  def _load(self, job_id):
+    from google.api_core import exceptions  # pylint: disable=g-import-not-at-top
+
+    try:
+      return json.loads(self._blob(job_id).download_as_bytes())
+    except exceptions.NotFound:
+      return None
+
+  def _save(self, job):
+    self._blob(job['id']).upload_from_string(
+        json.dumps(job), content_type='application/json')
+
+
+class JobRunner:
+  """Runs the jobs in a bounded pool of background threads."""
+
+  def __init__(self, store, max_workers=4, max_pending=32):
+    self.store = store
+    self.max_workers = max_workers
+    self.max_pending = max_pending
+    self._executor = None
+    self._pending = 0
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def submit(self, fn, *args, **kwargs):
+    """Queues a job.
+
+    The function is called with a progress keyword argument, a callable that
+    receives the name of the current stage.
+
+    Args:
+        fn (Callable): function to run
+        *args: positional arguments for the function
+        **kwargs: keyword arguments for the function
+
+    Returns:
+        str: id of the job
+    """
+    with self._lock:
+      if self._pid != os.getpid():
+        # Threads do not survive a fork, every worker needs its own pool.
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._pending = 0
+        self._pid = os.getpid()
+      if self._pending >= self.max_pending:
+        raise JobQueueFull('Too many jobs waiting, try again later')
+      self._pending += 1
+
+    try:
+      job_id = self.store.create()
+    except Exception:
+      with self._lock:
+        self._pending -= 1
+      raise
+    self._executor.submit(self._run, job_id, fn, args, kwargs)
+    return job_id
+
+  def _run(self, job_id, fn, args, kwargs):
+
+    def progress(stage):
+      try:
+        self.store.report_progress(job_id, stage)
+      except Exception as ex:
+        # Only the progress report is lost, the job goes on.
+        print(f'Could not update the job {job_id}: {ex}')
+
+    try:
+      self.store.update(job_id, status=RUNNING)
+      result = fn(*args, progress=progress, **kwargs)
+      self.store.update(job_id, status=DONE, stage=None, result=result)
+    except Exception as ex:
+      print(ex)
+      try:
+        self.store.update(job_id, status=FAILED, error=str(ex))
+      except Exception as store_ex:
+        print(f'Could not update the job {job_id}: {store_ex}')
+    finally:
+      with self._lock:
+        self._pending -= 1
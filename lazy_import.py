@@ -0,0 +1,94 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Defers the import of heavy modules until one of their attributes is used.
+
+cv2 and numpy take a good part of the start up of an instance and the routes
+that do not touch the images never need them. The warmup request loads them
+all ahead of the first user request, see load_all.
+"""
+
+import importlib
+import threading
+import time
+import types
+
+_lazy_modules = []
+_lazy_modules_lock = threading.Lock()
+
+
+class _LazyModule(types.ModuleType):
+  """Stands in for a module and imports it on the first missing attribute.
+
+  importlib.util.LazyLoader is not thread safe before Python 3.12, the image
+  workers would race to run the module. Here the import happens under a lock
+  and the attributes of the module are then copied over, so the later lookups
+  cost the same as on the module itself.
+  """
+
+  def __init__(self, name):
+    super().__init__(name)
+    self._lazy_lock = threading.Lock()
+    self._lazy_module = None
+
+  def _load(self):
+    """Imports the module once.
+
+    Returns:
+        module: the module
+    """
+    if self._lazy_module is None:
+      with self._lazy_lock:
+        if self._lazy_module is None:
+          module = importlib.import_module(self.__name__)
+          self.__dict__.update(
+              (name, value) for (name, value) in vars(module).items()
+              if name not in ('__name__', '__spec__', '__loader__'))
+          self._lazy_module = module
+    return self._lazy_module
+
+  def __getattr__(self, name):
+    return getattr(self._load(), name)
+
+
+def lazy_import(name):
+  """Imports a module the first time one of its attributes is used.
+
+  Args:
+      name (str): full name of the module, i.e: cv2
+
+  Returns:
+      module: a stand-in for the module
+  """
+  module = _LazyModule(name)
+  with _lazy_modules_lock:
+    _lazy_modules.append(module)
+  return module
+
+
+def load_all():
+  """Imports the modules imported lazily that are not imported yet.
+
+  Returns:
+      Dict[str, float]: seconds taken to import every module
+  """
+  with _lazy_modules_lock:
+    modules = list(_lazy_modules)
+  timings = {}
+  for module in modules:
+    start = time.perf_counter()
+    module._load()  # pylint: disable=protected-access
+    timings[module.__name__] = (timings.get(module.__name__, 0.0) +
+                                time.perf_counter() - start)
+  return timings
@@ -12,32 +12,65 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from base64 import b64encode
-import datetime
-from io import BytesIO, StringIO
+import functools
+import mimetypes
 import os
 import time
-from urllib import parse, request
-from urllib.request import Request, urlopen
-import zipfile
-from flask import Flask, Markup, redirect, render_template, request
-from generate_creative import detect_objects, generate_html5_parts
+from urllib import parse
+import creative_service
+from flask import Flask, Response, abort, g, jsonify, redirect, render_template, request, send_file, url_for
+from gcs_storage import get_storage_manager
 from google.appengine.api import wrap_wsgi_app
-from google.auth import app_engine
-from google.cloud import storage
+import jobs
+import lazy_import
+import metrics
+from profiler import Profiler
+import static_assets
+from werkzeug.security import safe_join
 
 
 app = Flask(__name__)
 app.wsgi_app = wrap_wsgi_app(app.wsgi_app)
 
-GCS_BUCKET = f"{os.environ.get('GOOGLE_CLOUD_PROJECT')}.appspot.com"
-API_KEY = os.environ.get('API_KEY')
-TRANSPARENT_GIF = 'static/images/transparent.gif'
-OUTPUT_HTML_FILE_NAME = 'creative.html'
-MINUTES_TO_EXPIRE = 60
-CSS_FILES = ['gwdgooglead_style.css', 'gwdpage_style.css', 'gwdimage_style.css', 'gwdpagedeck_style.css', 'gwdtaparea_style.css']
-JS_FILES = ['Enabler.js', 'gwdtaparea_min.js', 'gwdpage_min.js', 'gwd-events-support.1.0.js', 'gwd_webcomponents_v1_min.js', 'gwdgooglead_min.js', 'gwdpagedeck_min.js', 'gwdimage_min.js']
-
+# Compiled by the warmup request. Jinja caches the templates by the name they
+# are rendered with, they must be written the same way as in render_template.
+WARMUP_TEMPLATES = ['/index.html', '/build_creative.html', 'error.html']
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+# Time after which a running job that does not report any progress is failed.
+JOB_MAX_IDLE_SECONDS = int(os.environ.get('JOB_MAX_IDLE_SECONDS', 600))
+# Minimum time between two writes of the stage of a job, each one rewrites it.
+JOB_PROGRESS_SECONDS = int(os.environ.get('JOB_PROGRESS_SECONDS', 2))
+
+app.add_template_global(
+    functools.partial(static_assets.asset_url,
+                      creative_service.ASSET_MANIFEST), 'asset_url')
+# Any worker, or instance, can be asked about a job, not only the one running
+# it.
+if os.environ.get('GAE_ENV', '').startswith('standard'):
+  JOB_STORE = jobs.GcsJobStore(
+      creative_service.GCS_BUCKET,
+      ttl_seconds=creative_service.MINUTES_TO_EXPIRE * 60,
+      max_idle_seconds=JOB_MAX_IDLE_SECONDS,
+      min_progress_seconds=JOB_PROGRESS_SECONDS,
+  )
+else:
+  JOB_STORE = jobs.SqliteJobStore(
+      ttl_seconds=creative_service.MINUTES_TO_EXPIRE * 60,
+      max_idle_seconds=JOB_MAX_IDLE_SECONDS,
+      min_progress_seconds=JOB_PROGRESS_SECONDS,
+      path=os.environ.get('JOB_STORE_PATH'),
+  )
+JOB_RUNNER = jobs.JobRunner(
+    JOB_STORE, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE)
+# Off unless PROFILER_ENABLED is set, see Profiler for how requests opt in.
+PROFILER = Profiler(
+    enabled=os.environ.get('PROFILER_ENABLED', '').lower() in ('1', 'true'),
+    token=os.environ.get('PROFILER_TOKEN') or None,
+    sample_rate=float(os.environ.get('PROFILER_SAMPLE_RATE', 0)),
+    default_mode=os.environ.get('PROFILER_MODE', 'sample'),
+    profile_dir=os.environ.get('PROFILER_DIR'),
+)
 
 
 def _is_local():
@@ -50,327 +83,165 @@ def _is_local():
   return 'localhost' in request.host_url
 
 
-def _clean_files(img_url, zip_file_url):
-  """Delete the generated files
-
-  Args:
-      img_url (str): URL of the image
-      zip_file_url (str): URL of the zip file
-  """
-  img_name = img_url.split('/')[-1]
-  zip_name = zip_file_url.split('/')[-1]
-  if _is_local():
-    _delete_from_local(img_name, zip_name)
-  else:
-    img_name = img_name.split('?')[0]
-    zip_name = zip_name.split('?')[0]
-    _delete_from_gcs(img_name, zip_name)
-
-
-def _delete_from_local(img_name, zip_name):
-  """Removes the files from static directory in local drive
-
-  Args:
-      img_name (str): name of the image file
-      zip_name (str): name of the zip file
-  """
-
-  try:
-    os.remove(f'static/images/{img_name}')
-    os.remove(f'static/{zip_name}')
-  except Exception as ex:
-    print(ex)
-
-
-def _delete_from_gcs(img_name, zip_name):
-  """Deletes blobs from the bucket
+def _build_creative_job(img_url, threshold, img_dimensions, local, progress):
+  """Builds a creative in the background.
 
   Args:
-      img_name (str): URL of the image file
-      zip_name (str): URL of the zip file
-  """
-  storage_client = storage.Client()
-  bucket = storage_client.bucket(GCS_BUCKET)
-
-  try:
-    print(f'Trying to delete {img_name}.')
-    blob = bucket.get_blob(img_name)
-    blob.delete()
-    print(f'Blob {img_name} deleted.')
-  except Exception as ex:
-    print(ex)
-
-  try:
-    print(f'Trying to delete {zip_name}.')
-    blob = bucket.get_blob(zip_name)
-    blob.delete()
-    print(f'Blob {zip_name} deleted.')
-  except Exception as ex:
-    print(ex)
-
-
-def _read_image(image_url):
-  """Reads an image from internet
-
-  Args:
-      image_url (str): URL for the image
+      img_url (str): URL of the image to analyse
+      threshold (float): number between 0 and 1 to use as confidence threshold
+        for detection
+      img_dimensions (str): image dimensions in widthxheight format. i.e:
+        300x600
+      local (boolean): describes if the server is running on localhost
+      progress (Callable): called with the name of every stage as it starts
 
   Returns:
-      bytearray: Bytes for the image
+      Dict[str, object]: the values to render the creative template with
   """
-
-  headers = {
-      'User-Agent': (
-          'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like'
-          ' Gecko) Chrome/23.0.1271.64 Safari/537.11'
-      ),
-      'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-      'Accept-Encoding': 'gzip, deflate, br',
-      'Accept-Language': 'en-US,en;q=0.9,es;q=0.8',
-      'Connection': 'keep-alive',
+  (
+      img_url,
+      img_name,
+      width,
+      height,
+      html5_parts,
+      artifact_token,
+  ) = creative_service.process_image(img_url, threshold, img_dimensions, local,
+                                     progress)
+
+  return {
+      'img_url': img_url,
+      'img_name': img_name,
+      'width': width,
+      'height': height,
+      'artifact_token': artifact_token,
+      **html5_parts._asdict(),
   }
 
-  req = Request(image_url, headers=headers)
-  resp = urlopen(req)
-  return resp.read()
-
 
-def _read_txt_file(url):
-  """Reads an image from internet
+def _job_status(job):
+  """Describes a job without its result.
 
   Args:
-      url (str): URL for the image
+      job (Dict[str, object]): the job
 
   Returns:
-      string: for the file
+      Dict[str, object]: id, status, stage and error of the job plus the URL
+      of its result once it is done
   """
-  #'Accept-Encoding': 'gzip, deflate, br',
-  headers = {
-      'User-Agent': (
-          'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.11 (KHTML, like'
-          ' Gecko) Chrome/23.0.1271.64 Safari/537.11'
-      ),
-      'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-      'Accept-Language': 'en-US,en;q=0.9,es;q=0.8',
-      'Accept-Encoding': 'identity',
-      'Connection': 'keep-alive',
+  status = {
+      'job_id': job['id'],
+      'status': job['status'],
+      'stage': job['stage'],
+      'error': job['error'],
   }
+  if job['status'] == jobs.DONE:
+    status['result_url'] = url_for('job_result', job_id=job['id'])
+  return status
 
-  req = Request(url, headers=headers)
-  resp = urlopen(req)
-  return resp.read()
 
+@app.before_request
+def _start_janitor():
+  # Once per worker, when it serves its first request rather than when the
+  # module is imported.
+  creative_service.ARTIFACT_REGISTRY.start()
 
-def _create_zip(zip_file_name, html_file, img_url, img_name, base_url):
-  """Creates a zip file with the html and images files.
 
-  Args:
-      zip_file_name (str): Name for the zip file
-      html_file (bytearray): Bytes of the HTML file
-      img_url (str): URL for the image
-      img_name (str): Name of the image
-      base_url (str): Base URL for the server where the app is deployed
+@app.before_request
+def _start_timing():
+  g.metrics_token = metrics.start_request()
+  g.request_start = time.perf_counter()
 
-  Returns:
-      bytes: Bytes for the zip file
-  """
-  mem_zip = BytesIO()
-
-  transparent_url = f'{base_url}{TRANSPARENT_GIF}'
- 
-  files = []
-  files_js = []
-  files_css = []
-  transparent_file_name = TRANSPARENT_GIF.split('/')[-1]
-  files.append((_read_image(img_url), img_name))
-  files.append((_read_image(transparent_url), transparent_file_name))
-  for file_name in CSS_FILES:
-    files_css.append((_read_txt_file(f'{base_url}static/css/{file_name}'), file_name))
-  for file_name in JS_FILES:
-    files_js.append((_read_txt_file(f'{base_url}static/js/{file_name}'), file_name))
-
-  with zipfile.ZipFile(mem_zip, mode='w') as zf:
-    for f, name in files:
-      zf.writestr(f'{zip_file_name}/images/{name}', f)
-    for f, name in files_css:
-      zf.writestr(f'{zip_file_name}/css/{name}', f)
-    for f, name in files_js:
-      zf.writestr(f'{zip_file_name}/js/{name}', f)
-    zf.writestr(f'{zip_file_name}/{OUTPUT_HTML_FILE_NAME}', html_file)
-
-  return mem_zip.getvalue()
-
-
-def _save_zip(file, file_name, base_url):
-  """Saves the generate zip file.
 
-  Args:
-      file (bytearray): the contents of the zip file in bytes
-      file_name (str): the name to give to the saved file
-      base_url (str): base URL to use in the resulting URL for the saved file
+@app.after_request
+def _report_timing(response):
+  """Adds the stage timings of the request to the response.
 
   Returns:
-      str: URL for the saved file
+      Response: the response with a Server-Timing header
   """
+  if 'metrics_token' not in g:
+    return response
+  total = time.perf_counter() - g.request_start
+  spans = metrics.end_request(g.pop('metrics_token'))
+  response.headers['Server-Timing'] = metrics.server_timing(spans, total)
+  metrics.REQUEST_DURATION.observe(
+      total, endpoint=request.endpoint or 'unknown',
+      status=response.status_code)
+  return response
 
-  bucket = None
-  if _is_local():
-    tmp_dir = 'static'
-    return _store_local_file(file, f'{tmp_dir}/{file_name}.zip', base_url)
 
-  else:
-    bucket = GCS_BUCKET
-    return _store_file_in_gcs(file, f'{file_name}.zip', bucket)
+@app.teardown_request
+def _end_timing(error=None):
+  # after_request is skipped when the request fails with an exception.
+  if 'metrics_token' in g:
+    metrics.end_request(g.pop('metrics_token'))
 
 
-def _store_local_file(file, file_path, base_url):
-  """Saves the file into Google Cloud Storage
-
-  Args:
-      file (bytearray): file content
-      file_name (str): the file to generate the signed URL for
-      base_url (str): base URL to use in the resulting URL for the saved file
+@app.route('/_ah/warmup')
+def warmup():
+  """Gets the instance ready before App Engine sends it user requests.
 
-  Returns:
-      str: signed URL to temporary access the GCS files from any client
-  """
-
-  f = open(file_path, 'wb')
-  f.write(file)
-
-  return f'{base_url}{file_path}'
-
-
-def _store_file_in_gcs(file, file_name, bucket_name):
-  """Saves the file into Google Cloud Storage
-
-  Args:
-      file (bytearray): file content
-      file_name (str): the file to generate the signed URL for
-      bucket_name (str): name of the Google Cloud Storage bucket
+  Loads the modules imported lazily, compiles the templates, creates the
+  Cloud Storage client and opens the connections of the object detector, so
+  the first user request does not wait for any of it.
 
   Returns:
-      str: signed URL to temporary access the GCS files from any client
+      str: empty response, the time of every step is in Server-Timing
   """
+  with metrics.span('warmup_modules'):
+    for (name, duration) in lazy_import.load_all().items():
+      print(f'Loaded {name} in {duration * 1000:.1f} ms')
+  with metrics.span('warmup_templates'):
+    for template_name in WARMUP_TEMPLATES:
+      app.jinja_env.get_template(template_name)
+  if not _is_local():
+    with metrics.span('warmup_gcs'):
+      get_storage_manager(creative_service.GCS_BUCKET).bucket
+  with metrics.span('warmup_detector'):
+    detector = creative_service.DETECTOR
+    try:
+      detector.warm_up()
+    except Exception as ex:
+      # The first request tries again.
+      print(f'Could not warm up the {detector.name} detector: {ex}')
 
-  try:
-    credentials = app_engine.Credentials()
-
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
-    blob.upload_from_string(file)
-    url = blob.generate_signed_url(
-        version='v4',
-        expiration=datetime.timedelta(minutes=MINUTES_TO_EXPIRE),
-        method='GET',
-    )
-    return url
-  except Exception as ex:
-    print(ex)
-    return ex
+  return '', 204
 
 
-def _get_gcs_signed_url(file_name, bucket_name):
-  """Builds the signed URL to temporary access the GCS files from any client
+@app.route('/admin/metrics')
+def metrics_endpoint():
+  """Exposes the metrics of all the workers of the instance to Prometheus.
 
-  Args:
-      file_name (str): the file to generate the signed URL for
-      bucket_name (stre): name of the Google Cloud Storage bucket
+  Under /admin, App Engine only lets the administrators of the project in.
 
   Returns:
-      str: signed URL
+      Response: the metrics in the Prometheus text format
   """
-  credentials = app_engine.Credentials()
+  return Response(metrics.render(),
+                  content_type='text/plain; version=0.0.4; charset=utf-8')
 
-  storage_client = storage.Client(credentials=credentials)
-  bucket = storage_client.bucket(bucket_name)
-  blob = bucket.get_blob(file_name)
-
-  url = blob.generate_signed_url(
-      version='v4',
-      expiration=datetime.timedelta(minutes=MINUTES_TO_EXPIRE),
-      method='GET',
-  )
-  return url
 
+@app.route(f'/static/{static_assets.DIST_DIR}/<path:filename>')
+def fingerprinted_static(filename):
+  """Serves the fingerprinted static files, precompressed when possible.
 
-def _process_image(img_url, threshold, img_dimensions):
-  """Detects all the objects in the image, their labels and returns the HTML bits for later
-
-  composition.
-
-  Args:
-      img_url (str): URL of the image to analyse
-      threshold (float): number between 0 and 1 to use as confidence threshold
-        for detection
-      img_dimensions (str): image dimensions in widthxheight format. i.e:
-        300x600
+  Their names change with their content so they are cached forever.
 
   Returns:
-      (str,
-       str,
-       int,
-       int,
-       [str],
-       [str],
-       [str],
-       [str],
-       [str]): the generated URL after saving the image in the server, name of
-       the image, image width, image height, clip paths HTML5 strings, map areas
-       HTML5 strings, cut layer HTML5 strings, object names strings, svg circles
-       HTML5 strings
+      Response: the file
   """
+  path = safe_join(app.static_folder, static_assets.DIST_DIR, filename)
+  if path is None or not os.path.isfile(path):
+    abort(404)
 
-  bucket = None
-  local = True
-  if _is_local():
-    local = True
-    tmp_dir = 'static/images'
-  else:
-    local = False
-    tmp_dir = '/tmp'
-    bucket = GCS_BUCKET
-
-  desired_width = int(img_dimensions.split('x')[0])
-  desired_height = int(img_dimensions.split('x')[1])
-
-  (new_img_url, img_name, width, height, polygons) = detect_objects(
-      img_url,
-      tmp_dir,
-      threshold,
-      desired_width,
-      desired_height,
-      local,
-      API_KEY,
-      bucket,
-  )
-
-  if not _is_local():
-    new_img_url = _get_gcs_signed_url(new_img_url, bucket)
-    print(f'Replacing the image with the signed GCS URL {new_img_url}')
-
-  new_img_url = parse.unquote(new_img_url)
-
-  (clip_paths, map_areas, tap_areas_hover, tap_areas_active, exit_metrics, cut_layers_hover, cut_layers_active, object_names, circles) = (
-      generate_html5_parts(polygons)
-  )
-
-  return (
-      new_img_url,
-      img_name,
-      width,
-      height,
-      clip_paths,
-      map_areas,
-      tap_areas_hover,
-      tap_areas_active,
-      exit_metrics,
-      cut_layers_hover,
-      cut_layers_active,
-      object_names,
-      circles,
-  )
+  (variant, encoding) = static_assets.precompressed_variant(
+      path, request.headers.get('Accept-Encoding'))
+  response = send_file(variant or path, mimetype=mimetypes.guess_type(path)[0])
+  if encoding:
+    response.headers['Content-Encoding'] = encoding
+  response.headers['Vary'] = 'Accept-Encoding'
+  response.headers['Cache-Control'] = static_assets.IMMUTABLE_CACHE_CONTROL
+  return response
 
 
 @app.route('/')
@@ -384,6 +255,7 @@ def index():
 
 
 @app.route('/build_creative', methods=(['POST']))
+@PROFILER.profiled
 def build_creative():
   """Detects all the objects in the image, their labels and presents it in HTML.
 
@@ -402,16 +274,10 @@ def build_creative():
         img_name,
         width,
         height,
-        clip_paths,
-        map_areas,
-        tap_areas_hover,
-        tap_areas_active,
-        exit_metrics,
-        cut_layers_hover,
-        cut_layers_active,
-        object_names,
-        circles,
-    ) = _process_image(img_url, threshold, img_dimensions)
+        html5_parts,
+        artifact_token,
+    ) = creative_service.process_image(img_url, threshold, img_dimensions,
+                                       _is_local())
 
     return render_template(
         '/build_creative.html',
@@ -419,15 +285,8 @@ def build_creative():
         img_name=img_name,
         width=width,
         height=height,
-        object_names=','.join(object_names),
-        cut_layers_hover=Markup('\n'.join(cut_layers_hover)).unescape(),
-        cut_layers_active=Markup('\n'.join(cut_layers_active)).unescape(),
-        clip_paths=Markup('\n'.join(clip_paths)).unescape(),
-        map_areas=Markup('\n'.join(map_areas)).unescape(),
-        tap_areas_hover=Markup('\n'.join(tap_areas_hover)).unescape(),
-        tap_areas_active=Markup('\n'.join(tap_areas_active)).unescape(),
-        exit_metrics=Markup('\n'.join(exit_metrics)).unescape(),
-        circles=Markup('\n'.join(circles)).unescape(),
+        artifact_token=artifact_token,
+        **html5_parts._asdict(),
     )
   except Exception as ex:
     return render_template(
@@ -435,7 +294,104 @@ def build_creative():
     )
 
 
+@app.route('/build_creatives', methods=(['POST']))
+def build_creatives():
+  """Detects all the objects in the image once and builds every creative size.
+
+  Returns:
+      str: JSON with the image & HTML5 parts of every size or the error
+      description
+  """
+
+  try:
+    img_url = request.form['img_url']
+    threshold = request.form['threshold']
+    sizes = []
+    for img_dimensions in request.form.getlist('img_dimensions'):
+      sizes.extend(size for size in img_dimensions.split(',') if size)
+
+    return jsonify(
+        creative_service.process_image_sizes(img_url, threshold, sizes,
+                                             _is_local()))
+  except Exception as ex:
+    return jsonify({'error': f'Error while processing the image:{str(ex)}'}), 500
+
+
+@app.route('/jobs', methods=(['POST']))
+def submit_job():
+  """Queues the build of a creative and returns right away.
+
+  Returns:
+      str: JSON with the id of the job and the URLs to follow it or the error
+      description
+  """
+
+  try:
+    img_url = request.form['img_url']
+    threshold = request.form['threshold']
+    img_dimensions = request.form['img_dimensions']
+  except Exception as ex:
+    return jsonify({'error': f'Missing parameter: {str(ex)}'}), 400
+
+  try:
+    job_id = JOB_RUNNER.submit(_build_creative_job, img_url, threshold,
+                               img_dimensions, _is_local())
+  except jobs.JobQueueFull as ex:
+    return jsonify({'error': str(ex)}), 503
+  except Exception as ex:
+    return jsonify({'error': f'Could not queue the job: {str(ex)}'}), 500
+
+  return jsonify({
+      'job_id': job_id,
+      'status_url': url_for('job_status', job_id=job_id),
+      'result_url': url_for('job_result', job_id=job_id),
+  }), 202
+
+
+@app.route('/jobs/<job_id>', methods=(['GET']))
+def job_status(job_id):
+  """Reports the status and the current stage of a job.
+
+  It answers right away, the clients poll it until the job finishes.
+
+  Returns:
+      str: JSON with the status of the job
+  """
+
+  job = JOB_STORE.get(job_id)
+  if job is None:
+    return jsonify({'error': f'Unknown job {job_id}'}), 404
+  return jsonify(_job_status(job))
+
+
+@app.route('/job_result', methods=(['GET']))
+def job_result():
+  """Presents the creative built by a job.
+
+  It lives next to /build_creative since the template links the static files
+  with relative URLs.
+
+  Returns:
+      str: rendered HTML with the image & detect objects or the error
+      description
+  """
+
+  job_id = request.args.get('job_id')
+  job = JOB_STORE.get(job_id)
+  if job is None:
+    return render_template('error.html', message=f'Unknown job {job_id}'), 404
+  if job['status'] == jobs.FAILED:
+    return render_template(
+        'error.html',
+        message=f'Error while processing the image:{job["error"]}')
+  if job['status'] != jobs.DONE:
+    return redirect(url_for('job_status', job_id=job_id))
+
+  return render_template('/build_creative.html', **job['result'])
+
+
 @app.route('/generate_zip', methods=(['POST']))
+@PROFILER.profiled
 def generate_zip():
   """Generates and save the zip file.
 
@@ -447,12 +403,19 @@ def generate_zip():
     img_url = parse.unquote(request.form['img_url'])
     img_name = parse.unquote(request.form['img_name'])
     html_file = request.files.get('html_file')
+    artifact_token = request.form.get('artifact_token')
     local_base_url = request.url_root
     zip_file_name = f'creative_{str(time.time()).replace(".","")}'
-    zip_file = _create_zip(
-        zip_file_name, html_file.read(), img_url, img_name, local_base_url
-    )
-    zip_file_url = _save_zip(zip_file, zip_file_name, local_base_url)
+    with metrics.span('zip'):
+      zip_file_url = creative_service.save_zip(
+          zip_file_name,
+          html_file.read(),
+          img_url,
+          img_name,
+          artifact_token,
+          local_base_url,
+          _is_local(),
+      )
     print(f'Results generated at {zip_file_url}')
 
     return zip_file_url
@@ -462,6 +425,36 @@ def generate_zip():
     )
 
 
+@app.route('/admin/profiles', methods=(['GET']))
+def list_profiles():
+  """Lists the stored request profiles, the newest first.
+
+  Returns:
+      str: JSON with the name, endpoint, time, duration and size of every
+      profile
+  """
+  if not PROFILER.enabled:
+    abort(404)
+  profiles = PROFILER.list_profiles()
+  for profile in profiles:
+    profile['url'] = url_for('download_profile', name=profile['name'])
+  return jsonify(profiles)
+
+
+@app.route('/admin/profiles/<name>', methods=(['GET']))
+def download_profile(name):
+  """Downloads a stored request profile.
+
+  Returns:
+      Response: the pstats or collapsed stacks file
+  """
+  path = PROFILER.profile_path(name) if PROFILER.enabled else None
+  if path is None:
+    abort(404)
+  return send_file(path, mimetype='application/octet-stream',
+                   as_attachment=True, download_name=name)
+
+
 @app.route('/clean', methods=(['GET']))
 def clean():
   """Deletes the generated artefacast: zip file and image.
@@ -473,9 +466,11 @@ def clean():
   try:
     img_url = request.args.get('img_url')
     zip_file_url = request.args.get('zip_file_url')
+    artifact_token = request.args.get('artifact_token')
     print(img_url)
     print(zip_file_url)
-    _clean_files(img_url, zip_file_url)
+    creative_service.clean_files(img_url, zip_file_url, artifact_token,
+                                 _is_local())
   except Exception as ex:
     None
 
@@ -26,6 +26,16 @@ resource "null_resource" "copy_third_party" {
   }
 }
 
+resource "null_resource" "build_static_assets" {
+ depends_on = [null_resource.copy_third_party]
+ triggers = {
+        build_number = "${timestamp()}"
+ }
+ provisioner "local-exec" {
+    command = "python3 -m pip install --quiet Brotli==1.0.9 && python3 static_assets.py"
+  }
+}
+
 resource "google_project_service" "appengine_api" {
   depends_on = [local_file.yaml]
   project = var.gcp_project
@@ -39,8 +49,19 @@ resource "google_app_engine_application" "app" {
   location_id = var.gcp_project_location
 }
 
-resource "null_resource" "run_cloud_deploy" {
+# Deletes the blobs of the app left behind, see storage_lifecycle.json.
+resource "null_resource" "set_bucket_lifecycle" {
  depends_on = [google_app_engine_application.app]
+ triggers = {
+        lifecycle = filemd5("storage_lifecycle.json")
+ }
+ provisioner "local-exec" {
+    command = "gsutil lifecycle set storage_lifecycle.json gs://${var.gcp_project}.appspot.com"
+  }
+}
+
+resource "null_resource" "run_cloud_deploy" {
+ depends_on = [google_app_engine_application.app, null_resource.build_static_assets]
  triggers = {
         build_number = "${timestamp()}"
  }
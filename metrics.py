@@ -0,0 +1,379 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counters and histograms of the pipeline, in the Prometheus text format.
+
+Every process counts in memory and adds what it counted to a SQLite table
+shared by all the workers of the instance every FLUSH_SECONDS, so a scrape
+served by any worker sees the totals of all of them.
+"""
+
+import atexit
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+METRICS_PATH = os.environ.get('METRICS_PATH') or os.path.join(
+    tempfile.gettempdir(), 'creative_metrics.sqlite3')
+FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+
+def _format_labels(label_names, label_values, extra=''):
+  pairs = [
+      f'{name}="{value}"' for name, value in zip(label_names, label_values)
+  ]
+  if extra:
+    pairs.append(extra)
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+  """Monotonic counter, optionally split by labels."""
+
+  def __init__(self, name, help_text, label_names=()):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+    self._values = {}
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def inc(self, amount=1, **labels):
+    """Adds to the counter.
+
+    Args:
+        amount (float, optional): value to add. Defaults to 1
+        **labels: value of every label of the counter
+    """
+    key = tuple(str(labels[name]) for name in self.label_names)
+    _start_flusher()
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def drain(self):
+    """Takes what was counted since the last call.
+
+    Returns:
+        [(str, float)]: sample key and amount to add to the shared table
+    """
+    with self._lock:
+      (values, self._values) = (self._values, {})
+    return [(json.dumps(key), value) for key, value in values.items()]
+
+  def collect(self, samples):
+    """Renders the counter in the Prometheus text format.
+
+    Args:
+        samples (Dict[str, float]): totals of the shared table by sample key
+
+    Returns:
+        [str]: lines of the counter
+    """
+    lines = [
+        f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter'
+    ]
+    values = sorted(
+        (tuple(json.loads(key)), value) for key, value in samples.items())
+    for key, value in values:
+      lines.append(
+          f'{self.name}{_format_labels(self.label_names, key)} {value}')
+    return lines
+
+
+class Histogram:
+  """Distribution of observed values in fixed buckets, split by labels.
+
+  Observing a value only increments one bucket, the cumulative counts the
+  Prometheus format expects are computed when the histogram is collected.
+  """
+
+  def __init__(self, name, help_text, label_names=(),
+               buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+    self.buckets = tuple(buckets)
+    self._values = {}
+    self._lock = threading.Lock()
+    REGISTRY.append(self)
+
+  def observe(self, value, **labels):
+    """Records a value.
+
+    Args:
+        value (float): the observed value
+        **labels: value of every label of the histogram
+    """
+    key = tuple(str(labels[name]) for name in self.label_names)
+    index = bisect.bisect_left(self.buckets, value)
+    _start_flusher()
+    with self._lock:
+      entry = self._values.get(key)
+      if entry is None:
+        entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+      entry[0][index] += 1
+      entry[1] += value
+      entry[2] += 1
+
+  def drain(self):
+    """Takes what was observed since the last call.
+
+    Returns:
+        [(str, float)]: sample key and amount to add to the shared table, one
+        per bucket, plus the sum and the count
+    """
+    with self._lock:
+      (values, self._values) = (self._values, {})
+    samples = []
+    for key, (counts, total, count) in values.items():
+      samples.extend((json.dumps([key, index]), bucket_count)
+                     for index, bucket_count in enumerate(counts)
+                     if bucket_count)
+      samples.append((json.dumps([key, 'sum']), total))
+      samples.append((json.dumps([key, 'count']), count))
+    return samples
+
+  def collect(self, samples):
+    """Renders the histogram in the Prometheus text format.
+
+    Args:
+        samples (Dict[str, float]): totals of the shared table by sample key
+
+    Returns:
+        [str]: lines of the histogram
+    """
+    lines = [
+        f'# HELP {self.name} {self.help_text}',
+        f'# TYPE {self.name} histogram'
+    ]
+    entries = {}
+    for sample_key, value in samples.items():
+      (key, field) = json.loads(sample_key)
+      entry = entries.setdefault(
+          tuple(key), [[0] * (len(self.buckets) + 1), 0.0, 0])
+      if field == 'sum':
+        entry[1] = value
+      elif field == 'count':
+        entry[2] = int(value)
+      else:
+        entry[0][field] = int(value)
+    for key, (counts, total, count) in sorted(entries.items()):
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+        cumulative += bucket_count
+        labels = _format_labels(self.label_names, key, f'le="{bound}"')
+        lines.append(f'{self.name}_bucket{labels} {cumulative}')
+      labels = _format_labels(self.label_names, key)
+      lines.append(f'{self.name}_sum{labels} {total}')
+      lines.append(f'{self.name}_count{labels} {count}')
+    return lines
+
+
+REGISTRY = []
+
+STAGE_DURATION = Histogram('creative_stage_duration_seconds',
+                           'Time spent in every stage of the pipeline.',
+                           ['stage'])
+REQUEST_DURATION = Histogram('creative_request_duration_seconds',
+                             'Time spent serving the requests.',
+                             ['endpoint', 'status'])
+VISION_CALLS = Counter('creative_vision_calls_total',
+                       'Calls to the Vision API.')
+VISION_IMAGES = Counter('creative_vision_images_total',
+                        'Images sent to the Vision API.')
+ANNOTATION_CACHE = Counter('creative_annotation_cache_total',
+                           'Lookups of Vision responses in the cache.',
+                           ['result'])
+ARTIFACT_STORE = Counter('creative_artifact_store_total',
+                         'Lookups of resized images in the artifact store.',
+                         ['result'])
+ARTIFACTS_PURGED = Counter(
+    'creative_artifacts_purged_total',
+    'Generated images and zips deleted by the janitor.',
+    ['location', 'reason'])
+TRANSFERRED_BYTES = Counter(
+    'creative_transferred_bytes_total',
+    'Bytes downloaded from or uploaded to other services.',
+    ['direction', 'peer'])
+
+# Spans of the request being served, None outside of a request.
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+
+
+@contextlib.contextmanager
+def span(stage):
+  """Times a stage of the pipeline.
+
+  The duration is added to the stage histogram and, inside a request, to the
+  spans reported in its Server-Timing header.
+
+  Args:
+      stage (str): name of the stage, i.e: download
+  """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    duration = time.perf_counter() - start
+    STAGE_DURATION.observe(duration, stage=stage)
+    spans = _request_spans.get()
+    if spans is not None:
+      spans.append((stage, duration))
+
+
+def start_request():
+  """Starts collecting the spans of a request.
+
+  Returns:
+      contextvars.Token: token to give back to end_request
+  """
+  return _request_spans.set([])
+
+
+def end_request(token):
+  """Stops collecting the spans of a request.
+
+  Args:
+      token (contextvars.Token): token returned by start_request
+
+  Returns:
+      [(str, float)]: name and duration in seconds of the spans
+  """
+  spans = _request_spans.get() or []
+  _request_spans.reset(token)
+  return spans
+
+
+def server_timing(spans, total=None):
+  """Formats spans as the value of a Server-Timing header.
+
+  Spans of the same stage are added up, i.e: one encode per creative size.
+
+  Args:
+      spans ([(str, float)]): name and duration in seconds of the spans
+      total (float, optional): duration of the whole request in seconds
+
+  Returns:
+      str: header value, i.e: download;dur=120.5, vision;dur=840.2
+  """
+  durations = {}
+  for stage, duration in spans:
+    durations[stage] = durations.get(stage, 0.0) + duration
+  if total is not None:
+    durations['total'] = total
+  return ', '.join(
+      f'{stage};dur={duration * 1000:.1f}'
+      for stage, duration in durations.items())
+
+
+@contextlib.contextmanager
+def _connect():
+  db = sqlite3.connect(METRICS_PATH, timeout=10, isolation_level=None)
+  try:
+    # No type on the value, the integer counts stay integers.
+    db.execute('CREATE TABLE IF NOT EXISTS samples (name TEXT, key TEXT,'
+               ' value, PRIMARY KEY (name, key))')
+    yield db
+  finally:
+    db.close()
+
+
+def flush():
+  """Adds what this process counted since the last flush to the shared table."""
+  rows = [(metric.name, key, value)
+          for metric in REGISTRY
+          for (key, value) in metric.drain()]
+  if not rows:
+    return
+  with _connect() as db:
+    db.execute('BEGIN IMMEDIATE')
+    try:
+      # Without an upsert, the SQLite of the runtime is older than 3.24.
+      db.executemany('INSERT OR IGNORE INTO samples VALUES (?, ?, 0)',
+                     [(name, key) for (name, key, _) in rows])
+      db.executemany(
+          'UPDATE samples SET value = value + ? WHERE name = ? AND key = ?',
+          [(value, name, key) for (name, key, value) in rows])
+      db.execute('COMMIT')
+    except BaseException:
+      db.execute('ROLLBACK')
+      raise
+
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def _start_flusher():
+  """Starts the thread flushing the metrics, once per process."""
+  global _flusher_pid
+  if _flusher_pid == os.getpid():
+    return
+  with _flusher_lock:
+    if _flusher_pid == os.getpid():
+      return
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_forever, daemon=True).start()
+
+
+def _flush_forever():
+  while True:
+    time.sleep(FLUSH_SECONDS)
+    try:
+      flush()
+    except Exception as ex:
+      print(f'Error flushing the metrics: {ex}')
+
+
+def _forget_parent_values():
+  # A forked worker starts with what its parent has not flushed yet, the
+  # parent still adds it. The locks may have been held by a thread that is
+  # not in the child.
+  for metric in REGISTRY:
+    metric._values = {}  # pylint: disable=protected-access
+    metric._lock = threading.Lock()  # pylint: disable=protected-access
+
+
+os.register_at_fork(after_in_child=_forget_parent_values)
+atexit.register(flush)
+
+
+def render():
+  """Renders the metrics of all the workers in the Prometheus text format.
+
+  The ones of this process are flushed first, the others are at most
+  FLUSH_SECONDS late.
+
+  Returns:
+      str: the exposition text
+  """
+  flush()
+  samples = {}
+  with _connect() as db:
+    for (name, key, value) in db.execute('SELECT name, key, value FROM'
+                                         ' samples'):
+      samples.setdefault(name, {})[key] = value
+  lines = []
+  for metric in REGISTRY:
+    lines.extend(metric.collect(samples.get(metric.name, {})))
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,210 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import cProfile
+import functools
+import os
+import random
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from flask import make_response, request
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_MODE_HEADER = 'X-Profile-Mode'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+MODES = {'cprofile': '.pstats', 'sample': '.folded'}
+PROFILE_NAME_PATTERN = re.compile(
+    r'^(?P<time>\d+)_(?P<endpoint>\w+)_(?P<duration>\d+)ms_\w+'
+    r'\.(?:pstats|folded)$')
+
+
+class _Sampler:
+  """Samples the stack of a thread at a fixed interval.
+
+  The stacks are kept in the collapsed format read by flamegraph.pl and
+  speedscope, one line per distinct stack with the number of samples. Native
+  code such as OpenCV shows as the Python frame that called it. The methods
+  mirror the ones of cProfile.Profile so both are used the same way.
+  """
+
+  def __init__(self, thread_id, interval):
+    self.thread_id = thread_id
+    self.interval = interval
+    self.stacks = collections.Counter()
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id)
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                     f':{code.co_firstlineno})')
+        frame = frame.f_back
+      if stack:
+        self.stacks[';'.join(reversed(stack))] += 1
+
+  def enable(self):
+    self._thread.start()
+
+  def disable(self):
+    self._stop.set()
+    self._thread.join()
+
+  def dump_stats(self, path):
+    with open(path, 'w') as f:
+      for stack, count in self.stacks.most_common():
+        f.write(f'{stack} {count}\n')
+
+
+class Profiler:
+  """Profiles single requests on demand and keeps the last profiles on disk.
+
+  It is off unless enabled. Once enabled, a request is profiled when it has the
+  X-Profile header, set to the token when one is configured, or at random with
+  the sample rate. X-Profile-Mode picks cprofile, deterministic and saved as
+  pstats, or sample, a stack sampler saved as collapsed stacks.
+  """
+
+  def __init__(self, enabled=False, token=None, sample_rate=0.0,
+               default_mode='sample', sample_interval_ms=5, profile_dir=None,
+               max_profiles=50):
+    self.enabled = enabled
+    self.token = token
+    self.sample_rate = sample_rate
+    self.default_mode = default_mode
+    self.sample_interval = sample_interval_ms / 1000
+    self.profile_dir = profile_dir or os.path.join(tempfile.gettempdir(),
+                                                   'creative_profiles')
+    self.max_profiles = max_profiles
+    self._lock = threading.Lock()
+
+  def _requested_mode(self):
+    """Decides if the current request is profiled and how.
+
+    Returns:
+        str: cprofile, sample or None to not profile the request
+    """
+    if not self.enabled:
+      return None
+
+    header = request.headers.get(PROFILE_HEADER)
+    if header is not None:
+      if self.token and not secrets.compare_digest(header, self.token):
+        return None
+    elif not (self.sample_rate and random.random() < self.sample_rate):
+      return None
+
+    mode = request.headers.get(PROFILE_MODE_HEADER, self.default_mode)
+    return mode if mode in MODES else self.default_mode
+
+  def _save(self, endpoint, duration, mode, profile):
+    """Stores a profile and drops the oldest ones over the limit.
+
+    Returns:
+        str: name of the stored profile
+    """
+    os.makedirs(self.profile_dir, exist_ok=True)
+    name = (f'{int(time.time() * 1000)}_{endpoint}_{int(duration * 1000)}ms_'
+            f'{secrets.token_hex(4)}{MODES[mode]}')
+    profile.dump_stats(os.path.join(self.profile_dir, name))
+
+    with self._lock:
+      for old_name in self.list_profiles()[self.max_profiles:]:
+        try:
+          os.remove(os.path.join(self.profile_dir, old_name['name']))
+        except OSError:
+          pass
+    return name
+
+  def profiled(self, view):
+    """Decorates a view to profile it when requested.
+
+    The name of the stored profile is returned in the X-Profile-Id header.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+      mode = self._requested_mode()
+      if mode is None:
+        return view(*args, **kwargs)
+
+      if mode == 'cprofile':
+        profile = cProfile.Profile()
+      else:
+        profile = _Sampler(threading.get_ident(), self.sample_interval)
+
+      start = time.perf_counter()
+      profile.enable()
+      try:
+        response = make_response(view(*args, **kwargs))
+      finally:
+        profile.disable()
+        name = self._save(view.__name__, time.perf_counter() - start, mode,
+                          profile)
+        print(f'Profile of {view.__name__} saved as {name}')
+
+      response.headers[PROFILE_ID_HEADER] = name
+      return response
+
+    return wrapper
+
+  def list_profiles(self):
+    """Lists the stored profiles, the newest first.
+
+    Returns:
+        [Dict[str, object]]: name, endpoint, time, duration and size of every
+        profile
+    """
+    if not os.path.isdir(self.profile_dir):
+      return []
+
+    profiles = []
+    for name in os.listdir(self.profile_dir):
+      match = PROFILE_NAME_PATTERN.match(name)
+      if match is None:
+        continue
+      try:
+        size = os.path.getsize(os.path.join(self.profile_dir, name))
+      except OSError:
+        continue
+      profiles.append({
+          'name': name,
+          'endpoint': match['endpoint'],
+          'time': int(match['time']) / 1000,
+          'duration_ms': int(match['duration']),
+          'size': size,
+      })
+    return sorted(profiles, key=lambda profile: profile['time'], reverse=True)
+
+  def profile_path(self, name):
+    """Returns the path of a stored profile.
+
+    Args:
+        name (str): name of the profile
+
+    Returns:
+        str: path of the file or None if there is no such profile
+    """
+    if PROFILE_NAME_PATTERN.match(name) is None:
+      return None
+    path = os.path.join(self.profile_dir, name)
+    return path if os.path.isfile(path) else None
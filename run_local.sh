@@ -53,4 +53,5 @@ find_config_value()
 export API_KEY=$(find_config_value "variable vision_api_key")
 pip install -r requirements_local.txt --force-reinstall --require-hashes
 cp third_party/jscolor.js static/js/
+python static_assets.py
 gunicorn -w 4 main:app
\ No newline at end of file
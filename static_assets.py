@@ -0,0 +1,210 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fingerprinted and precompressed copies of the static JS and CSS files.
+
+Running this module copies every file of static/js and static/css into
+static/dist with the hash of its content in the name, i.e:
+js/Enabler.3f2a9c1b0d.js, next to its gzip and brotli variants. The manifest
+maps the original names to the fingerprinted ones, so the URLs change when the
+content does and the files can be cached forever.
+
+Usage: python static_assets.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+STATIC_DIR = 'static'
+DIST_DIR = 'dist'
+SOURCE_DIRS = ['js', 'css']
+MANIFEST_FILE = 'manifest.json'
+HASH_LENGTH = 10
+# Precompressed variants in order of preference, with their extension.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def fingerprinted_name(name, content):
+  """Adds the hash of the content to a file name.
+
+  Args:
+      name (str): path of the file relative to static/, i.e: js/Enabler.js
+      content (bytes): content of the file
+
+  Returns:
+      str: the fingerprinted path, i.e: js/Enabler.3f2a9c1b0d.js
+  """
+  digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+  (stem, extension) = os.path.splitext(name)
+  return f'{stem}.{digest}{extension}'
+
+
+def build(static_dir=STATIC_DIR):
+  """Writes the fingerprinted files, their compressed variants and manifest.
+
+  Args:
+      static_dir (str, optional): the static directory. Defaults to static
+
+  Returns:
+      Dict[str, str]: the manifest
+  """
+  # Only the build needs it, the app serves the files written here. Missing,
+  # the build fails rather than leaving out the variant browsers prefer.
+  import brotli  # pylint: disable=g-import-not-at-top
+
+  dist_dir = os.path.join(static_dir, DIST_DIR)
+  shutil.rmtree(dist_dir, ignore_errors=True)
+
+  manifest = {}
+  for source_dir in SOURCE_DIRS:
+    for file_name in sorted(os.listdir(os.path.join(static_dir, source_dir))):
+      name = f'{source_dir}/{file_name}'
+      if os.path.splitext(name)[1] not in ('.js', '.css'):
+        continue
+      with open(os.path.join(static_dir, name), 'rb') as f:
+        content = f.read()
+
+      hashed_name = fingerprinted_name(name, content)
+      path = os.path.join(dist_dir, hashed_name)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with open(path, 'wb') as f:
+        f.write(content)
+      with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, 9, mtime=0))
+      with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(content, quality=11))
+
+      manifest[name] = hashed_name
+      print(f'{name} -> {DIST_DIR}/{hashed_name}')
+
+  with open(os.path.join(dist_dir, MANIFEST_FILE), 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  return manifest
+
+
+def load_manifest(static_dir=STATIC_DIR):
+  """Reads the manifest written by build.
+
+  Args:
+      static_dir (str, optional): the static directory. Defaults to static
+
+  Returns:
+      Dict[str, str]: original to fingerprinted names, empty when the assets
+      have not been built
+  """
+  try:
+    with open(os.path.join(static_dir, DIST_DIR, MANIFEST_FILE)) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    print('The static assets are not built, serving them without fingerprints')
+    return {}
+
+
+def asset_url(manifest, name):
+  """Returns the URL of a static file, fingerprinted when it was built.
+
+  The URL is relative like the ones in the templates, i.e: static/js/x.js.
+
+  Args:
+      manifest (Dict[str, str]): the manifest
+      name (str): path of the file relative to static/, i.e: js/Enabler.js
+
+  Returns:
+      str: the URL of the file
+  """
+  hashed_name = manifest.get(name)
+  if hashed_name is None:
+    return f'{STATIC_DIR}/{name}'
+  return f'{STATIC_DIR}/{DIST_DIR}/{hashed_name}'
+
+
+def unfingerprint(html, manifest):
+  """Points the fingerprinted references of an exported creative back to the
+
+  names of the files inside the creative zip.
+
+  The creative is exported with the static/ prefix removed, so the template
+  references show up as dist/js/Enabler.3f2a9c1b0d.js.
+
+  Args:
+      html (bytes): the exported HTML
+      manifest (Dict[str, str]): the manifest
+
+  Returns:
+      bytes: the HTML referencing the zip members, i.e: js/Enabler.js
+  """
+  for name, hashed_name in manifest.items():
+    html = html.replace(f'{DIST_DIR}/{hashed_name}'.encode('utf-8'),
+                        name.encode('utf-8'))
+  return html
+
+
+def _parse_accept_encoding(accept_encoding):
+  """Reads the quality value of every encoding of an Accept-Encoding header.
+
+  Args:
+      accept_encoding (str): value of the header, i.e: gzip;q=1.0, br;q=0
+
+  Returns:
+      Dict[str, float]: quality of every encoding listed, 0 if refused
+  """
+  qualities = {}
+  for value in (accept_encoding or '').split(','):
+    (encoding, *params) = value.split(';')
+    encoding = encoding.strip().lower()
+    if not encoding:
+      continue
+    quality = 1.0
+    for param in params:
+      (name, _, param_value) = param.partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          quality = float(param_value)
+        except ValueError:
+          quality = 0.0
+    qualities[encoding] = quality
+  return qualities
+
+
+def precompressed_variant(path, accept_encoding):
+  """Chooses the best precompressed variant of a file the client accepts.
+
+  The encodings refused with q=0 are skipped, the others are tried from the
+  highest quality, in the order of ENCODINGS for the same quality.
+
+  Args:
+      path (str): path of the file on disk
+      accept_encoding (str): value of the Accept-Encoding header
+
+  Returns:
+      (str, str): path of the variant and its encoding or (None, None)
+  """
+  qualities = _parse_accept_encoding(accept_encoding)
+  candidates = []
+  for (order, (encoding, extension)) in enumerate(ENCODINGS):
+    quality = qualities.get(encoding, qualities.get('*', 0.0))
+    if quality > 0:
+      candidates.append((-quality, order, encoding, extension))
+  for (_, _, encoding, extension) in sorted(candidates):
+    if os.path.isfile(path + extension):
+      return (path + extension, encoding)
+  return (None, None)
+
+
+if __name__ == '__main__':
+  build()
@@ -0,0 +1,172 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import json
+import os
+import queue
+import threading
+import time
+
+MAX_IMAGES_PER_CALL = 16
+
+
+class VisionBatcher:
+  """Groups the annotate requests of concurrent callers into a single call.
+
+  Requests are collected for a few milliseconds, or until the batch is full,
+  and sent together. Each caller gets back a future with the response for its
+  own image only, so an error in one image does not affect the others.
+  """
+
+  def __init__(self, annotate, max_batch_size=MAX_IMAGES_PER_CALL,
+               max_wait_ms=10, max_batch_bytes=8 * 1024 * 1024,
+               max_in_flight=4, size_of=None, timeout=None):
+    """Initializes the batcher.
+
+    Args:
+        annotate (Callable[[List[Dict]], List[Dict]]): sends the annotate
+          requests and returns one response per request, in the same order
+        max_batch_size (int, optional): maximum number of images per call.
+          Defaults to 16
+        max_wait_ms (int, optional): maximum time to wait for the batch to
+          fill up. Defaults to 10
+        max_batch_bytes (int, optional): maximum size of the JSON payload of
+          a call. Defaults to 8 MB
+        max_in_flight (int, optional): maximum number of concurrent calls.
+          Defaults to 4
+        size_of (Callable[[object], int], optional): size of a request counted
+          against max_batch_bytes. Defaults to None, the size of its JSON
+        timeout (float, optional): seconds call waits for the batch before
+          sending the request on its own. Defaults to None, no limit
+    """
+    self.annotate = annotate
+    self.max_batch_size = min(max_batch_size, MAX_IMAGES_PER_CALL)
+    self.max_wait_ms = max_wait_ms
+    self.max_batch_bytes = max_batch_bytes
+    self.max_in_flight = max_in_flight
+    self.size_of = size_of or (lambda request: len(json.dumps(request)))
+    self.timeout = timeout
+    self._queue = queue.Queue()
+    self._lock = threading.Lock()
+    self._pid = None
+    self._executor = None
+
+  def _get_queue(self):
+    """Returns the queue of the process, starting its collector thread.
+
+    Threads do not survive a fork, so it is started lazily in every worker.
+    The check and the read happen under the lock, a caller never gets the
+    queue inherited from the parent, which nobody reads.
+
+    Returns:
+        queue.Queue: queue read by the collector thread of this process
+    """
+    with self._lock:
+      if self._pid != os.getpid():
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        threading.Thread(target=self._collect, args=(self._queue,),
+                         daemon=True).start()
+        self._pid = os.getpid()
+      return self._queue
+
+  def submit(self, annotate_request):
+    """Queues an annotate request for the next batch.
+
+    Args:
+        annotate_request (Dict[str, Dict]): request for a single image
+
+    Returns:
+        Future: resolves to the Vision API response for the image
+    """
+    work_queue = self._get_queue()
+    future = Future()
+    size = self.size_of(annotate_request)
+    work_queue.put((annotate_request, size, future))
+    return future
+
+  def call(self, annotate_request):
+    """Sends a request in the next batch and waits for its response.
+
+    If the batch does not answer within timeout, the request is taken out of
+    it and sent on its own, unless the batch is already being sent: then its
+    response is awaited, the image is never annotated twice.
+
+    Args:
+        annotate_request (Dict[str, Dict]): request for a single image
+
+    Returns:
+        Dict[str, Dict]: response for the image
+    """
+    future = self.submit(annotate_request)
+    try:
+      return future.result(timeout=self.timeout)
+    except FutureTimeoutError:
+      if not future.cancel():
+        # The batch is running, sending it again would pay for it twice.
+        return future.result()
+      print(f'No response from the batch after {self.timeout} seconds,'
+            ' sending the request on its own')
+    return self.annotate([annotate_request])[0]
+
+  def _collect(self, work_queue):
+    pending = None
+    while True:
+      batch = [pending or work_queue.get()]
+      pending = None
+      batch_bytes = batch[0][1]
+      deadline = time.monotonic() + self.max_wait_ms / 1000.0
+
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          item = work_queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+        if batch_bytes + item[1] > self.max_batch_bytes:
+          pending = item
+          break
+        batch.append(item)
+        batch_bytes += item[1]
+
+      self._executor.submit(self._send, batch)
+
+  def _send(self, batch):
+    """Sends a batch and hands every response to its caller.
+
+    Args:
+        batch ([(Dict, int, Future)]): queued requests
+    """
+    # Leaves out the requests whose callers stopped waiting.
+    batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+    if not batch:
+      return
+    print(f'Sending a batch of {len(batch)} images')
+    try:
+      responses = self.annotate([item[0] for item in batch])
+    except Exception as ex:
+      for _, _, future in batch:
+        future.set_exception(ex)
+      return
+
+    for index, (_, _, future) in enumerate(batch):
+      if index < len(responses):
+        future.set_result(responses[index])
+      else:
+        future.set_result(
+            {'error': {'message': 'Missing response from the Vision API'}})